@@ -0,0 +1,180 @@
+"""Фейковые docker и git для бенчмарков и нагрузочных тестов.
+
+Скрипты кладутся в отдельную папку, которая ставится первой в PATH, и прописываются
+в CD2B_DOCKER/CD2B_GIT; cd2b_runtime на это время переключается на CliRuntime.
+Состояние фейкового docker (запущенные контейнеры, собранные образы) хранится
+в файлах, так что его видят все процессы.
+"""
+import contextlib
+import os
+import stat
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FAKE_COMMIT = '0123456789abcdef0123456789abcdef01234567'
+
+FAKE_DOCKER = r'''#!/bin/sh
+STATE="{state}"
+mkdir -p "$STATE/running" "$STATE/images"
+command="$1"
+shift
+case "$command" in
+  ps)
+    for file in "$STATE"/running/*; do
+      [ -e "$file" ] || continue
+      name=$(basename "$file")
+      printf '%s\t%s\tUp 1 second\n' "$name" "$name"
+    done
+    ;;
+  events)
+    exec sleep 3600
+    ;;
+  image)
+    # image inspect --format ... <image>
+    for last in "$@"; do :; done
+    [ -e "$STATE/images/$last" ] || exit 1
+    echo "sha256:fake"
+    ;;
+  images)
+    for file in "$STATE"/images/"$1":*; do
+      [ -e "$file" ] || continue
+      basename "$file" | cut -d: -f2
+    done
+    ;;
+  build)
+    while [ $# -gt 0 ]; do
+      if [ "$1" = "-t" ]; then touch "$STATE/images/$2"; shift; fi
+      shift
+    done
+    i=0
+    while [ $i -lt {build_lines} ]; do
+      echo "> Task :compileJava $i"
+      i=$((i + 1))
+    done
+    echo "BUILD SUCCESSFUL in 1s"
+    ;;
+  tag)
+    touch "$STATE/images/$2"
+    ;;
+  run)
+    while [ $# -gt 0 ]; do
+      if [ "$1" = "--name" ]; then touch "$STATE/running/$2"; echo "fake-container-id"; fi
+      shift
+    done
+    ;;
+  stop)
+    rm -f "$STATE/running/$1"
+    ;;
+  rmi)
+    for image in "$@"; do rm -f "$STATE/images/$image"; done
+    ;;
+  logs)
+    echo "2024-01-01T00:00:00.000000000Z Started Application"
+    ;;
+esac
+exit 0
+'''
+
+FAKE_GIT = r'''#!/bin/sh
+command="$1"
+case "$command" in
+  clone)
+    for last in "$@"; do :; done
+    mkdir -p "$last/.git" "$last/src/main/resources"
+    echo "FROM scratch" > "$last/Dockerfile"
+    ;;
+  rev-parse)
+    echo "{commit}"
+    ;;
+esac
+exit 0
+'''
+
+
+def write_executable(directory: str, name: str, script: str) -> str:
+    path = os.path.join(directory, name)
+    with open(path, 'w') as file:
+        file.write(script)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+# Готовит рабочую папку: фейковые docker и git в bin/ и ссылки на query/ и templates/,
+# которые приложение ищет относительно текущей директории
+def prepare_workdir(workdir: str, build_lines: int = 200) -> str:
+    bin_dir = os.path.join(workdir, 'bin')
+    os.makedirs(bin_dir, exist_ok=True)
+    write_executable(bin_dir, 'docker', FAKE_DOCKER.format(
+        state=os.path.join(workdir, 'docker-state'),
+        build_lines=build_lines
+    ))
+    write_executable(bin_dir, 'git', FAKE_GIT.format(commit=FAKE_COMMIT))
+    for name in ('query', 'templates'):
+        link = os.path.join(workdir, name)
+        if not os.path.exists(link):
+            os.symlink(os.path.join(ROOT, name), link)
+    return bin_dir
+
+
+# Переходит в workdir и подменяет docker, git и проверку GitHub; на выходе все возвращает как было.
+# Кэши-синглтоны (профили, проперти, авторизация, логи сборки, листинги) на время контекста
+# заменяются пустыми, чтобы бенчмарк не видел чужих записей и не оставлял своих (например, в pytest).
+# Если модули cd2b_* импортируются впервые внутри контекста, константы сразу читаются с фейковыми путями
+@contextlib.contextmanager
+def installed(workdir: str, build_lines: int = 200):
+    bin_dir = prepare_workdir(workdir, build_lines)
+    saved_env = {name: os.environ.get(name) for name in ('PATH', 'CD2B_DOCKER', 'CD2B_GIT', 'CD2B_GIT_MIRRORS')}
+    saved_cwd = os.getcwd()
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+    os.environ['CD2B_DOCKER'] = os.path.join(bin_dir, 'docker')
+    os.environ['CD2B_GIT'] = os.path.join(bin_dir, 'git')
+    os.environ['CD2B_GIT_MIRRORS'] = ''
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    os.chdir(workdir)
+
+    import cd2b_api
+    import cd2b_auth_core
+    import cd2b_build_logs
+    import cd2b_containers
+    import cd2b_db_core
+    import cd2b_git
+    import cd2b_log_files
+    import cd2b_properties
+    import cd2b_runtime
+
+    async def always_reachable(url: str) -> bool:
+        return True
+
+    saved_attributes = [
+        (cd2b_containers, 'DOCKER_BIN', os.environ['CD2B_DOCKER']),
+        (cd2b_git, 'GIT_BIN', os.environ['CD2B_GIT']),
+        (cd2b_git, 'mirrors', None),
+        (cd2b_db_core, 'check_github_repository', always_reachable),
+        (cd2b_api, 'profiles', cd2b_api.ProfileCache()),
+        (cd2b_properties, 'cache', cd2b_properties.PropertiesCache()),
+        (cd2b_auth_core, 'sessions', cd2b_auth_core.SessionCache()),
+        (cd2b_auth_core, 'verified_credentials',
+         cd2b_auth_core.TTLCache(cd2b_auth_core.CREDENTIALS_TTL, cd2b_auth_core.MAX_SESSIONS)),
+        (cd2b_build_logs, 'hub', cd2b_build_logs.LogHub()),
+        (cd2b_log_files, 'listings', cd2b_log_files.ListingCache()),
+    ]
+    originals = [(module, name, getattr(module, name)) for module, name, _ in saved_attributes]
+    for module, name, value in saved_attributes:
+        setattr(module, name, value)
+    # фейковый docker - это CLI, даже если на машине есть сокет Docker Engine;
+    # set_runtime заодно сбрасывает снимок cd2b_containers.status (и на выходе тоже)
+    saved_runtime = cd2b_runtime.set_runtime(cd2b_runtime.CliRuntime())
+    try:
+        yield bin_dir
+    finally:
+        cd2b_runtime.set_runtime(saved_runtime)
+        for module, name, value in originals:
+            setattr(module, name, value)
+        os.chdir(saved_cwd)
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
@@ -0,0 +1,375 @@
+"""Нагрузочный генератор для HTTP и websocket API cd2b.
+
+Поднимает приложение отдельным процессом (uvicorn) во временной папке с фейковыми
+docker и git (см. benchmarks/fakes.py), заводит пользователей с профилями и гоняет
+смесь запросов от многих одновременных пользователей. В отчете - пропускная
+способность, задержки p50/p95/p99, доля ошибок по каждой операции и задержка
+event loop сервера (насколько корутины не успевают вовремя получить управление,
+то есть сколько блокирующей работы осталось в обработке запросов).
+
+    python -m benchmarks.load --users 50 --duration 30 --output load.json
+    python -m benchmarks.load --mix check_profile=1,bandr=1
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Optional
+
+import httpx
+import websockets
+
+from benchmarks import fakes
+from benchmarks.micro import percentile
+
+PASSWORD = 'load-password'
+GITHUB_URL = 'https://github.com/load/service.git'
+
+DEFAULT_MIX = {
+    'check_profile': 35,
+    'all_profiles': 20,
+    'set_port': 15,
+    'change_properties_field': 25,
+    'bandr': 5,
+}
+
+# как часто сервер проверяет задержку event loop, в секундах
+LOOP_LAG_INTERVAL = 0.01
+# сколько ждать запуска сервера, в секундах
+SERVER_START_TIMEOUT = 60
+
+
+def user_login(index: int) -> str:
+    return f'load_user_{index}'
+
+
+def profile_name(index: int) -> str:
+    return f'profile_{index}'
+
+
+# имя контейнера строится из имени профиля, поэтому у каждого пользователя свой профиль для bandr
+def bandr_profile_name(user_index: int) -> str:
+    return f'bandr_{user_index}'
+
+
+class LoopLagMonitor:
+    """Замеряет, на сколько позже запланированного просыпается корутина в event loop сервера."""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.samples: list[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def reset(self):
+        self.samples = []
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - start - self.interval))
+
+    def summary(self) -> dict:
+        return latency_summary(self.samples)
+
+
+def latency_summary(samples: list[float]) -> dict:
+    if not samples:
+        return {'samples': 0}
+    samples = sorted(samples)
+    return {
+        'samples': len(samples),
+        'p50_ms': round(percentile(samples, 0.5) * 1000, 3),
+        'p95_ms': round(percentile(samples, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 3),
+        'max_ms': round(samples[-1] * 1000, 3),
+    }
+
+
+# Заводит пользователей и профили с файлами пропертей
+async def prepare_data(users: int, profiles_per_user: int, properties_lines: int):
+    import cd2b_api
+    import cd2b_auth_core
+    import cd2b_db_core
+    from cd2b_auth_core import User
+
+    properties = 'server.port=8080\n' + ''.join(f'app.key{i}=value{i}\n' for i in range(properties_lines))
+    for index in range(users):
+        user = await cd2b_auth_core.create_user(User(user_login(index), PASSWORD))
+        names = [profile_name(i) for i in range(profiles_per_user)] + [bandr_profile_name(index)]
+        for port, name in enumerate(names, start=9000):
+            profile = await cd2b_api.create_profile(name, GITHUB_URL, port, workdir=user.workdir)
+            properties_dir = os.path.join(user.workdir, 'PROPERTIES', profile.docker_image_name)
+            os.makedirs(properties_dir, exist_ok=True)
+            with open(os.path.join(properties_dir, 'application.properties'), 'w') as file:
+                file.write(properties)
+    await cd2b_db_core.close_connections()
+
+
+# Режим сервера: готовит данные и запускает приложение с ручкой для задержки event loop
+def serve(args):
+    import uvicorn
+
+    with fakes.installed(args.workdir, build_lines=args.build_lines):
+        asyncio.run(prepare_data(args.users, args.profiles_per_user, args.properties_lines))
+
+        import main
+
+        monitor = LoopLagMonitor()
+
+        async def loop_lag(reset: bool = False):
+            if reset:
+                monitor.reset()
+                return {}
+            return monitor.summary()
+
+        main.app.add_api_route('/_load/loop_lag', loop_lag, methods=['GET'])
+        uvicorn.Server(uvicorn.Config(main.app, host='127.0.0.1', port=args.port, log_level='warning')).run()
+
+
+class Stats:
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+        self.error_samples: dict[str, str] = {}
+
+    def record(self, operation: str, latency: float, error: Optional[str] = None):
+        self.latencies.setdefault(operation, []).append(latency)
+        if error is not None:
+            self.errors[operation] = self.errors.get(operation, 0) + 1
+            self.error_samples.setdefault(operation, error)
+
+    def report(self, duration: float) -> dict:
+        operations = {}
+        for operation, latencies in sorted(self.latencies.items()):
+            errors = self.errors.get(operation, 0)
+            operations[operation] = {
+                'requests': len(latencies),
+                'errors': errors,
+                'error_rate': round(errors / len(latencies), 4),
+                'throughput_per_s': round(len(latencies) / duration, 2),
+                **latency_summary(latencies),
+            }
+            if operation in self.error_samples:
+                operations[operation]['first_error'] = self.error_samples[operation]
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        total_errors = sum(self.errors.values())
+        return {
+            'requests': total,
+            'errors': total_errors,
+            'error_rate': round(total_errors / total, 4) if total else 0,
+            'throughput_per_s': round(total / duration, 2),
+            'operations': operations,
+        }
+
+
+class SimulatedUser:
+    def __init__(self, index: int, base_url: str, client: httpx.AsyncClient, args, stats: Stats):
+        self.index = index
+        self.base_url = base_url
+        self.client = client
+        self.args = args
+        self.stats = stats
+        self.random = random.Random(args.seed + index)
+        self.token = ''
+
+    async def login(self):
+        response = await self.client.post('/login', json={'login': user_login(self.index), 'password': PASSWORD})
+        response.raise_for_status()
+        self.token = response.json()['access_token']
+
+    async def post(self, path: str, **params):
+        response = await self.client.post(path, params=params, headers={'Authorization': f'Bearer {self.token}'})
+        if response.status_code != 200:
+            raise RuntimeError(f'{path}: {response.status_code} {response.text[:200]}')
+
+    def some_profile(self) -> str:
+        return profile_name(self.random.randrange(self.args.profiles_per_user))
+
+    async def check_profile(self):
+        await self.post('/check_profile', profile_name=self.some_profile())
+
+    async def all_profiles(self):
+        await self.post('/all_profiles')
+
+    async def set_port(self):
+        await self.post('/set_port', profile_name=self.some_profile(), port=self.random.randrange(10000, 60000))
+
+    async def change_properties_field(self):
+        await self.post(
+            '/change_properties_field',
+            profile_name=self.some_profile(),
+            key=f'app.key{self.random.randrange(self.args.properties_lines)}',
+            value=str(self.random.random())
+        )
+
+    # websocket-сессия bandr до закрытия сервером, затем остановка контейнера
+    async def bandr(self):
+        bandr_profile = bandr_profile_name(self.index)
+        url = (f"{self.base_url.replace('http', 'ws', 1)}/bandr"
+               f"?profile_name={bandr_profile}&token={self.token}")
+        async with websockets.connect(url, max_size=None) as websocket:
+            try:
+                async for _ in websocket:
+                    pass
+            except websockets.ConnectionClosedError:
+                pass
+            close_code, close_reason = websocket.close_code, websocket.close_reason
+        await self.post('/stop', profile_name=bandr_profile)
+        if close_code != 1000:
+            raise RuntimeError(f'/bandr closed with {close_code}: {close_reason}')
+
+    async def run(self, deadline: float, mix: dict[str, float]):
+        operations, weights = list(mix), list(mix.values())
+        while time.monotonic() < deadline:
+            operation = self.random.choices(operations, weights)[0]
+            start = time.perf_counter()
+            error = None
+            try:
+                await getattr(self, operation)()
+            except Exception as e:
+                error = f'{type(e).__name__}: {e}'
+            self.stats.record(operation, time.perf_counter() - start, error)
+            if self.args.think_ms:
+                await asyncio.sleep(self.random.uniform(0, 2 * self.args.think_ms) / 1000)
+
+
+async def drive(base_url: str, args) -> dict:
+    stats = Stats()
+    limits = httpx.Limits(max_connections=args.users, max_keepalive_connections=args.users)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        users = [SimulatedUser(index, base_url, client, args, stats) for index in range(args.users)]
+        await asyncio.gather(*[user.login() for user in users])
+        await client.get('/_load/loop_lag', params={'reset': True})
+
+        started = time.monotonic()
+        deadline = started + args.duration
+        await asyncio.gather(*[user.run(deadline, args.mix) for user in users])
+        duration = time.monotonic() - started
+
+        report = stats.report(duration)
+        report['server_loop_lag'] = (await client.get('/_load/loop_lag')).json()
+    report['duration_s'] = round(duration, 3)
+    return report
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def wait_ready(base_url: str, server: subprocess.Popen):
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise RuntimeError(f'server exited with code {server.returncode}')
+            try:
+                if (await client.get('/metrics')).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise TimeoutError('server did not start')
+
+
+# Поднимает сервер, прогоняет нагрузку и возвращает отчет
+def run(args) -> dict:
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    with tempfile.TemporaryDirectory(prefix='cd2b-load-') as workdir:
+        server = subprocess.Popen(
+            [
+                sys.executable, '-m', 'benchmarks.load', '--serve',
+                '--port', str(port),
+                '--workdir', workdir,
+                '--users', str(args.users),
+                '--profiles-per-user', str(args.profiles_per_user),
+                '--properties-lines', str(args.properties_lines),
+                '--build-lines', str(args.build_lines),
+            ],
+            cwd=fakes.ROOT,
+            # вывод сборок сервер печатает в stdout, в отчет он не нужен
+            stdout=subprocess.DEVNULL
+        )
+        try:
+            async def scenario():
+                await wait_ready(base_url, server)
+                return await drive(base_url, args)
+
+            report = asyncio.run(scenario())
+        finally:
+            server.terminate()
+            try:
+                server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+    report['config'] = {
+        'users': args.users,
+        'duration_s': args.duration,
+        'profiles_per_user': args.profiles_per_user,
+        'properties_lines': args.properties_lines,
+        'build_lines': args.build_lines,
+        'think_ms': args.think_ms,
+        'mix': args.mix,
+    }
+    return report
+
+
+def parse_mix(value: str) -> dict[str, float]:
+    mix = {}
+    for part in value.split(','):
+        operation, _, weight = part.partition('=')
+        operation = operation.strip()
+        if operation not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f'unknown operation {operation!r}, expected one of {list(DEFAULT_MIX)}')
+        mix[operation] = float(weight or 1)
+    return mix
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='cd2b load generator')
+    parser.add_argument('--users', type=int, default=20, help='concurrent simulated users')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of load')
+    parser.add_argument('--mix', type=parse_mix, default=dict(DEFAULT_MIX),
+                        help='operation weights, e.g. check_profile=40,all_profiles=20,bandr=5')
+    parser.add_argument('--profiles-per-user', type=int, default=5)
+    parser.add_argument('--properties-lines', type=int, default=200)
+    parser.add_argument('--build-lines', type=int, default=200, help='lines of output of a fake docker build')
+    parser.add_argument('--think-ms', type=float, default=0, help='mean pause between requests of one user')
+    parser.add_argument('--timeout', type=float, default=60, help='request timeout, seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write JSON report to this file')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    if args.serve:
+        serve(args)
+        return 0
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+    return 0 if report['errors'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
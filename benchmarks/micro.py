@@ -0,0 +1,352 @@
+"""Микро-бенчмарки горячих путей cd2b.
+
+Работают офлайн: docker и git подменяются фейками (см. benchmarks/fakes.py),
+все данные создаются во временной папке.
+
+    python -m benchmarks.micro --output results.json
+    python -m benchmarks.micro --quick
+    python -m benchmarks.micro --compare old.json new.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Awaitable, Callable
+
+from benchmarks import fakes
+
+# метрики, по которым сравниваются результаты: для ops_per_s больше - лучше, для остальных - меньше
+COMPARED_METRICS = ('ops_per_s', 'p50_us', 'p95_us')
+# изменение больше этого (в процентах) помечается в сравнении
+REGRESSION_THRESHOLD = 10
+
+GRADLE_OUTPUT_SCRIPT = r'''
+import sys
+for i in range({lines}):
+    if i % 50 == 0:
+        sys.stdout.write(f"<{{i % 100}}% EXECUTING [{{i}}ms]> :compileJava\r")
+    sys.stdout.write(f"> Task :module{{i % 40}}:compileJava UP-TO-DATE, took {{i % 997}}ms, warnings: none\n")
+'''
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    index = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(durations: list[float], total: float) -> dict:
+    durations = sorted(durations)
+    return {
+        'ops': len(durations),
+        'total_s': round(total, 6),
+        'ops_per_s': round(len(durations) / total, 2) if total else None,
+        'mean_us': round(sum(durations) / len(durations) * 1e6, 2),
+        'p50_us': round(percentile(durations, 0.5) * 1e6, 2),
+        'p95_us': round(percentile(durations, 0.95) * 1e6, 2),
+        'max_us': round(durations[-1] * 1e6, 2),
+    }
+
+
+# Выполняет operation repeat раз подряд, замеряя каждый вызов; before вызывается перед каждым замером
+async def measure(operation: Callable[[], Awaitable],
+                  repeat: int,
+                  before: Callable[[], None] = lambda: None) -> dict:
+    durations = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        before()
+        start = time.perf_counter()
+        await operation()
+        durations.append(time.perf_counter() - start)
+    return summarize(durations, time.perf_counter() - started)
+
+
+# То же, но concurrency корутин одновременно, каждая делает repeat вызовов
+async def measure_concurrent(operation: Callable[[], Awaitable], repeat: int, concurrency: int) -> dict:
+    durations = []
+
+    async def worker():
+        for _ in range(repeat):
+            start = time.perf_counter()
+            await operation()
+            durations.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return summarize(durations, time.perf_counter() - started)
+
+
+async def insert_profiles(workdir: str, count: int):
+    import cd2b_db_core
+
+    os.makedirs(workdir, exist_ok=True)
+    await cd2b_db_core.execute_many(
+        'create-profile.sql',
+        workdir,
+        ((f'profile_{i}', f'https://github.com/bench/repo{i % 10}.git', 8000 + i) for i in range(count))
+    )
+
+
+async def bench_execute_queries(sizes: dict) -> dict:
+    import cd2b_db_core
+
+    workdir = os.path.abspath('bench_queries')
+    await insert_profiles(workdir, 100)
+    counter = iter(range(10 ** 9))
+
+    async def get_profile():
+        await cd2b_db_core.execute_queries('get_profile.sql', workdir, f'profile_{next(counter) % 100}')
+
+    return {
+        'execute_queries.get_profile.sequential': await measure(get_profile, sizes['queries']),
+        'execute_queries.get_profile.concurrent_16': await measure_concurrent(get_profile, sizes['queries'] // 16, 16),
+    }
+
+
+async def bench_auth_validation(sizes: dict) -> dict:
+    import cd2b_auth_core
+    from cd2b_auth_core import User
+
+    user = User('BENCH_USER', 'bench-password')
+    await cd2b_auth_core.create_user(user)
+
+    async def validate():
+        await cd2b_auth_core.auth_validation(User('BENCH_USER', 'bench-password'))
+
+    return {
+        'auth_validation.cold': await measure(
+            validate, sizes['auth'], before=lambda: cd2b_auth_core.invalidate_user('BENCH_USER')
+        ),
+        'auth_validation.cached': await measure(validate, sizes['auth']),
+    }
+
+
+async def bench_get_all_profiles(sizes: dict) -> dict:
+    import cd2b_api
+
+    results = {}
+    for count in sizes['profiles']:
+        workdir = os.path.abspath(f'bench_profiles_{count}')
+        await insert_profiles(workdir, count)
+
+        async def get_all():
+            await cd2b_api.get_all_profiles(workdir)
+
+        results[f'get_all_profiles.{count}.cold'] = await measure(get_all, sizes['profiles_repeat'],
+                                                                  before=cd2b_api.profiles.clear)
+        results[f'get_all_profiles.{count}.cached'] = await measure(get_all, sizes['profiles_repeat'])
+    return results
+
+
+async def bench_update_property(sizes: dict) -> dict:
+    import cd2b_api
+
+    results = {}
+    for lines in sizes['properties_lines']:
+        workdir = os.path.abspath(f'bench_properties_{lines}')
+        profile = cd2b_api.Profile('props', 'https://github.com/bench/repo.git', 8080, workdir)
+        properties_dir = os.path.join(workdir, 'PROPERTIES', profile.docker_image_name)
+        os.makedirs(properties_dir, exist_ok=True)
+        with open(os.path.join(properties_dir, 'application.properties'), 'w') as file:
+            file.write('server.port=8080\n')
+            file.writelines(f'app.setting.key{i}=value{i}\n' for i in range(lines))
+
+        counter = iter(range(10 ** 9))
+
+        async def update_one():
+            await profile.update_property(f'app.setting.key{lines // 2}', f'changed{next(counter)}')
+
+        async def update_batch():
+            value = next(counter)
+            await profile.update_properties({f'app.setting.key{i}': f'batch{value}' for i in range(100)})
+
+        results[f'update_property.{lines}_lines'] = await measure(update_one, sizes['properties_repeat'])
+        results[f'update_properties.{lines}_lines.batch_100'] = await measure(update_batch,
+                                                                              sizes['properties_repeat'])
+    return results
+
+
+async def bench_is_valid_properties_file(sizes: dict) -> dict:
+    import utils
+
+    lines = sizes['validation_lines']
+    content = '\n'.join(
+        f'# comment {i}' if i % 10 == 0 else f'app.setting.key{i}=value{i}'
+        for i in range(lines)
+    )
+
+    async def validate():
+        assert await utils.is_valid_properties_file(content)
+
+    return {f'is_valid_properties_file.{lines}_lines': await measure(validate, sizes['validation_repeat'])}
+
+
+class NullWebSocket:
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+
+    async def send_text(self, text: str):
+        self.frames += 1
+        self.bytes += len(text)
+
+    async def send_json(self, data):
+        await self.send_text(json.dumps(data))
+
+
+async def bench_process_writer(sizes: dict) -> dict:
+    import utils
+
+    lines = sizes['gradle_lines']
+    script = GRADLE_OUTPUT_SCRIPT.format(lines=lines)
+    websocket = NullWebSocket()
+
+    async def write():
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, '-c', script,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        # при CD2B_PRINT_BUILD_OUTPUT PrintLogConsumer пишет каждую строку в stdout, в отчет она попасть не должна
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            await utils.process_writer(process, websocket)
+
+    result = await measure(write, sizes['gradle_repeat'])
+    result['lines_per_s'] = round(lines * result['ops'] / result['total_s'], 2)
+    result['frames_per_run'] = websocket.frames // result['ops']
+    result['frame_bytes_per_run'] = websocket.bytes // result['ops']
+    return {f'process_writer.gradle_{lines}_lines': result}
+
+
+BENCHMARKS = (
+    bench_execute_queries,
+    bench_auth_validation,
+    bench_get_all_profiles,
+    bench_update_property,
+    bench_is_valid_properties_file,
+    bench_process_writer,
+)
+
+SIZES = {
+    'queries': 4000,
+    'auth': 2000,
+    'profiles': (10, 100, 1000),
+    'profiles_repeat': 50,
+    'properties_lines': (10_000, 100_000),
+    'properties_repeat': 20,
+    'validation_lines': 100_000,
+    'validation_repeat': 10,
+    'gradle_lines': 200_000,
+    'gradle_repeat': 3,
+}
+
+QUICK_SIZES = {
+    'queries': 160,
+    'auth': 20,
+    'profiles': (10, 100),
+    'profiles_repeat': 3,
+    'properties_lines': (1000,),
+    'properties_repeat': 3,
+    'validation_lines': 1000,
+    'validation_repeat': 2,
+    'gradle_lines': 2000,
+    'gradle_repeat': 1,
+}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=fakes.ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+# Запускает бенчмарки в временной папке с фейковыми docker и git, возвращает отчет
+def run(sizes: dict, selected: tuple[str, ...] = ()) -> dict:
+    # коммит берем до подмены git в PATH
+    commit = git_commit()
+    with tempfile.TemporaryDirectory(prefix='cd2b-bench-') as workdir, fakes.installed(workdir):
+        results = asyncio.run(run_benchmarks(sizes, selected))
+    return {
+        'meta': {
+            'commit': commit,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        },
+        'results': results,
+    }
+
+
+async def run_benchmarks(sizes: dict, selected: tuple[str, ...]) -> dict:
+    import cd2b_db_core
+
+    results = {}
+    try:
+        for benchmark in BENCHMARKS:
+            name = benchmark.__name__.removeprefix('bench_')
+            if selected and name not in selected:
+                continue
+            print(f'running {name}...', file=sys.stderr)
+            results.update(await benchmark(sizes))
+    finally:
+        await cd2b_db_core.close_connections()
+    return results
+
+
+# Сравнивает два отчета и печатает изменение метрик; возвращает число регрессий
+def compare(base: dict, new: dict, threshold: float = REGRESSION_THRESHOLD) -> int:
+    regressions = 0
+    for name, result in new['results'].items():
+        base_result = base['results'].get(name)
+        if base_result is None:
+            continue
+        for metric in COMPARED_METRICS:
+            old_value, new_value = base_result.get(metric), result.get(metric)
+            if not old_value or new_value is None:
+                continue
+            change = (new_value - old_value) / old_value * 100
+            worse = -change if metric == 'ops_per_s' else change
+            mark = ''
+            if worse > threshold:
+                mark = '  REGRESSION'
+                regressions += 1
+            elif worse < -threshold:
+                mark = '  improvement'
+            print(f'{name:60} {metric:10} {old_value:>14} -> {new_value:>14} ({change:+.1f}%){mark}')
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='cd2b micro-benchmarks')
+    parser.add_argument('--output', help='write JSON results to this file')
+    parser.add_argument('--quick', action='store_true', help='small sizes, for a smoke run')
+    parser.add_argument('--only', action='append', default=[],
+                        help='run only these benchmarks, e.g. --only auth_validation')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help='compare two result files')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as base_file, open(args.compare[1]) as new_file:
+            return 1 if compare(json.load(base_file), json.load(new_file)) else 0
+
+    report = run(QUICK_SIZES if args.quick else SIZES, tuple(args.only))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,17 +1,29 @@
 import asyncio
+import hashlib
 import os
-import re
 import shutil
-import subprocess
-from typing import Optional
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Callable, Optional, Sequence
 
-import git
-import requests
+import httpx
 from fastapi import WebSocket
 
+import cd2b_build_logs
+import cd2b_containers
 import cd2b_db_core
+import cd2b_git
+import cd2b_http
+import cd2b_process
+import cd2b_properties
+import cd2b_runtime
 import utils
 
+# сколько объектов Profile держать в памяти (identity map)
+MAX_CACHED_PROFILES = int(os.environ.get('CD2B_MAX_CACHED_PROFILES', 4096))
+# сколько профилей одновременно удалять в remove_profiles (docker stop/rmi, удаление папок)
+REMOVE_CONCURRENCY = int(os.environ.get('CD2B_REMOVE_CONCURRENCY', 8))
+
 
 class Profile:
     def __init__(self,
@@ -30,9 +42,6 @@ class Profile:
         self.repo_name = self.github.split('/')[-1].replace('.git', '')
         self.docker_image_name = f'cd2b_{self.repo_name}_{self._name}'
 
-        # создаем папку с пропертями если ее не существует
-        utils.create_dirs(self.__property_folder())
-
     # папка содержащая проперти приложения
     def __property_folder(self) -> str:
         return utils.build_path(
@@ -59,17 +68,27 @@ class Profile:
             f'repos/{self.docker_image_name}/{self.repo_name}'
         )
 
+    # путь к проперти, скопированным в репо при сборке
+    def __applied_property_file_path(self) -> str:
+        return f'{self.__repo_path_lvl2()}/src/main/resources/application.properties'
+
     def __logs_dir(self) -> str:
         return utils.build_path(
             self.workdir,
             f'logs/{self.docker_image_name}/'
         )
 
+    # файл с полным логом последней сборки
+    def build_log_path(self) -> str:
+        return os.path.join(self.__logs_dir(), 'build.log')
+
     async def __post_proc(self):
         await self.__can_create()
+        # создаем папку с пропертями если ее не существует
+        utils.create_dirs(self.__property_folder())
         # сохраняем профиль в бдшке
         await self.save()
-        await self.__clone_git_()
+        await self.__sync_git_()
         utils.create_dirs(self.__logs_dir())
 
     # метод проверяющий профиль на валидность
@@ -77,89 +96,149 @@ class Profile:
         self_dict_form = await self.to_dict()
         await cd2b_db_core.check_profile_data(self_dict_form)
 
-    # создаем папку с гитхаб-репо и клонируем его
-    async def __clone_git_(self):
-        repo_path = self.__repo_path_lvl2()
-
-        if os.path.exists(repo_path):
-            shutil.rmtree(repo_path)
-
-        git.Repo.clone_from(self.github, repo_path)
+    # клонирует гитхаб-репо или инкрементально обновляет уже склонированный
+    async def __sync_git_(self):
+        await cd2b_git.sync_repository(
+            self.github,
+            self.__repo_path_lvl2(),
+            mirror_cache=cd2b_git.mirrors
+        )
 
     async def has_properties(self):
         return os.path.exists(self.__property_file_path())
 
+    # тег образа, однозначно определяемый коммитом и примененными пропертями:
+    # <коммит>-<хэш application.properties>
+    async def image_tag(self) -> str:
+        commit = await cd2b_git.head_commit(self.__repo_path_lvl2())
+        properties_hash = hashlib.sha256()
+        applied_properties = self.__applied_property_file_path()
+        if os.path.exists(applied_properties):
+            with open(applied_properties, 'rb') as file:
+                properties_hash.update(file.read())
+        return f'{commit[:12]}-{properties_hash.hexdigest()[:12]}'
+
+    # получатели вывода сборки: консоль (если включена), вебсокет (если есть) и дополнительные consumers
+    @staticmethod
+    def __log_consumers(websocket: Optional['WebSocket'],
+                        consumers: Sequence[cd2b_process.LogConsumer]) -> list[cd2b_process.LogConsumer]:
+        result = list(consumers)
+        if cd2b_process.PRINT_BUILD_OUTPUT:
+            result.append(cd2b_process.PrintLogConsumer())
+        if websocket is not None:
+            result.append(cd2b_process.WebSocketLogConsumer(websocket))
+        return result
+
     # build docker container with name self.docker_image_name
-    async def build(self, websocket: Optional['WebSocket'] = None):
-        await self.remove_image()
-        await self.__clone_git_()
+    # если образ с тем же коммитом и пропертями уже собран - сборка пропускается
+    # on_stage вызывается при смене этапа: cloning, building
+    # если сборка упала - выбрасывает cd2b_process.ProcessFailedError
+    # возвращает тег собранного (или уже существовавшего) образа
+    async def build(self,
+                    websocket: Optional['WebSocket'] = None,
+                    on_stage: Optional[Callable[[str], None]] = None,
+                    consumers: Sequence[cd2b_process.LogConsumer] = ()) -> str:
+        if on_stage is not None:
+            on_stage('cloning')
+        await self.__sync_git_()
         await self.__apply_properties()
-        build_command = (f'docker build --build-arg HOST_USER_UID=$(id -u) --build-arg HOST_USER_GID=$(id -g) '
-                         f'-t {self.docker_image_name} .')
-
-        full_command = f'cd {self.__repo_path_lvl2()}; {build_command}'
-        print(full_command)
-
-        process = await asyncio.create_subprocess_shell(
-            full_command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            shell=True
+        tag = await self.image_tag()
+        tagged_image = f'{self.docker_image_name}:{tag}'
+
+        if await cd2b_runtime.runtime.image_exists(tagged_image):
+            message = f'Image {tagged_image} is up to date, skipping build.'
+            if websocket is not None:
+                await websocket.send_json({"message": message, "is_new_line": True})
+            for consumer in consumers:
+                await consumer.write(cd2b_process.LogLine(cd2b_process.STDOUT, message, True, time.time()))
+            print(message)
+            # latest должен указывать на актуальный образ, его запускает run
+            await cd2b_runtime.runtime.tag(tagged_image, self.docker_image_name)
+            return tag
+
+        if on_stage is not None:
+            on_stage('building')
+        await cd2b_runtime.runtime.build(
+            self.__repo_path_lvl2(),
+            [tagged_image, self.docker_image_name],
+            {'HOST_USER_UID': str(os.getuid()), 'HOST_USER_GID': str(os.getgid())},
+            self.__log_consumers(websocket, consumers)
         )
-
-        await utils.process_writer(process, websocket)
-
-    # удаляет образ контейнера профиля
-    async def remove_image(self):
+        return tag
+
+    # удаляет старые теги образа профиля, кроме current_tag (тега запущенного образа) и latest
+    async def prune_images(self, current_tag: str):
+        tags = await cd2b_runtime.runtime.image_tags(self.docker_image_name)
+        stale = [
+            f'{self.docker_image_name}:{tag}'
+            for tag in tags
+            if tag not in (current_tag, 'latest')
+        ]
+        if stale:
+            await cd2b_runtime.runtime.remove_images(stale)
+
+    # удаляет образ контейнера профиля (все его теги), возвращает True если образ удален
+    async def remove_image(self) -> bool:
         await self.stop_container()
-        command = f"docker rmi {self.docker_image_name}"
-        process = await asyncio.create_subprocess_shell(
-            command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        await process.communicate()
+        tags = await cd2b_runtime.runtime.image_tags(self.docker_image_name)
+        images = [f'{self.docker_image_name}:{tag}' for tag in tags] or [self.docker_image_name]
+        removed = await cd2b_runtime.runtime.remove_images(images)
+        cd2b_containers.container_changed(self.docker_image_name)
+        return removed
 
     # запускает профиль с заданной проброской портов, то есть external_port - внешний порт приложения,
     # по которому оно будет доступно
     # по вебсокету отправляются логи из build
-    async def run(self, external_port: int = -1, rebuild: bool = True, websocket: Optional['WebSocket'] = None):
+    # on_stage вызывается при смене этапа: cloning, building, starting
+    async def run(self,
+                  external_port: int = -1,
+                  rebuild: bool = True,
+                  websocket: Optional['WebSocket'] = None,
+                  on_stage: Optional[Callable[[str], None]] = None,
+                  consumers: Sequence[cd2b_process.LogConsumer] = ()):
         _external_port = external_port
         if external_port == -1:
             _external_port = self.port
 
         await cd2b_db_core.is_valid_port(_external_port)
 
+        image = self.docker_image_name
         if rebuild:
-            await self.build(websocket)
-
-        run_command = f"""\
-docker run \
--p {_external_port}:{self.port} \
---rm \
--v {self.__logs_dir()}:/usr/src/app/logs \
---name {self.docker_image_name} \
--d \
-{self.docker_image_name} \
-"""
-
-        # TODO: do logging
-        print('run command:')
-        print(run_command)
-        process = await asyncio.create_subprocess_shell(run_command)
-        await process.communicate()
+            # запускаем именно собранный тег: latest мог успеть перетегировать другой билд
+            tag = await self.build(websocket, on_stage, consumers)
+            image = f'{self.docker_image_name}:{tag}'
+
+        if on_stage is not None:
+            on_stage('starting')
+
+        started = await cd2b_runtime.runtime.run(
+            image,
+            self.docker_image_name,
+            ports={self.port: _external_port},
+            # Engine API принимает только абсолютные пути папок хоста
+            volumes={os.path.abspath(self.__logs_dir()): '/usr/src/app/logs'}
+        )
+        cd2b_containers.container_changed(
+            self.docker_image_name,
+            running=True if started else None
+        )
+
+        # старые образы удаляем только когда новый контейнер уже поднят
+        if started and rebuild:
+            await self.prune_images(tag)
 
     async def properties_content(self) -> Optional['str']:
         if not await self.has_properties():
             return None
-        file_path = self.__property_file_path()
-        with open(file_path, 'r') as file:
-            content = file.read()
-        return content
+        properties = await cd2b_properties.cache.load(self.__property_file_path())
+        return properties.render()
 
     # устанавливает профилю файл пропертей
     async def load_properties(self, properties_file_url: str):
-        response = requests.get(properties_file_url)
+        try:
+            response = await cd2b_http.client().get(properties_file_url)
+        except httpx.HTTPError:
+            raise ConnectionError(f"Can't load property file by url {properties_file_url}")
         if response.status_code != 200:
             raise ConnectionError(f"Can't load property file by url {properties_file_url}")
 
@@ -167,63 +246,53 @@ docker run \
         if not is_valid_format:
             raise cd2b_db_core.InvalidPropertiesFormat()
 
-        property_path = self.__property_file_path()
-        with open(property_path, 'wb') as file:
-            file.write(response.content)
+        utils.create_dirs(self.__property_folder())
+        await cd2b_properties.cache.write(self.__property_file_path(), response.content)
 
-    # выгружает профиль проперти в папку с репо
+    # выгружает проперти профиля в папку с репо; вызывается только при сборке
     async def __apply_properties(self):
-        await self.update_property(
-            'server.port',
-            self.port,
-            is_port=True
-        )
-        source_property = self.__property_file_path()
+        if not await self.has_properties():
+            return
+        await cd2b_properties.cache.update(self.__property_file_path(), {'server.port': self.port})
         utils.create_dirs(f'{self.__repo_path_lvl2()}/src/main/resources/')
-        destination_property = f'{self.__repo_path_lvl2()}/src/main/resources/application.properties'
-        shutil.copy2(source_property, destination_property)
+        await asyncio.to_thread(
+            shutil.copy2,
+            self.__property_file_path(),
+            self.__applied_property_file_path()
+        )
 
     # устанавливает порт
     async def set_port(self, new_port: int | str):
         if not await cd2b_db_core.is_valid_port(new_port):
             raise cd2b_db_core.InvalidPortError(new_port)
-        self.port = int(new_port)
-        await self.save()
-        await self.__apply_properties()
-
-    # меняет properties
-    async def update_property(self, property_name: str, new_value, is_port: bool = False):
-        property_name = property_name.strip()
-        new_value = str(new_value).strip()
-
-        if not re.match(r'^[a-zA-Z0-9._-]+$', property_name.strip()):
-            raise ValueError('Incorrect key format.')
-
-        properties_path = self.__property_file_path()
-        encoding = 'utf-8'
-        with open(properties_path, 'r', encoding=encoding) as file:
-            lines = file.readlines()
-
-        found = False
-        for i, line in enumerate(lines):
-            if line.startswith(property_name + '='):
-                lines[i] = f'{property_name}={new_value}\n'
-                found = True
-                break
-
-        if not found:
-            lines.append(f'{property_name}={new_value}\n')
-
-        with open(properties_path, 'w', encoding=encoding) as file:
-            file.writelines(lines)
-
-        # запрещаем вручную менять порт
-        if not is_port:
-            await self.set_port(self.port)
-
-    # сохраняет профиль в бдшке
-    async def save(self):
-        await cd2b_db_core.save_profile(await self.to_dict(), self.workdir)
+        await self.save(port=int(new_port))
+        if await self.has_properties():
+            await cd2b_properties.cache.update(self.__property_file_path(), {'server.port': self.port})
+
+    # меняет несколько полей properties одной атомарной записью файла;
+    # server.port всегда равен порту профиля, менять его нужно через set_port
+    async def update_properties(self, values: dict[str, object]):
+        new_values = {
+            cd2b_properties.validate_key(key): cd2b_properties.validate_value(value)
+            for key, value in values.items()
+        }
+        new_values['server.port'] = self.port
+        if not await self.has_properties():
+            raise FileNotFoundError(f"Profile '{self._name}' has no properties file.")
+        await cd2b_properties.cache.update(self.__property_file_path(), new_values)
+
+    # меняет одно поле properties
+    async def update_property(self, property_name: str, new_value):
+        await self.update_properties({property_name: new_value})
+
+    # сохраняет профиль в бдшке. changes - новые значения полей (например port=8081):
+    # объект общий для всех запросов (см. ProfileCache), поэтому поля меняются только после
+    # успешного сохранения, иначе кэш разойдется с БД
+    async def save(self, **changes):
+        await cd2b_db_core.save_profile({**await self.to_dict(), **changes}, self.workdir)
+        for field, value in changes.items():
+            setattr(self, field, value)
+        profiles.put(self)
 
     @property
     async def name(self) -> str:
@@ -247,51 +316,78 @@ docker run \
         )
 
     # проверяет, запущен ли контейнер данного профиля
-    # TODO: асинхронность
     async def is_running(self):
-        command = f"docker ps | grep '{self.docker_image_name}'"
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        output, error = process.communicate()
-        if process.returncode == 0:
-            return output.decode('utf-8') is not None
-        return False
+        return await cd2b_containers.is_running(self.docker_image_name)
+
+    # вывод запущенного контейнера профиля пачками строк, см. cd2b_runtime.ContainerRuntime.container_logs
+    def container_logs(self,
+                       follow: bool = False,
+                       since: Optional[str] = None,
+                       until: Optional[str] = None,
+                       tail: Optional[int] = None,
+                       timestamps: bool = False) -> AsyncIterator[list[cd2b_process.LogLine]]:
+        return cd2b_runtime.runtime.container_logs(
+            self.docker_image_name,
+            follow=follow,
+            since=since,
+            until=until,
+            tail=tail,
+            timestamps=timestamps
+        )
 
     # Возвращает хэш последнего коммита
     async def last_commit(self):
-        command = ["git", "rev-parse", "HEAD"]
-        result = subprocess.run(command, stdout=subprocess.PIPE, text=True, cwd=self.__repo_path_lvl2())
-        return result.stdout.strip()
+        try:
+            return await cd2b_git.head_commit(self.__repo_path_lvl2())
+        except (cd2b_git.GitError, OSError):
+            return ''
 
     # останавливает контейнер профиля
     async def stop_container(self):
         if not await self.is_running():
             return
-        command = f"docker stop {self.docker_image_name}"
-        process = await asyncio.create_subprocess_shell(
-            command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+        stopped = await cd2b_runtime.runtime.stop(self.docker_image_name)
+        cd2b_containers.container_changed(
+            self.docker_image_name,
+            running=False if stopped else None
         )
-        await process.communicate()
 
     # Перезапускает контейнер, если он запущен; запускает, если выключен
-    async def rerun(self, external_port: int = -1, rebuild: bool = True, websocket: Optional['WebSocket'] = None):
+    async def rerun(self,
+                    external_port: int = -1,
+                    rebuild: bool = True,
+                    websocket: Optional['WebSocket'] = None,
+                    on_stage: Optional[Callable[[str], None]] = None,
+                    consumers: Sequence[cd2b_process.LogConsumer] = ()):
         await self.stop_container()
-        await self.run(external_port=external_port, rebuild=rebuild, websocket=websocket)
+        await self.run(
+            external_port=external_port,
+            rebuild=rebuild,
+            websocket=websocket,
+            on_stage=on_stage,
+            consumers=consumers
+        )
 
     # удаляет профиль
     async def remove(self):
         await cd2b_db_core.remove_profile(self.workdir, self._name)
-        await self.remove_image()
-
-        # удаляем репозиторий
-        repo_path = self.__repo_path_lvl1()
-        if os.path.exists(repo_path):
-            shutil.rmtree(repo_path)
-        # удаляем проперти
-        properties_path = self.__property_folder()
-        if os.path.exists(properties_path):
-            shutil.rmtree(properties_path)
+        profiles.remove(self.workdir, self._name)
+        await self.remove_files()
+
+    # удаляет образ, репозиторий и проперти уже удаленного из БД профиля.
+    # Возвращает True, если образ был удален
+    async def remove_files(self) -> bool:
+        image_removed = await self.remove_image()
+        cd2b_properties.cache.invalidate(self.__property_file_path())
+        cd2b_build_logs.hub.remove((self.workdir, self._name))
+        # удаление больших деревьев не должно блокировать event loop
+        await asyncio.to_thread(self.__remove_dirs)
+        return image_removed
+
+    def __remove_dirs(self):
+        for path in (self.__repo_path_lvl1(), self.__property_folder()):
+            if os.path.exists(path):
+                shutil.rmtree(path)
 
     def __str__(self):
         return f"Profile(name={self._name}, github={self.github}, port={self.port})"
@@ -300,26 +396,82 @@ docker run \
         return self.__str__()
 
 
-async def get_all_profiles(workdir: str) -> list[Profile]:
-    all_profiles_dicts = await cd2b_db_core.select_all_profiles(workdir)
+class ProfileCache:
+    """Identity map объектов Profile с ключом (workdir, name), вытесняет давно не использованные.
+
+    Заполняется при чтении профилей из БД и обновляется при save и remove,
+    поэтому повторные запросы профиля не ходят ни в БД, ни в файловую систему.
+    """
+
+    def __init__(self, max_size: int = MAX_CACHED_PROFILES):
+        self.max_size = max_size
+        self._profiles: OrderedDict[tuple[str, str], Profile] = OrderedDict()
+
+    def get(self, workdir: str, name: str) -> Optional[Profile]:
+        profile = self._profiles.get((workdir, name))
+        if profile is not None:
+            self._profiles.move_to_end((workdir, name))
+        return profile
+
+    def put(self, profile: Profile):
+        key = (profile.workdir, profile._name)
+        self._profiles[key] = profile
+        self._profiles.move_to_end(key)
+        while len(self._profiles) > self.max_size:
+            self._profiles.popitem(last=False)
+
+    def remove(self, workdir: str, name: str):
+        self._profiles.pop((workdir, name), None)
+
+    # забывает все профили рабочей директории, например после удаления таблицы профилей
+    def remove_workdir(self, workdir: str):
+        for key in [key for key in self._profiles if key[0] == workdir]:
+            del self._profiles[key]
+
+    def clear(self):
+        self._profiles.clear()
+
+
+profiles = ProfileCache()
+
+
+# Возвращает закэшированный объект профиля, если он соответствует записи из БД, иначе создает новый
+async def _profile_from_row(workdir: str, profile_dict: dict) -> Profile:
+    profile = profiles.get(workdir, profile_dict['name'])
+    if profile is None or profile.github != profile_dict['github'] or profile.port != profile_dict['port']:
+        profile = await Profile.from_dict(profile_dict, post_proc=False, workdir=workdir)
+        profiles.put(profile)
+    return profile
+
+
+async def _profiles_from_rows(workdir: str, rows) -> list[Profile]:
     result: list[Profile] = []
-    for dict_profile in all_profiles_dicts:
-        # TODO: do logging
-        print(f'getting profile {dict_profile}')
+    for dict_profile in rows:
         result.append(
-            await Profile.from_dict(
+            await _profile_from_row(
+                workdir,
                 {
                     'name': dict_profile[1],
                     'github': dict_profile[2],
                     'port': dict_profile[3],
-                },
-                post_proc=False,
-                workdir=workdir
+                }
             )
         )
     return result
 
 
+async def get_all_profiles(workdir: str) -> list[Profile]:
+    return await _profiles_from_rows(workdir, await cd2b_db_core.select_all_profiles(workdir))
+
+
+# Страница профилей после курсора after_id (id профиля в БД).
+# Возвращает профили и курсор следующей страницы (None, если страница последняя)
+async def get_profiles_page(workdir: str, after_id: int = 0, limit: int = 100) -> tuple[list[Profile], Optional[int]]:
+    rows = await cd2b_db_core.select_profiles_page(workdir, after_id, limit)
+    next_cursor = rows[-1][0] if len(rows) == limit else None
+    return await _profiles_from_rows(workdir, rows), next_cursor
+
+
 async def create_profile(
         name: str,  # имя профиля
         github: str,  # github url
@@ -344,13 +496,54 @@ async def create_profile(
 
 
 async def get_by_name(workdir: str, name: str, post_proc: bool = False) -> Optional['Profile']:
+    if not post_proc:
+        profile = profiles.get(workdir, name)
+        if profile is not None:
+            return profile
+
     profile_dict = await cd2b_db_core.get_profile(workdir=workdir, name=name)
     if profile_dict == {}:
         return None
 
     # по дефолту post_proc=False так как уже точно известно что профиль валидный и есть папка с репо
-    return await Profile.from_dict(param=profile_dict, post_proc=post_proc, workdir=workdir)
+    profile = await Profile.from_dict(param=profile_dict, post_proc=post_proc, workdir=workdir)
+    profiles.put(profile)
+    return profile
+
+
+# Удаляет профили пачкой: строки из БД - одной транзакцией, затем контейнеры, образы
+# и папки - параллельно, не больше concurrency профилей одновременно.
+# Возвращает сводку по каждому профилю
+async def remove_profiles(workdir: str,
+                          profiles_to_remove: Sequence[Profile],
+                          concurrency: int = REMOVE_CONCURRENCY) -> list[dict]:
+    names = [profile._name for profile in profiles_to_remove]
+    await cd2b_db_core.remove_profiles(workdir, names)
+    for name in names:
+        profiles.remove(workdir, name)
+
+    async def remove_files(profile: Profile) -> dict:
+        result = {'name': profile._name, 'removed': True, 'image_removed': False, 'error': None}
+        try:
+            result['image_removed'] = await profile.remove_files()
+        except Exception as e:
+            result['error'] = str(e) or type(e).__name__
+        return result
+
+    return await utils.gather_bounded(
+        (remove_files(profile) for profile in profiles_to_remove),
+        concurrency
+    )
+
+
+# Дропает таблицу профилей рабочей директории вместе с закэшированными объектами профилей:
+# иначе профиль, созданный заново с тем же именем, отдавался бы из кэша старым объектом
+async def drop_profiles(workdir: str):
+    await cd2b_db_core.drop_profiles(workdir)
+    profiles.remove_workdir(workdir)
 
 
 async def remove_profile_by_name(workdir: str, name: str):
     await cd2b_db_core.remove_profile(workdir, name)
+    profiles.remove(workdir, name)
+    cd2b_build_logs.hub.remove((workdir, name))
@@ -1,3 +1,8 @@
+import os
+import secrets
+import sqlite3
+import time
+from collections import OrderedDict
 from typing import Optional
 
 from fastapi import HTTPException
@@ -21,25 +26,117 @@ class User:
         return hashlib.md5(f'cd2b_{password}'.encode()).hexdigest()
 
 
+# сколько секунд живет сессия (токен из /login) и сколько сессий помнить
+SESSION_TTL = float(os.environ.get('CD2B_SESSION_TTL', 12 * 60 * 60))
+MAX_SESSIONS = int(os.environ.get('CD2B_MAX_SESSIONS', 10000))
+# сколько секунд помнить проверенный хэш пароля пользователя (авторизация логином и паролем в теле запроса)
+CREDENTIALS_TTL = float(os.environ.get('CD2B_CREDENTIALS_TTL', 5 * 60))
+
+
+class TTLCache:
+    """LRU-кэш с временем жизни записей."""
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items: OrderedDict = OrderedDict()
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if time.monotonic() >= expires_at:
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._items[key] = (value, time.monotonic() + self.ttl)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def pop(self, key):
+        item = self._items.pop(key, None)
+        return None if item is None else item[0]
+
+    def remove_if(self, predicate):
+        for key in [key for key, (value, _) in self._items.items() if predicate(key, value)]:
+            del self._items[key]
+
+    def __len__(self):
+        return len(self._items)
+
+
+class SessionCache:
+    """Сессии: токен -> User. Проверка токена не трогает ни БД, ни хэширование."""
+
+    def __init__(self, ttl: float = SESSION_TTL, max_sessions: int = MAX_SESSIONS):
+        self.ttl = ttl
+        self._sessions = TTLCache(ttl, max_sessions)
+
+    def create(self, user: User) -> str:
+        token = secrets.token_urlsafe(32)
+        self._sessions.set(token, user)
+        return token
+
+    def get(self, token: str) -> Optional[User]:
+        return self._sessions.get(token)
+
+    def invalidate(self, token: str):
+        self._sessions.pop(token)
+
+    def invalidate_user(self, login: str):
+        self._sessions.remove_if(lambda _, user: user.login == login)
+
+
+sessions = SessionCache()
+# login -> хэш пароля, уже сверенный с БД
+verified_credentials = TTLCache(CREDENTIALS_TTL, MAX_SESSIONS)
+
+
+# сбрасывает все закэшированные данные авторизации пользователя; вызывать при любом изменении пользователя
+def invalidate_user(login: str):
+    sessions.invalidate_user(login)
+    verified_credentials.pop(login)
+
+
 # выполняем пользовательские запросы
 async def execute_user_queries(filename: str, *params):
-    await execute_queries_with_no_prequery('pre-query.sql', ".")
     return await execute_queries_with_no_prequery(filename, ".", *params)
 
 
+def unauthorized_exception(detail: str = "Incorrect username or password") -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail=detail,
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+
 # Авторизация
 async def auth_validation(user: User) -> Optional['User']:
+    if verified_credentials.get(user.login) == user.hash_password:
+        return user
+
     query_res = (await execute_user_queries('get_user.sql', user.login))[0]
-    exception = HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Incorrect username or password",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
+    exception = unauthorized_exception()
     if len(query_res) == 0:
         raise exception
     profile_db = query_res[0]
     if user.hash_password != profile_db[2]:
         raise exception
+    verified_credentials.set(user.login, user.hash_password)
+    return user
+
+
+# Авторизация по токену сессии
+def token_validation(token: str) -> User:
+    user = sessions.get(token)
+    if user is None:
+        raise unauthorized_exception("Invalid or expired token")
     return user
 
 
@@ -50,16 +147,17 @@ async def is_user_exist(login: str) -> bool:
 
 
 async def create_user(user: User):
-    # профили только с уникальными именами
-    if await is_user_exist(user.login):
+    # пользователи только с уникальными логинами: за это отвечает UNIQUE индекс на users.login
+    try:
+        await execute_user_queries(
+            'create-user.sql',
+            user.login,
+            user.hash_password
+        )
+    except sqlite3.IntegrityError:
         raise ValueError(
             f'User with login \'{user.login}\' already exists.'
         )
-
-    await execute_user_queries(
-        'create-user.sql',
-        user.login,
-        user.hash_password
-    )
+    invalidate_user(user.login)
 
     return user
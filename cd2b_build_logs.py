@@ -0,0 +1,162 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import AsyncIterator, Callable, Hashable, Optional
+
+from cd2b_process import LogConsumer, LogLine
+
+# сколько последних строк сборки держать в памяти для повторной отправки подписчикам
+RING_SIZE = int(os.environ.get('CD2B_BUILD_LOG_RING_SIZE', 2000))
+# сколько строк может ждать отправки одному подписчику; медленный подписчик перескакивает вперед
+SUBSCRIBER_QUEUE_SIZE = int(os.environ.get('CD2B_BUILD_LOG_SUBSCRIBER_QUEUE', 1000))
+# строки для файла лога копятся и пишутся в потоке пачкой: когда набралось столько строк
+FILE_FLUSH_LINES = 512
+# ... или с последней записи прошло столько секунд
+FILE_FLUSH_INTERVAL = 1.0
+# сколько секунд лог завершенной сборки остается в памяти для /build_logs; полный лог остается в файле
+FINISHED_LOG_TTL = float(os.environ.get('CD2B_BUILD_LOG_TTL', 10 * 60))
+
+HUB_STREAM = 'cd2b'
+
+
+class Subscriber:
+    """Подписка на лог сборки: сначала отдает накопленные строки, затем новые.
+
+    Если подписчик не успевает забирать строки и его очередь заполнилась,
+    очередь сбрасывается и вместо пропущенных строк приходит одна строка
+    с их количеством - сборка медленного подписчика не ждет.
+    """
+
+    def __init__(self, replay: list[LogLine], queue_size: int = SUBSCRIBER_QUEUE_SIZE):
+        self._replay = replay
+        self.queue_size = queue_size
+        # размер ограничивается в offer, чтобы маркер конца лога помещался всегда
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self.skipped = 0
+
+    def _skip_ahead(self):
+        skipped = 0
+        while not self._queue.empty():
+            if self._queue.get_nowait().stream != HUB_STREAM:
+                skipped += 1
+        self.skipped += skipped
+        self._queue.put_nowait(LogLine(HUB_STREAM, f'... {skipped} lines skipped ...', True, time.time()))
+
+    # кладет строку в очередь подписчика, никогда не блокируясь; None - конец лога
+    def offer(self, line: Optional[LogLine]):
+        if line is not None and self._queue.qsize() >= self.queue_size:
+            self._skip_ahead()
+        self._queue.put_nowait(line)
+
+    async def __aiter__(self) -> AsyncIterator[LogLine]:
+        for line in self._replay:
+            yield line
+        self._replay = []
+        while (line := await self._queue.get()) is not None:
+            yield line
+
+
+class BuildLog(LogConsumer):
+    """Лог одной сборки: кольцевой буфер последних строк в памяти,
+    полный лог в файле и рассылка новых строк подписчикам.
+
+    Файл пишется не на event loop, а в потоке пачками строк (см. FILE_FLUSH_LINES).
+    """
+
+    def __init__(self,
+                 file_path: Optional[str] = None,
+                 ring_size: int = RING_SIZE,
+                 on_close: Optional[Callable[['BuildLog'], None]] = None):
+        self.file_path = file_path
+        self.started_at = time.time()
+        self.finished = False
+        self.on_close = on_close
+        self._ring: deque[LogLine] = deque(maxlen=ring_size)
+        self._subscribers: set[Subscriber] = set()
+        self._pending: list[str] = []
+        self._flushed_at = time.monotonic()
+        # первая запись создает файл заново, следующие дописывают
+        self._file_mode = 'w'
+
+    def _write_file(self, text: str, mode: str):
+        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+        with open(self.file_path, mode, encoding='utf-8') as file:
+            file.write(text)
+
+    async def _flush(self):
+        if self.file_path is None:
+            return
+        text = ''.join(self._pending)
+        self._pending = []
+        self._flushed_at = time.monotonic()
+        mode, self._file_mode = self._file_mode, 'a'
+        await asyncio.to_thread(self._write_file, text, mode)
+
+    async def write(self, line: LogLine):
+        self._ring.append(line)
+        for subscriber in self._subscribers:
+            subscriber.offer(line)
+        if self.file_path is not None and line.is_new_line:
+            self._pending.append(line.text + '\n')
+            if (len(self._pending) >= FILE_FLUSH_LINES
+                    or time.monotonic() - self._flushed_at >= FILE_FLUSH_INTERVAL):
+                await self._flush()
+
+    async def close(self):
+        self.finished = True
+        await self._flush()
+        for subscriber in self._subscribers:
+            subscriber.offer(None)
+        self._subscribers.clear()
+        if self.on_close is not None:
+            self.on_close(self)
+
+    def subscribe(self) -> Subscriber:
+        replay = list(self._ring)
+        subscriber = Subscriber(replay)
+        if self.finished:
+            subscriber.offer(None)
+        else:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self._subscribers.discard(subscriber)
+
+
+class LogHub:
+    """Последний лог сборки каждого профиля; ключ - (рабочая директория, имя профиля).
+
+    Лог завершенной сборки удаляется из памяти через ttl секунд, если за это время
+    не началась новая сборка профиля.
+    """
+
+    def __init__(self, ttl: float = FINISHED_LOG_TTL):
+        self.ttl = ttl
+        self._logs: dict[Hashable, BuildLog] = {}
+
+    # начинает новый лог сборки профиля, заменяя завершенный предыдущий.
+    # Пока идет другая сборка того же профиля, выбрасывает RuntimeError: две сборки писали бы в один файл
+    def start(self, key: Hashable, file_path: Optional[str] = None) -> BuildLog:
+        current = self._logs.get(key)
+        if current is not None and not current.finished:
+            raise RuntimeError('Another build of this profile is in progress.')
+        build_log = self._logs[key] = BuildLog(file_path, on_close=lambda log: self._expire_later(key, log))
+        return build_log
+
+    def _expire_later(self, key: Hashable, build_log: BuildLog):
+        asyncio.get_running_loop().call_later(self.ttl, self._expire, key, build_log)
+
+    def _expire(self, key: Hashable, build_log: BuildLog):
+        if self._logs.get(key) is build_log:
+            del self._logs[key]
+
+    def get(self, key: Hashable) -> Optional[BuildLog]:
+        return self._logs.get(key)
+
+    def remove(self, key: Hashable):
+        self._logs.pop(key, None)
+
+
+hub = LogHub()
@@ -0,0 +1,349 @@
+import asyncio
+import contextlib
+import json
+import os
+import time
+from typing import AsyncContextManager, AsyncIterator, Awaitable, Callable, NamedTuple, Optional
+
+import cd2b_metrics
+import cd2b_process
+
+DOCKER_BIN = os.environ.get('CD2B_DOCKER', 'docker')
+# сколько секунд снимок запущенных контейнеров считается актуальным
+STATUS_TTL = float(os.environ.get('CD2B_CONTAINER_STATUS_TTL', 2))
+
+PS_FORMAT = '{{.Names}}\t{{.Image}}\t{{.Status}}'
+# контейнеры профилей называются cd2b_<repo>_<profile>
+CONTAINER_PREFIX = 'cd2b_'
+
+# события docker, после которых контейнер считается запущенным или остановленным.
+# pause сюда не входит: docker ps показывает приостановленный контейнер запущенным, и таблица должна совпадать
+STARTED_ACTIONS = frozenset({'start', 'unpause'})
+STOPPED_ACTIONS = frozenset({'die', 'stop', 'destroy'})
+
+
+class ContainerInfo(NamedTuple):
+    name: str
+    image: str
+    status: str
+
+
+# Разбирает вывод `docker ps --format PS_FORMAT` в словарь имя контейнера -> информация
+def parse_ps_output(output: str) -> dict[str, ContainerInfo]:
+    containers = {}
+    for line in output.splitlines():
+        parts = line.split('\t')
+        if len(parts) != 3:
+            continue
+        name, image, status = parts
+        containers[name] = ContainerInfo(name, image, status)
+    return containers
+
+
+# Выполняет docker с аргументами args, возвращает код возврата и stdout
+async def run_docker(*args: str) -> tuple[int, str]:
+    with cd2b_metrics.track_subprocess((DOCKER_BIN, *args)):
+        try:
+            process = await asyncio.create_subprocess_exec(
+                DOCKER_BIN, *args,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+        except OSError:
+            return 127, ''
+        output, _ = await process.communicate()
+    return process.returncode, output.decode('utf-8')
+
+
+async def image_exists(image: str) -> bool:
+    returncode, _ = await run_docker('image', 'inspect', '--format', '{{.Id}}', image)
+    return returncode == 0
+
+
+# Теги образа repository, например ['latest', '0123abcd4567-89abcdef0123']
+async def image_tags(repository: str) -> list[str]:
+    returncode, output = await run_docker('images', repository, '--format', '{{.Tag}}')
+    if returncode != 0:
+        return []
+    return [tag for tag in output.split() if tag and tag != '<none>']
+
+
+# Один вызов docker ps, возвращает все запущенные контейнеры.
+# Если docker ps упал - выбрасывает cd2b_process.ProcessFailedError: пустой список означал бы, что все остановлены
+async def list_running_containers() -> dict[str, ContainerInfo]:
+    returncode, output = await run_docker('ps', '--no-trunc', '--format', PS_FORMAT)
+    if returncode != 0:
+        raise cd2b_process.ProcessFailedError(f'{DOCKER_BIN} ps', returncode)
+    return parse_ps_output(output)
+
+
+# Подписка на `docker events` по контейнерам. На входе в контекст процесс уже подписан,
+# внутри - поток событий (словари из `--format '{{json .}}'`); на выходе процесс убивается
+@contextlib.asynccontextmanager
+async def docker_events() -> AsyncIterator[AsyncIterator[dict]]:
+    process = await asyncio.create_subprocess_exec(
+        DOCKER_BIN, 'events',
+        '--filter', 'type=container',
+        '--format', '{{json .}}',
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    try:
+        yield _read_events(process.stdout)
+    finally:
+        await cd2b_process.kill(process)
+
+
+async def _read_events(stream: asyncio.StreamReader) -> AsyncIterator[dict]:
+    async for line in stream:
+        try:
+            yield json.loads(line)
+        except ValueError:
+            continue
+
+
+class ContainerStatus:
+    """Снимок запущенных контейнеров, общий для всех запросов.
+
+    Снимок обновляется не чаще раза в ttl секунд; конкурентные запросы,
+    пришедшие во время обновления, ждут один и тот же вызов list_containers (по умолчанию docker ps).
+    Если list_containers упал (docker недоступен), отдается последний удачный снимок.
+    """
+
+    def __init__(self,
+                 ttl: float = STATUS_TTL,
+                 list_containers: Callable[[], Awaitable[dict[str, ContainerInfo]]] = list_running_containers):
+        self.ttl = ttl
+        # откуда брать список контейнеров; cd2b_runtime.set_runtime подставляет сюда свой runtime
+        self.list_containers = list_containers
+        self._snapshot: dict[str, ContainerInfo] = {}
+        self._taken_at: Optional[float] = None
+        self._pending: Optional[asyncio.Task] = None
+        # увеличивается при каждой инвалидации, чтобы не сохранить снимок, снятый до изменения
+        self._generation = 0
+
+    # сбрасывает снимок; вызывается после запуска, остановки и удаления контейнеров
+    def invalidate(self):
+        self._generation += 1
+        self._taken_at = None
+        self._pending = None
+
+    def _is_fresh(self) -> bool:
+        return self._taken_at is not None and time.monotonic() - self._taken_at < self.ttl
+
+    # обновление идет отдельной задачей: отмена одного ожидающего (клиент отключился) не отменяет его для остальных
+    async def snapshot(self) -> dict[str, ContainerInfo]:
+        if self._is_fresh():
+            return self._snapshot
+
+        loop = asyncio.get_running_loop()
+        refresh = self._pending
+        if refresh is None or refresh.get_loop() is not loop:
+            refresh = self._pending = loop.create_task(self._refresh())
+        return await asyncio.shield(refresh)
+
+    async def _refresh(self) -> dict[str, ContainerInfo]:
+        generation = self._generation
+        try:
+            snapshot = await self.list_containers()
+        except Exception as e:
+            # снимок не считается свежим, следующий запрос попробует снова
+            # TODO: do logging
+            print(f'failed to list containers, using the last snapshot: {e}')
+            return self._snapshot
+        finally:
+            if self._pending is asyncio.current_task():
+                self._pending = None
+
+        if self._generation == generation:
+            self._snapshot = snapshot
+            self._taken_at = time.monotonic()
+        return snapshot
+
+    async def is_running(self, container_name: str) -> bool:
+        return container_name in await self.snapshot()
+
+
+status = ContainerStatus()
+
+
+class ContainerEventTracker:
+    """Таблица запущенных контейнеров профилей, которая ведется по потоку событий docker.
+
+    При старте и после каждого переподключения к потоку таблица
+    пересинхронизируется полным списком контейнеров. Пока поток жив
+    (is_live), is_running отвечает из памяти без вызова docker.
+    События и список берутся из events и list_containers (по умолчанию docker events и docker ps);
+    cd2b_runtime.set_runtime подставляет сюда свой runtime.
+    """
+
+    def __init__(self,
+                 prefix: str = CONTAINER_PREFIX,
+                 reconnect_delay: float = 1.0,
+                 max_reconnect_delay: float = 30.0,
+                 events: Callable[[], AsyncContextManager[AsyncIterator[dict]]] = docker_events,
+                 list_containers: Callable[[], Awaitable[dict[str, ContainerInfo]]] = list_running_containers):
+        self.prefix = prefix
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.events = events
+        self.list_containers = list_containers
+        self._running: set[str] = set()
+        self._live = False
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def is_live(self) -> bool:
+        return self._live
+
+    def is_running(self, container_name: str) -> bool:
+        return container_name in self._running
+
+    def running(self) -> set[str]:
+        return set(self._running)
+
+    # отмечает известное изменение состояния, не дожидаясь события от docker
+    def mark(self, container_name: str, running: bool):
+        if running:
+            self._running.add(container_name)
+        else:
+            self._running.discard(container_name)
+
+    # применяет одно событие из `docker events --format '{{json .}}'`
+    def apply(self, event: dict):
+        if event.get('Type', 'container') != 'container':
+            return
+        name = event.get('Actor', {}).get('Attributes', {}).get('name')
+        if not name or not name.startswith(self.prefix):
+            return
+        action = event.get('Action') or event.get('status') or ''
+        if action in STARTED_ACTIONS:
+            self._running.add(name)
+        elif action in STOPPED_ACTIONS:
+            self._running.discard(name)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    # переподключается к потоку событий, если он запущен; нужно после смены источника событий
+    def restart(self):
+        if self._task is None or self._task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if self._task.get_loop() is not loop:
+            return
+        self._task.cancel()
+        self._live = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._live = False
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self):
+        delay = self.reconnect_delay
+        while True:
+            try:
+                if await self._follow():
+                    delay = self.reconnect_delay
+            except Exception as e:
+                # TODO: do logging
+                print(f'docker events are unavailable: {e}')
+            finally:
+                self._live = False
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    # Подписывается на события и читает их до разрыва потока. Таблица становится живой только
+    # после удачного списка контейнеров: если он упал, исключение уходит в _run и будет переподключение.
+    # Возвращает True, если поток успел синхронизироваться
+    async def _follow(self) -> bool:
+        async with self.events() as events:
+            # снимок берем уже после подписки: события, пришедшие за это время,
+            # лежат в буфере потока и будут применены поверх снимка
+            snapshot = await self.list_containers()
+            self._running = {name for name in snapshot if name.startswith(self.prefix)}
+            self._live = True
+
+            async for event in events:
+                self.apply(event)
+        return True
+
+
+tracker = ContainerEventTracker()
+
+
+# проверяет, запущен ли контейнер: по таблице событий, если поток событий жив, иначе по снимку docker ps
+async def is_running(container_name: str) -> bool:
+    if tracker.is_live:
+        return tracker.is_running(container_name)
+    return await status.is_running(container_name)
+
+
+# вызывается после операций, меняющих состояние контейнера;
+# running - известное новое состояние, если оно известно
+def container_changed(container_name: str, running: Optional[bool] = None):
+    status.invalidate()
+    if running is not None:
+        tracker.mark(container_name, running)
+
+
+class ContainerLogLine(NamedTuple):
+    time: str
+    stream: str
+    text: str
+
+
+# Разбирает строку `docker logs --timestamps`: <RFC3339 время> <текст>
+def parse_log_line(line: 'cd2b_process.LogLine') -> ContainerLogLine:
+    timestamp, _, text = line.text.partition(' ')
+    return ContainerLogLine(timestamp, line.stream, text)
+
+
+# Вывод контейнера через `docker logs`, пачками строк (так его отдает CliRuntime).
+# follow - ждать новых строк, пока контейнер работает; since и until - время или длительность
+# в формате docker (2024-01-01T10:00:00, 10m); tail - сколько последних строк отдать.
+# Если получатель не успевает, docker logs упирается в пайп
+async def container_logs(container_name: str,
+                         follow: bool = False,
+                         since: Optional[str] = None,
+                         until: Optional[str] = None,
+                         tail: Optional[int] = None,
+                         timestamps: bool = False) -> AsyncIterator[list['cd2b_process.LogLine']]:
+    args = ['logs']
+    if follow:
+        args.append('--follow')
+    if timestamps:
+        args.append('--timestamps')
+    # значения передаются через =, чтобы их нельзя было принять за отдельные флаги
+    if since:
+        args.append(f'--since={since}')
+    if until:
+        args.append(f'--until={until}')
+    if tail is not None:
+        args.append(f'--tail={tail}')
+
+    process = await asyncio.create_subprocess_exec(
+        DOCKER_BIN, *args, '--', container_name,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        async for batch in cd2b_process.iter_line_batches(process):
+            # у docker logs строки всегда законченные, незаконченный хвост придет целиком позже
+            batch = [line for line in batch if line.is_new_line]
+            if batch:
+                yield batch
+    finally:
+        await cd2b_process.kill(process)
@@ -1,13 +1,29 @@
+import asyncio
 import os
 import re
+import sqlite3
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Iterable, Optional, Sequence
 
 import aiosqlite
-import requests
 
+import cd2b_http
+import cd2b_metrics
+import cd2b_migrations
 import utils
+from cd2b_queries import QueryRegistry
 
 QUERIES_PATH = './query'
 DATABASE_FILE = 'cd2b_profiles.db'
+# dev-режим: перечитывать .sql файлы при их изменении
+QUERIES_HOT_RELOAD = os.environ.get('CD2B_QUERIES_HOT_RELOAD', '').lower() in ('1', 'true', 'yes')
+
+# максимальное число одновременно открытых соединений (по одному на файл БД)
+MAX_CONNECTIONS = int(os.environ.get('CD2B_DB_MAX_CONNECTIONS', 256))
+# через сколько секунд простоя соединение с БД пользователя закрывается
+CONNECTION_IDLE_TIMEOUT = float(os.environ.get('CD2B_DB_IDLE_TIMEOUT', 300))
 
 
 # TODO: вынести исключения в отдельный модуль
@@ -28,58 +44,210 @@ class InvalidPropertiesFormat(Exception):
         super().__init__(self.msg)
 
 
+class _PooledConnection:
+    def __init__(self, path: str):
+        self.path = path
+        self.connection: Optional[aiosqlite.Connection] = None
+        # соединение одно на файл, поэтому запросы к нему выполняются по очереди
+        self.lock = asyncio.Lock()
+        # сколько корутин сейчас держат или ждут соединение; такие соединения не вытесняются
+        self.users = 0
+        self.last_used = time.monotonic()
+
+
+class ConnectionPool:
+    """Долгоживущие соединения с SQLite, по одному на файл БД.
+
+    Соединения открываются лениво, переводятся в WAL, схема БД при открытии
+    доводится до последней версии миграциями. Соединения закрываются,
+    если простаивают дольше idle_timeout или если открытых соединений
+    больше max_connections (вытесняются давно не использованные).
+    """
+
+    PRAGMAS = (
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA busy_timeout=5000',
+        'PRAGMA temp_store=MEMORY',
+        # кэш страниц на соединение ограничен ~512KB, чтобы тысячи пользователей не съели память
+        'PRAGMA cache_size=-512',
+    )
+
+    def __init__(self,
+                 max_connections: int = MAX_CONNECTIONS,
+                 idle_timeout: float = CONNECTION_IDLE_TIMEOUT):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self._connections: OrderedDict[str, _PooledConnection] = OrderedDict()
+
+    def __len__(self):
+        return len(self._connections)
+
+    async def _connect(self, path: str) -> aiosqlite.Connection:
+        utils.create_dirs(os.path.dirname(path))
+        connection = aiosqlite.connect(path)
+        # поток соединения не должен мешать завершению процесса
+        connection.daemon = True
+        await connection
+        try:
+            for pragma in self.PRAGMAS:
+                await connection.execute(pragma)
+            await cd2b_migrations.migrate(connection)
+        except Exception:
+            await connection.close()
+            raise
+        return connection
+
+    # Отдает соединение с БД по пути path; пока контекст открыт, соединением владеет только вызывающий
+    @asynccontextmanager
+    async def acquire(self, path: str) -> AsyncIterator[aiosqlite.Connection]:
+        key = os.path.abspath(path)
+        while True:
+            entry = self._connections.get(key)
+            if entry is None:
+                entry = _PooledConnection(key)
+                self._connections[key] = entry
+            entry.users += 1
+            try:
+                async with entry.lock:
+                    # пока ждали блокировку, соединение могли вытеснить
+                    if self._connections.get(key) is not entry:
+                        continue
+                    if entry.connection is None:
+                        entry.connection = await self._connect(key)
+                    yield entry.connection
+                    break
+            finally:
+                entry.users -= 1
+                entry.last_used = time.monotonic()
+                if self._connections.get(key) is entry:
+                    self._connections.move_to_end(key)
+        await self.evict()
+
+    # Закрывает простаивающие соединения и лишние соединения сверх max_connections
+    async def evict(self):
+        now = time.monotonic()
+        excess = len(self._connections) - self.max_connections
+        to_close = []
+        for key, entry in list(self._connections.items()):
+            if entry.users:
+                continue
+            if excess > 0 or now - entry.last_used > self.idle_timeout:
+                del self._connections[key]
+                excess -= 1
+                to_close.append(entry)
+            else:
+                # дальше идут только более свежие соединения
+                break
+        for entry in to_close:
+            await self._close_entry(entry)
+
+    @staticmethod
+    async def _close_entry(entry: _PooledConnection):
+        connection, entry.connection = entry.connection, None
+        if connection is not None:
+            await connection.close()
+
+    # Закрывает все соединения; вызывается при остановке приложения
+    async def close(self):
+        entries = list(self._connections.values())
+        self._connections.clear()
+        for entry in entries:
+            await self._close_entry(entry)
+
+
+pool = ConnectionPool()
+queries = QueryRegistry(QUERIES_PATH, hot_reload=QUERIES_HOT_RELOAD)
+
+
 # БД профилей хранится в workdir/DATABASE_FILE
 async def db_path(workdir: str):
-    utils.create_dirs(os.path.join(workdir))
     return os.path.join(workdir, DATABASE_FILE)
 
 
+# Соединение с БД профилей рабочей директории workdir
+def connection(workdir: str):
+    return pool.acquire(os.path.join(workdir, DATABASE_FILE))
+
+
+async def close_connections():
+    await pool.close()
+
+
 # Выполняет запросы из .sql файлов. filename - название файла, без указания пути
 # Без пре-запроса
 async def execute_queries_with_no_prequery(filename: str, workdir: str, *params) -> list:
-    filename = f'{QUERIES_PATH}/{filename}'
-    with open(filename, 'r') as file:
-        queries = file.read().split(';')[:-1]
+    statements = queries.get(filename).statements
 
     results = []
-    async with aiosqlite.connect(await db_path(workdir)) as db:
-        for query in queries:
-            query = query.strip()
-            if 'select' in query.lower():
-                cursor = await db.execute(query, params)
-                result = await cursor.fetchall()
-                results.append(result)
-                await cursor.close()
-            else:
-                await db.execute(query, params)
-                await db.commit()
+    with cd2b_metrics.sql_query_seconds.time(filename):
+        async with connection(workdir) as db:
+            try:
+                for statement in statements:
+                    if statement.is_read:
+                        cursor = await db.execute(statement.sql, params)
+                        result = await cursor.fetchall()
+                        results.append(result)
+                        await cursor.close()
+                    else:
+                        await db.execute(statement.sql, params)
+                        await db.commit()
+            except Exception:
+                cd2b_metrics.sql_query_errors.inc(filename)
+                # соединение общее, незавершенную транзакцию оставлять нельзя
+                await db.rollback()
+                raise
     return results
 
 
-# Выполняет запрос из файла с пре-запросом
+# Выполняет изменяющие запросы из файла для каждого набора параметров одной транзакцией
+async def execute_many(filename: str, workdir: str, params_list: Iterable[Sequence]):
+    statements = queries.get(filename).statements
+    params_list = list(params_list)
+
+    async with connection(workdir) as db:
+        try:
+            for statement in statements:
+                await db.executemany(statement.sql, params_list)
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+
+
+# Выполняет запрос из файла. Схему БД создают миграции при открытии соединения,
+# поэтому отдельный пре-запрос больше не нужен
 async def execute_queries(filename: str, workdir: str, *params):
-    await execute_queries_with_no_prequery('pre-query.sql', workdir)
     return await execute_queries_with_no_prequery(filename, workdir, *params)
 
 
 # Дропает бдшку
 async def drop_profiles(workdir: str):
-    async with aiosqlite.connect(await db_path(workdir)) as db:
+    async with connection(workdir) as db:
         await db.execute(f'DROP TABLE profiles')
+        # пересоздаем схему с нуля, чтобы следующие запросы нашли пустую таблицу
+        await db.execute('DELETE FROM schema_version')
+        await db.commit()
+        await cd2b_migrations.migrate(db)
 
 
 async def remove_profile(workdir: str, name: str):
     await execute_queries('remove-profile.sql', workdir, name)
 
 
+# Удаляет профили с именами names одной транзакцией
+async def remove_profiles(workdir: str, names: Iterable[str]):
+    await execute_many('remove-profile.sql', workdir, ((name,) for name in names))
+
+
 # Возвращает все профили
 async def select_all_profiles(workdir: str):
-    await execute_queries_with_no_prequery('pre-query.sql', workdir)
-    async with aiosqlite.connect(await db_path(workdir)) as db:
-        cursor = await db.execute(f'SELECT * FROM profiles')
-        rows = await cursor.fetchall()
-        await cursor.close()
-        return rows
+    return (await execute_queries('select-all-profiles.sql', workdir))[0]
+
+
+# Возвращает не больше limit профилей с id больше after_id, по возрастанию id
+async def select_profiles_page(workdir: str, after_id: int = 0, limit: int = 100):
+    return (await execute_queries('select-profiles-page.sql', workdir, after_id, limit))[0]
 
 
 # Возвращает профиль по имени
@@ -96,30 +264,29 @@ async def get_profile(workdir: str, name: str) -> dict:
 
 
 async def create_profile(profile_data: dict, workdir: str):
-    # профили только с уникальными именами
-    if await get_profile(workdir, profile_data.get('name')) != {}:
-        raise ValueError(
-            f'Profile with name \'{profile_data.get("name")}\' already exists.'
-        )
+    name = profile_data.get('name')
+    already_exists = ValueError(f'Profile with name \'{name}\' already exists.')
+    # занятое имя проверяем до check_profile_data, чтобы не ходить зря в GitHub
+    if name is not None and await get_profile(workdir, name):
+        raise already_exists
     await check_profile_data(profile_data)
 
-    await execute_queries(
-        'create-profile.sql',
-        workdir,
-        profile_data.get('name'),
-        profile_data.get('github'),
-        profile_data.get('port')
-    )
+    # профили только с уникальными именами: за это отвечает UNIQUE индекс на profiles.name
+    try:
+        await execute_queries(
+            'create-profile.sql',
+            workdir,
+            name,
+            profile_data.get('github'),
+            profile_data.get('port')
+        )
+    except sqlite3.IntegrityError:
+        raise already_exists
 
 
-# проверка доступности гитхаб репозитория
+# проверка доступности гитхаб репозитория; результат кэшируется на CD2B_REPOSITORY_CHECK_TTL секунд
 async def check_github_repository(url: str):
-    try:
-        response = requests.get(url)
-        response.raise_for_status()
-        return True
-    except requests.exceptions.RequestException as _:
-        return False
+    return await cd2b_http.repositories.check(url)
 
 
 async def is_valid_port(port: any) -> bool:
@@ -0,0 +1,275 @@
+import asyncio
+import fcntl
+import hashlib
+import os
+import shutil
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import cd2b_metrics
+
+GIT_BIN = os.environ.get('CD2B_GIT', 'git')
+# глубина первого клона; 0 - полный клон с историей
+CLONE_DEPTH = int(os.environ.get('CD2B_GIT_CLONE_DEPTH', 0))
+# фильтр частичного клона, например blob:none; пусто - клонировать все объекты
+CLONE_FILTER = os.environ.get('CD2B_GIT_CLONE_FILTER', '')
+# общий для всех пользователей кэш bare-зеркал репозиториев, например ./MIRRORS; пусто (по умолчанию) -
+# кэш выключен и checkout'ы клонируются напрямую с учетом CLONE_DEPTH и CLONE_FILTER
+MIRRORS_PATH = os.environ.get('CD2B_GIT_MIRRORS', '')
+# сколько зеркал хранить; лишние неиспользуемые удаляются начиная с самых давних
+MAX_MIRRORS = int(os.environ.get('CD2B_GIT_MAX_MIRRORS', 64))
+
+
+class GitError(Exception):
+    """Исключение для случаев, когда команда git завершилась с ошибкой."""
+
+    def __init__(self, args: tuple, returncode: int, stderr: str):
+        self.returncode = returncode
+        self.stderr = stderr
+        self.msg = f"git {' '.join(args)} failed with code {returncode}: {stderr.strip()}"
+        super().__init__(self.msg)
+
+
+# Выполняет git с аргументами args, возвращает stdout. При ненулевом коде выбрасывает GitError
+async def run_git(*args: str, cwd: Optional[str] = None) -> str:
+    with cd2b_metrics.track_subprocess((GIT_BIN, *args)):
+        process = await asyncio.create_subprocess_exec(
+            GIT_BIN, *args,
+            cwd=cwd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            # git не должен ждать ввода логина/пароля в терминале
+            env={**os.environ, 'GIT_TERMINAL_PROMPT': '0'}
+        )
+        stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise GitError(args, process.returncode, stderr.decode(errors='replace'))
+    return stdout.decode(errors='replace')
+
+
+# Клонирует url в path; depth и clone_filter включают shallow/partial клон
+async def clone(url: str, path: str, depth: int = CLONE_DEPTH, clone_filter: str = CLONE_FILTER):
+    args = ['clone', '--quiet']
+    if depth:
+        args += ['--depth', str(depth)]
+    if clone_filter:
+        args += ['--filter', clone_filter]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    await run_git(*args, url, path)
+
+
+# Подтягивает ref (по умолчанию - ветку по умолчанию удаленного репо) и жестко сбрасывает на него checkout
+async def fetch_and_reset(path: str, url: str, ref: Optional[str] = None, depth: int = CLONE_DEPTH):
+    await run_git('remote', 'set-url', 'origin', url, cwd=path)
+    args = ['fetch', '--quiet', '--prune']
+    if depth:
+        args += ['--depth', str(depth)]
+    await run_git(*args, 'origin', ref or 'HEAD', cwd=path)
+    await run_git('reset', '--quiet', '--hard', 'FETCH_HEAD', cwd=path)
+    await run_git('clean', '--quiet', '-ffdx', cwd=path)
+
+
+# Хэш HEAD в checkout
+async def head_commit(path: str) -> str:
+    return (await run_git('rev-parse', 'HEAD', cwd=path)).strip()
+
+
+# Проверяет, что репозиторий в path цел: HEAD указывает на коммит и все объекты на месте.
+# Нужна, чтобы отличить поврежденный checkout от временной ошибки сети или доступа
+async def is_intact(path: str) -> bool:
+    try:
+        await run_git('rev-parse', '--quiet', '--verify', 'HEAD^{commit}', cwd=path)
+        await run_git('fsck', '--connectivity-only', '--no-progress', cwd=path)
+    except (GitError, OSError):
+        return False
+    return True
+
+
+class MirrorCache:
+    """Кэш bare-зеркал (git clone --mirror), по одному на url репозитория.
+
+    Checkout'ы профилей создаются из зеркала через `git clone --shared`
+    (объекты берутся из зеркала через alternates), поэтому один fetch
+    зеркала обновляет всех зависимых. Операции с зеркалом защищены
+    блокировкой внутри процесса и файловой блокировкой между процессами.
+    Зеркала без живых зависимых checkout'ов вытесняются по LRU.
+    """
+
+    LAST_USED_FILE = 'cd2b-last-used'
+    URL_FILE = 'cd2b-url'
+    DEPENDENTS_FILE = 'cd2b-dependents'
+
+    def __init__(self, path: str = MIRRORS_PATH, max_mirrors: int = MAX_MIRRORS):
+        self.path = path
+        self.max_mirrors = max_mirrors
+        self._locks: dict[str, asyncio.Lock] = {}
+
+    def mirror_path(self, url: str) -> str:
+        key = hashlib.sha1(url.encode()).hexdigest()[:16]
+        return os.path.join(self.path, f'{key}.git')
+
+    # Эксклюзивная блокировка зеркала, общая для корутин процесса и для других процессов
+    @asynccontextmanager
+    async def lock(self, mirror: str):
+        lock = self._locks.setdefault(mirror, asyncio.Lock())
+        lock_path = f'{mirror}.lock'
+        async with lock:
+            os.makedirs(self.path, exist_ok=True)
+            while True:
+                lock_file = open(lock_path, 'w')
+                await asyncio.to_thread(fcntl.flock, lock_file, fcntl.LOCK_EX)
+                # пока ждали, другой процесс мог удалить файл блокировки вместе с зеркалом -
+                # тогда блокировка взята на уже удаленный файл и ее надо взять заново
+                try:
+                    if os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                        break
+                except FileNotFoundError:
+                    pass
+                lock_file.close()
+            try:
+                yield
+            finally:
+                # закрытие файла снимает flock
+                lock_file.close()
+
+    # Создает или обновляет зеркало url; вызывать под lock
+    async def _update(self, url: str, mirror: str):
+        if os.path.isdir(mirror):
+            try:
+                await run_git('remote', 'set-url', 'origin', url, cwd=mirror)
+                await run_git('fetch', '--quiet', '--prune', 'origin', cwd=mirror)
+                return
+            except GitError as e:
+                if await is_intact(mirror):
+                    raise
+                # TODO: do logging
+                print(f'mirror {mirror} is corrupt, cloning from scratch: {e.msg}')
+                await asyncio.to_thread(shutil.rmtree, mirror)
+
+        await run_git('clone', '--quiet', '--mirror', url, mirror)
+        # gc в зеркале может удалить объекты, на которые ссылаются зависимые checkout'ы
+        await run_git('config', 'gc.auto', '0', cwd=mirror)
+        with open(os.path.join(mirror, self.URL_FILE), 'w') as file:
+            file.write(url)
+
+    def _touch(self, mirror: str):
+        with open(os.path.join(mirror, self.LAST_USED_FILE), 'w') as file:
+            file.write(str(time.time()))
+
+    def _add_dependent(self, mirror: str, path: str):
+        path = os.path.abspath(path)
+        if path in self._dependents(mirror):
+            return
+        with open(os.path.join(mirror, self.DEPENDENTS_FILE), 'a') as file:
+            file.write(path + '\n')
+
+    def _dependents(self, mirror: str) -> list[str]:
+        dependents_path = os.path.join(mirror, self.DEPENDENTS_FILE)
+        if not os.path.exists(dependents_path):
+            return []
+        with open(dependents_path, 'r') as file:
+            return [line for line in file.read().splitlines() if line]
+
+    # checkout, чьи объекты лежат в зеркале (alternates указывает на зеркало)
+    @staticmethod
+    def _uses_mirror(path: str, mirror: str) -> bool:
+        alternates = os.path.join(path, '.git', 'objects', 'info', 'alternates')
+        if not os.path.exists(alternates):
+            return False
+        mirror_objects = os.path.abspath(os.path.join(mirror, 'objects'))
+        with open(alternates, 'r') as file:
+            return any(os.path.abspath(line.strip()) == mirror_objects for line in file)
+
+    # Приводит checkout в path к состоянию ref, предварительно обновив зеркало url
+    async def checkout(self, url: str, path: str, ref: Optional[str] = None):
+        mirror = self.mirror_path(url)
+        async with self.lock(mirror):
+            await self._update(url, mirror)
+            self._touch(mirror)
+
+            if self._uses_mirror(path, mirror):
+                try:
+                    await fetch_and_reset(path, os.path.abspath(mirror), ref, depth=0)
+                    return
+                except GitError as e:
+                    if await is_intact(path):
+                        raise
+                    # TODO: do logging
+                    print(f'checkout {path} is corrupt, cloning from scratch: {e.msg}')
+
+            if os.path.exists(path):
+                await asyncio.to_thread(shutil.rmtree, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            await run_git('clone', '--quiet', '--shared', os.path.abspath(mirror), path)
+            if ref is not None:
+                await fetch_and_reset(path, os.path.abspath(mirror), ref, depth=0)
+            self._add_dependent(mirror, path)
+
+        await self.evict()
+
+    # Удаляет давно не использованные зеркала сверх max_mirrors, у которых нет живых зависимых
+    async def evict(self):
+        if not os.path.isdir(self.path):
+            return
+        mirrors = [
+            os.path.join(self.path, name)
+            for name in os.listdir(self.path)
+            if name.endswith('.git')
+        ]
+        excess = len(mirrors) - self.max_mirrors
+        if excess <= 0:
+            return
+
+        def last_used(mirror: str) -> float:
+            try:
+                return os.path.getmtime(os.path.join(mirror, self.LAST_USED_FILE))
+            except OSError:
+                return 0
+
+        for mirror in sorted(mirrors, key=last_used):
+            if excess <= 0:
+                break
+            async with self.lock(mirror):
+                if any(self._uses_mirror(path, mirror) for path in self._dependents(mirror)):
+                    continue
+                await asyncio.to_thread(shutil.rmtree, mirror, True)
+                # файл блокировки удаляем, пока она еще взята; ждущие ее увидят это и возьмут новую
+                os.remove(f'{mirror}.lock')
+            self._locks.pop(mirror, None)
+            excess -= 1
+
+
+mirrors: Optional[MirrorCache] = MirrorCache() if MIRRORS_PATH else None
+
+
+# Приводит checkout в path к состоянию ref репозитория url.
+# Существующий checkout обновляется инкрементально (fetch + reset --hard);
+# заново клонируется только если checkout отсутствует или поврежден (см. is_intact).
+# Если fetch не удался, а checkout цел, GitError пробрасывается и checkout остается как был.
+# Если передан mirror_cache, объекты берутся из общего зеркала
+async def sync_repository(url: str,
+                          path: str,
+                          ref: Optional[str] = None,
+                          depth: int = CLONE_DEPTH,
+                          mirror_cache: Optional[MirrorCache] = None):
+    if mirror_cache is not None:
+        await mirror_cache.checkout(url, path, ref)
+        return
+
+    if os.path.isdir(os.path.join(path, '.git')):
+        try:
+            await fetch_and_reset(path, url, ref, depth)
+            return
+        except GitError as e:
+            # ошибка сети или доступа - рабочую копию не трогаем
+            if await is_intact(path):
+                raise
+            # TODO: do logging
+            print(f'checkout {path} is corrupt, cloning from scratch: {e.msg}')
+
+    if os.path.exists(path):
+        await asyncio.to_thread(shutil.rmtree, path)
+    await clone(url, path, depth)
+    if ref is not None:
+        await fetch_and_reset(path, url, ref, depth)
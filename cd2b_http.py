@@ -0,0 +1,98 @@
+import asyncio
+import os
+import time
+from typing import Optional
+
+import httpx
+
+import cd2b_metrics
+
+# строгие таймауты: проверка репозитория не должна подвешивать запрос пользователя
+TIMEOUT = httpx.Timeout(
+    float(os.environ.get('CD2B_HTTP_TIMEOUT', 5)),
+    connect=float(os.environ.get('CD2B_HTTP_CONNECT_TIMEOUT', 3))
+)
+LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30)
+
+# сколько секунд помнить результат проверки доступности url
+REACHABLE_TTL = float(os.environ.get('CD2B_REPOSITORY_CHECK_TTL', 300))
+UNREACHABLE_TTL = float(os.environ.get('CD2B_REPOSITORY_CHECK_NEGATIVE_TTL', 30))
+
+_client: Optional[httpx.AsyncClient] = None
+_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+# Общий http-клиент с пулом keep-alive соединений.
+# Соединения привязаны к event loop, поэтому в другом loop создается свой клиент
+def client() -> httpx.AsyncClient:
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client.is_closed or _client_loop is not loop:
+        _client = httpx.AsyncClient(timeout=TIMEOUT, limits=LIMITS, follow_redirects=True)
+        _client_loop = loop
+    return _client
+
+
+async def close_client():
+    global _client, _client_loop
+    http_client, _client, _client_loop = _client, None, None
+    if http_client is not None and not http_client.is_closed:
+        await http_client.aclose()
+
+
+class ReachabilityCache:
+    """Кэш доступности url с TTL: повторные проверки одного url не ходят в сеть.
+
+    Конкурентные проверки одного url ждут один и тот же запрос.
+    """
+
+    def __init__(self, ttl: float = REACHABLE_TTL, negative_ttl: float = UNREACHABLE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._results: dict[str, tuple[bool, float]] = {}
+        self._pending: dict[str, asyncio.Task] = {}
+
+    def clear(self):
+        self._results.clear()
+
+    def cached(self, url: str) -> Optional[bool]:
+        result = self._results.get(url)
+        if result is None:
+            return None
+        reachable, expires_at = result
+        if time.monotonic() >= expires_at:
+            del self._results[url]
+            return None
+        return reachable
+
+    async def check(self, url: str) -> bool:
+        reachable = self.cached(url)
+        if reachable is not None:
+            cd2b_metrics.github_checks.inc('cached')
+            return reachable
+
+        task = self._pending.get(url)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = self._pending[url] = asyncio.create_task(self._request(url))
+            task.add_done_callback(lambda done: self._forget(url, done))
+        return await asyncio.shield(task)
+
+    def _forget(self, url: str, task: asyncio.Task):
+        if self._pending.get(url) is task:
+            del self._pending[url]
+
+    async def _request(self, url: str) -> bool:
+        with cd2b_metrics.github_check_seconds.time():
+            try:
+                # тело ответа не нужно, достаточно статуса
+                async with client().stream('GET', url) as response:
+                    reachable = response.is_success
+            except httpx.HTTPError:
+                reachable = False
+        cd2b_metrics.github_checks.inc('reachable' if reachable else 'unreachable')
+        ttl = self.ttl if reachable else self.negative_ttl
+        self._results[url] = (reachable, time.monotonic() + ttl)
+        return reachable
+
+
+repositories = ReachabilityCache()
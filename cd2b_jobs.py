@@ -0,0 +1,200 @@
+import asyncio
+import itertools
+import os
+import time
+import uuid
+from collections import Counter, OrderedDict
+from typing import Awaitable, Callable, Hashable, Optional
+
+import cd2b_build_logs
+
+# сколько сборок может идти одновременно на всем хосте и у одного пользователя
+MAX_CONCURRENT_JOBS = int(os.environ.get('CD2B_MAX_BUILDS', 2))
+MAX_JOBS_PER_USER = int(os.environ.get('CD2B_MAX_BUILDS_PER_USER', 1))
+# сколько завершенных задач помнить для ручки статуса
+JOBS_HISTORY = int(os.environ.get('CD2B_JOBS_HISTORY', 1000))
+# приоритеты задач по виду: перезапуск обновляет уже работающий профиль, поэтому идет раньше новых запусков
+PRIORITIES = {'rerun': 1, 'bandr': 0}
+
+QUEUED = 'queued'
+CLONING = 'cloning'
+BUILDING = 'building'
+STARTING = 'starting'
+RUNNING = 'running'
+FAILED = 'failed'
+
+FINAL_STATUSES = (RUNNING, FAILED)
+
+
+class Job:
+    def __init__(self,
+                 owner: str,
+                 profile_name: str,
+                 kind: str,
+                 action: Callable[['Job'], Awaitable],
+                 key: Optional[Hashable] = None,
+                 priority: int = 0):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.profile_name = profile_name
+        self.kind = kind
+        self.key = key
+        self.priority = priority
+        self.action = action
+        self.status = QUEUED
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        # время входа в каждый статус
+        self.stages: dict[str, float] = {QUEUED: self.created_at}
+        # лог сборки; action заводит его в самом начале, до первого await
+        self.build_log: Optional[cd2b_build_logs.BuildLog] = None
+        self._started = asyncio.Event()
+        self._done = asyncio.Event()
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in FINAL_STATUSES
+
+    # переводит задачу в новый статус; передается в Profile.run как on_stage
+    def set_status(self, status: str):
+        self.status = status
+        self.stages[status] = time.time()
+
+    def finish(self, error: Optional[str] = None):
+        self.error = error
+        self.finished_at = time.time()
+        self.set_status(FAILED if error is not None else RUNNING)
+        self._started.set()
+        self._done.set()
+
+    # ждет завершения задачи
+    async def wait(self):
+        await self._done.wait()
+
+    # ждет начала выполнения задачи (или ее завершения, если она так и не началась)
+    async def wait_started(self):
+        await self._started.wait()
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "profile_name": self.profile_name,
+            "kind": self.kind,
+            "status": self.status,
+            "error": self.error,
+            "priority": self.priority,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "stages": dict(self.stages),
+            "queue_seconds": (self.started_at or time.time()) - self.created_at,
+            "run_seconds": (
+                (self.finished_at or time.time()) - self.started_at
+                if self.started_at is not None else None
+            ),
+        }
+
+
+class JobScheduler:
+    """Очередь задач сборки и запуска профилей.
+
+    Одновременно выполняется не больше max_concurrent задач и не больше
+    max_per_user задач одного владельца (рабочей директории пользователя); остальные ждут в очереди по
+    приоритету (больше - раньше), при равном приоритете - в порядке
+    поступления. Одинаковая задача (по key), еще стоящая в очереди,
+    повторно не ставится - возвращается уже существующая.
+    """
+
+    def __init__(self,
+                 max_concurrent: int = MAX_CONCURRENT_JOBS,
+                 max_per_user: int = MAX_JOBS_PER_USER,
+                 history: int = JOBS_HISTORY):
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.history = history
+        self._queue: list[tuple[int, int, Job]] = []
+        self._sequence = itertools.count()
+        self._queued_by_key: dict[Hashable, Job] = {}
+        self._running_per_user: Counter = Counter()
+        self._running = 0
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        self._tasks: set[asyncio.Task] = set()
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def queued(self) -> list[Job]:
+        return [job for _, _, job in sorted(self._queue)]
+
+    def submit(self,
+               owner: str,
+               profile_name: str,
+               kind: str,
+               action: Callable[[Job], Awaitable],
+               key: Optional[Hashable] = None,
+               priority: int = 0) -> Job:
+        if key is not None and key in self._queued_by_key:
+            return self._queued_by_key[key]
+
+        job = Job(owner, profile_name, kind, action, key=key, priority=priority)
+        self._queue.append((-priority, next(self._sequence), job))
+        if key is not None:
+            self._queued_by_key[key] = job
+        self._remember(job)
+        self._dispatch()
+        return job
+
+    # запоминает задачу и забывает самые старые завершенные сверх history;
+    # незавершенные пропускаются, но не мешают удалять завершенные после них
+    def _remember(self, job: Job):
+        self._jobs[job.id] = job
+        excess = len(self._jobs) - self.history
+        if excess <= 0:
+            return
+        for job_id, old_job in list(self._jobs.items()):
+            if excess <= 0:
+                break
+            if old_job.is_finished:
+                del self._jobs[job_id]
+                excess -= 1
+
+    # запускает задачи из очереди, пока есть свободные слоты
+    def _dispatch(self):
+        for entry in sorted(self._queue):
+            if self._running >= self.max_concurrent:
+                return
+            job = entry[2]
+            if self._running_per_user[job.owner] >= self.max_per_user:
+                continue
+            self._queue.remove(entry)
+            if job.key is not None:
+                self._queued_by_key.pop(job.key, None)
+            self._running += 1
+            self._running_per_user[job.owner] += 1
+            task = asyncio.create_task(self._execute(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, job: Job):
+        job.started_at = time.time()
+        job._started.set()
+        try:
+            await job.action(job)
+        except asyncio.CancelledError:
+            job.finish(error='cancelled')
+            raise
+        except Exception as e:
+            job.finish(error=str(e) or e.__class__.__name__)
+        else:
+            job.finish()
+        finally:
+            self._running -= 1
+            self._running_per_user[job.owner] -= 1
+            if self._running_per_user[job.owner] <= 0:
+                del self._running_per_user[job.owner]
+            self._dispatch()
+
+
+scheduler = JobScheduler()
@@ -0,0 +1,302 @@
+import asyncio
+import gzip
+import mimetypes
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from typing import AsyncIterator, NamedTuple, Optional
+
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+
+import cd2b_process
+
+# размер куска при чтении файла
+READ_CHUNK_SIZE = 64 * 1024
+# размер блока при чтении файла с конца в режиме tail
+TAIL_BLOCK_SIZE = 64 * 1024
+# больше стольких строк tail не отдает
+MAX_TAIL_LINES = 100_000
+# как часто в режиме follow проверять, не дописался ли файл, в секундах
+FOLLOW_POLL_INTERVAL = float(os.environ.get('CD2B_LOGS_FOLLOW_POLL_INTERVAL', 0.5))
+# файлы меньше этого размера не сжимаются
+MIN_GZIP_SIZE = 1024
+# размер страницы листинга директории по умолчанию
+DEFAULT_LISTING_LIMIT = 1000
+MAX_LISTING_LIMIT = 10_000
+# для скольких директорий хранится отсортированный листинг
+LISTING_CACHE_SIZE = 16
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class DirectoryEntry(NamedTuple):
+    name: str
+    is_dir: bool
+
+
+# ETag файла: меняется при любой дозаписи или перезаписи
+def file_etag(stat: os.stat_result) -> str:
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+# у сжатого представления файла свой ETag
+def gzip_etag(etag: str) -> str:
+    return etag[:-1] + '-gzip"'
+
+
+def is_text_file(path: str) -> bool:
+    mime_type, _ = mimetypes.guess_type(path)
+    # у логов часто нет расширения или оно неизвестное
+    return mime_type is None or mime_type.startswith('text/') or mime_type == 'application/json'
+
+
+# Разбирает заголовок Range. Поддерживается один диапазон bytes=start-end, bytes=start- и bytes=-suffix.
+# Возвращает (start, end) включительно или None, если заголовок не получится применить и нужно отдать весь файл
+def parse_range(header: str, size: int) -> Optional[tuple[int, int]]:
+    unit, _, ranges = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in ranges:
+        return None
+    start, _, end = ranges.strip().partition('-')
+    try:
+        if start == '':
+            suffix = int(end)
+            if suffix <= 0:
+                raise RangeNotSatisfiable()
+            return max(size - suffix, 0), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        raise RangeNotSatisfiable()
+    return start, min(end, size - 1)
+
+
+# Читает файл кусками с offset, всего length байт
+async def read_chunks(path: str, offset: int, length: int) -> AsyncIterator[bytes]:
+    file = await asyncio.to_thread(open, path, 'rb')
+    try:
+        await asyncio.to_thread(file.seek, offset)
+        while length > 0:
+            chunk = await asyncio.to_thread(file.read, min(READ_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        await asyncio.to_thread(file.close)
+
+
+async def gzip_chunks(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+# Последние n строк файла. Файл читается блоками с конца, пока не наберется n переводов строки
+def tail(path: str, n: int, block_size: int = TAIL_BLOCK_SIZE) -> bytes:
+    with open(path, 'rb') as file:
+        position = file.seek(0, os.SEEK_END)
+        # перевод строки в самом конце файла не начинает новую строку
+        newlines_needed = n + 1 if position and _last_byte(file, position) == b'\n' else n
+        # блоки собираются в список и склеиваются один раз, переводы строк считаются по мере чтения
+        blocks = []
+        newlines = 0
+        while position > 0 and newlines < newlines_needed:
+            read_size = min(block_size, position)
+            position -= read_size
+            file.seek(position)
+            block = file.read(read_size)
+            newlines += block.count(b'\n')
+            blocks.append(block)
+    data = b''.join(reversed(blocks))
+    lines = data.split(b'\n')
+    if data.endswith(b'\n'):
+        return b'\n'.join(lines[-n - 1:]) if n else b''
+    return b'\n'.join(lines[-n:]) if n else b''
+
+
+def _last_byte(file, size: int) -> bytes:
+    file.seek(size - 1)
+    return file.read(1)
+
+
+class _Listing(NamedTuple):
+    inode: int
+    mtime_ns: int
+    entries: list[DirectoryEntry]
+
+
+class ListingCache:
+    """Отсортированные листинги последних директорий.
+
+    Листинг перечитывается, когда меняется mtime директории (создание, удаление,
+    переименование записей), поэтому постраничный обход большой директории
+    не сканирует и не сортирует ее заново на каждой странице.
+    """
+
+    def __init__(self, size: int = LISTING_CACHE_SIZE):
+        self.size = size
+        self._listings: OrderedDict[str, _Listing] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> list[DirectoryEntry]:
+        stat = os.stat(path)
+        with self._lock:
+            listing = self._listings.get(path)
+            if listing is not None and listing.inode == stat.st_ino and listing.mtime_ns == stat.st_mtime_ns:
+                self._listings.move_to_end(path)
+                return listing.entries
+        # scandir не делает stat на каждый файл, тип записи берется из самой директории
+        with os.scandir(path) as entries:
+            listing = _Listing(stat.st_ino, stat.st_mtime_ns,
+                               sorted(DirectoryEntry(entry.name, entry.is_dir()) for entry in entries))
+        with self._lock:
+            self._listings[path] = listing
+            self._listings.move_to_end(path)
+            while len(self._listings) > self.size:
+                self._listings.popitem(last=False)
+        return listing.entries
+
+    def clear(self):
+        with self._lock:
+            self._listings.clear()
+
+
+listings = ListingCache()
+
+
+# Страница листинга директории: записи по имени, начиная с offset, не больше limit
+def list_directory(path: str, offset: int = 0, limit: int = DEFAULT_LISTING_LIMIT) -> tuple[list[DirectoryEntry], int]:
+    listing = listings.get(path)
+    return listing[offset:offset + limit], len(listing)
+
+
+# Отдает новые строки, дописываемые в конец файла, начиная с offset.
+# Если файл стал короче (его пересоздали), читает его с начала
+async def follow(path: str, offset: int, poll_interval: float = FOLLOW_POLL_INTERVAL) -> AsyncIterator[str]:
+    splitter = cd2b_process.LineSplitter()
+    while True:
+        try:
+            size = (await asyncio.to_thread(os.stat, path)).st_size
+        except FileNotFoundError:
+            size = 0
+        if size < offset:
+            offset = 0
+            splitter = cd2b_process.LineSplitter()
+        if size > offset:
+            async for chunk in read_chunks(path, offset, size - offset):
+                offset += len(chunk)
+                for text, is_new_line in splitter.feed(chunk):
+                    if is_new_line:
+                        yield text
+        else:
+            await asyncio.sleep(poll_interval)
+
+
+# etag - ETag того представления (сжатого или нет), которое получит этот клиент
+def _not_modified(request: Request, stat: os.stat_result, etag: str) -> bool:
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return etag in tags or '*' in tags
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since is not None:
+        try:
+            return int(stat.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _accepts_gzip(request: Request) -> bool:
+    return 'gzip' in request.headers.get('accept-encoding', '')
+
+
+# Отдает файл с поддержкой Range, If-None-Match/If-Modified-Since и gzip для текстовых файлов
+async def file_response(request: Request, path: str) -> Response:
+    stat = await asyncio.to_thread(os.stat, path)
+    size = stat.st_size
+    etag = file_etag(stat)
+    headers = {
+        'accept-ranges': 'bytes',
+        'etag': etag,
+        'last-modified': formatdate(stat.st_mtime, usegmt=True),
+    }
+    media_type = mimetypes.guess_type(path)[0] or 'text/plain'
+    if media_type.startswith('text/'):
+        media_type += '; charset=utf-8'
+
+    # представление выбирается до проверки условий: у сжатого свой ETag, диапазоны отдаются без сжатия
+    range_header = request.headers.get('range')
+    compressible = size >= MIN_GZIP_SIZE and is_text_file(path)
+    compress = compressible and range_header is None and _accepts_gzip(request)
+    if compressible:
+        headers['vary'] = 'Accept-Encoding'
+    if compress:
+        headers['etag'] = gzip_etag(etag)
+
+    if _not_modified(request, stat, headers['etag']):
+        return Response(status_code=304, headers=headers)
+
+    byte_range = None
+    if_range = request.headers.get('if-range')
+    if range_header is not None and size > 0 and (if_range is None or if_range.strip() == etag):
+        try:
+            byte_range = parse_range(range_header, size)
+        except RangeNotSatisfiable:
+            return Response(status_code=416, headers={**headers, 'content-range': f'bytes */{size}'})
+
+    if byte_range is not None:
+        start, end = byte_range
+        headers['content-range'] = f'bytes {start}-{end}/{size}'
+        headers['content-length'] = str(end - start + 1)
+        return StreamingResponse(
+            read_chunks(path, start, end - start + 1),
+            status_code=206,
+            headers=headers,
+            media_type=media_type
+        )
+
+    chunks = read_chunks(path, 0, size)
+    if compress:
+        headers['content-encoding'] = 'gzip'
+        return StreamingResponse(gzip_chunks(chunks), headers=headers, media_type=media_type)
+    headers['content-length'] = str(size)
+    return StreamingResponse(chunks, headers=headers, media_type=media_type)
+
+
+# Последние n строк файла текстом
+async def tail_response(request: Request, path: str, n: int) -> Response:
+    data = await asyncio.to_thread(tail, path, min(n, MAX_TAIL_LINES))
+    headers = {}
+    if len(data) >= MIN_GZIP_SIZE and _accepts_gzip(request):
+        data = await asyncio.to_thread(gzip.compress, data, 6)
+        headers = {'content-encoding': 'gzip', 'vary': 'Accept-Encoding'}
+    return Response(data, headers=headers, media_type='text/plain; charset=utf-8')
+
+
+# Server-Sent Events: сначала последние n строк, затем строки, дописываемые в файл
+async def follow_response(path: str, n: int = 0) -> Response:
+    async def events() -> AsyncIterator[str]:
+        size = (await asyncio.to_thread(os.stat, path)).st_size
+        if n:
+            data = await asyncio.to_thread(tail, path, min(n, MAX_TAIL_LINES))
+            for line in data.decode('utf-8', errors='replace').splitlines():
+                yield f'data: {line}\n\n'
+        async for line in follow(path, size):
+            yield f'data: {line}\n\n'
+
+    return StreamingResponse(
+        events(),
+        media_type='text/event-stream',
+        headers={'cache-control': 'no-cache'}
+    )
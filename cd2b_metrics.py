@@ -0,0 +1,238 @@
+import bisect
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional, Sequence
+
+# границы корзин гистограмм по умолчанию, в секундах
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+# метка для запросов, не попавших ни в одну ручку: сырой путь дал бы неограниченное число рядов
+UNMATCHED_PATH = 'unmatched'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    """Монотонно растущий счетчик с метками.
+
+    inc - одно обращение к словарю; текст для Prometheus собирается только в render.
+    """
+
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values: str) -> float:
+        return self._values.get(label_values, 0)
+
+    def samples(self) -> Iterator[str]:
+        for label_values, value in sorted(self._values.items()):
+            yield f'{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}'
+
+
+class _HistogramSeries:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, size: int):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram:
+    """Гистограмма с метками и фиксированными корзинами.
+
+    В каждой корзине хранится число попавших именно в нее наблюдений,
+    накопленные значения считаются только при выгрузке.
+    """
+
+    type = 'histogram'
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple, _HistogramSeries] = {}
+
+    def observe(self, value: float, *label_values: str):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = _HistogramSeries(len(self.buckets) + 1)
+        series.counts[bisect.bisect_left(self.buckets, value)] += 1
+        series.sum += value
+        series.count += 1
+
+    # замеряет время выполнения блока, в том числе с await внутри
+    @contextmanager
+    def time(self, *label_values: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def count(self, *label_values: str) -> int:
+        series = self._series.get(label_values)
+        return series.count if series is not None else 0
+
+    def samples(self) -> Iterator[str]:
+        for label_values, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), series.counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f'{self.name}_bucket{_format_labels(self.labels, label_values, le)} {cumulative}'
+            labels = _format_labels(self.labels, label_values)
+            yield f'{self.name}_sum{labels} {_format_value(series.sum)}'
+            yield f'{self.name}_count{labels} {series.count}'
+
+
+class Registry:
+    """Набор метрик процесса, выгружаемый в текстовом формате Prometheus."""
+
+    def __init__(self):
+        self._metrics: dict[str, Counter | Histogram] = {}
+
+    def register(self, metric: Counter | Histogram):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric '{metric.name}' is already registered.")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+sql_query_seconds = registry.histogram(
+    'cd2b_sql_query_duration_seconds', 'Time spent executing a query file.', ['file']
+)
+sql_query_errors = registry.counter(
+    'cd2b_sql_query_errors_total', 'Query files that raised an error.', ['file']
+)
+subprocess_seconds = registry.histogram(
+    'cd2b_subprocess_duration_seconds', 'Run time of external docker and git commands.', ['program', 'command']
+)
+docker_api_seconds = registry.histogram(
+    'cd2b_docker_api_duration_seconds', 'Docker Engine API request time by operation.', ['operation']
+)
+github_checks = registry.counter(
+    'cd2b_github_checks_total', 'GitHub repository reachability checks by result.', ['result']
+)
+github_check_seconds = registry.histogram(
+    'cd2b_github_check_duration_seconds', 'Time spent on network requests checking GitHub repositories.'
+)
+websocket_frames = registry.counter(
+    'cd2b_websocket_frames_total', 'Log frames sent to websocket clients.'
+)
+websocket_bytes = registry.counter(
+    'cd2b_websocket_bytes_sent_total', 'Bytes of log frames sent to websocket clients.'
+)
+http_request_seconds = registry.histogram(
+    'cd2b_http_request_duration_seconds', 'HTTP request latency by route.', ['method', 'path', 'status']
+)
+
+
+# Метки подпроцесса по его аргументам: программа и подкоманда без флагов,
+# например ('docker', 'build') или ('git', 'rev-parse')
+def subprocess_labels(args: Sequence[str]) -> tuple[str, str]:
+    if not args:
+        return '', ''
+    program = os.path.basename(args[0])
+    command = next((arg for arg in args[1:] if not arg.startswith('-')), '')
+    return program, command
+
+
+# Замеряет время внешней команды; command - список аргументов или shell-строка
+def track_subprocess(command: str | Sequence[str]):
+    args = command.split() if isinstance(command, str) else command
+    return subprocess_seconds.time(*subprocess_labels(args))
+
+
+class RequestMetricsMiddleware:
+    """ASGI middleware, замеряющий время HTTP-запросов.
+
+    Путь в метке - шаблон ручки (/logs/{files_path:path}), а не сырой url.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._paths: dict[object, str] = {}
+
+    def _path(self, scope) -> str:
+        endpoint = scope.get('endpoint')
+        if endpoint is None:
+            return UNMATCHED_PATH
+        path = self._paths.get(endpoint)
+        if path is None:
+            for route in scope['app'].routes:
+                if getattr(route, 'endpoint', None) is not None:
+                    self._paths[route.endpoint] = route.path
+            path = self._paths.get(endpoint, UNMATCHED_PATH)
+        return path
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status_code: Optional[int] = None
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_request_seconds.observe(
+                time.perf_counter() - start,
+                scope['method'],
+                self._path(scope),
+                str(status_code or 500)
+            )
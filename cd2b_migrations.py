@@ -0,0 +1,138 @@
+import os
+import re
+from typing import Awaitable, Callable, NamedTuple, Optional
+
+import aiosqlite
+
+from cd2b_queries import Statement, parse_statements
+
+MIGRATIONS_PATH = './query/migrations'
+
+# имя файла миграции: <версия>-<описание>.sql, например 001-create-tables.sql
+MIGRATION_FILE_PATTERN = re.compile(r'^(\d+)-[\w-]+\.sql$')
+# имя профиля - ^[a-zA-Z_][a-zA-Z0-9_]{0,61}$, переименованное имя не должно быть длиннее
+MAX_PROFILE_NAME_LENGTH = 62
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    statements: tuple[Statement, ...]
+
+
+_migrations: Optional[list[Migration]] = None
+
+
+# Читает миграции из MIGRATIONS_PATH, упорядоченные по версии
+def load_migrations(path: str = MIGRATIONS_PATH) -> list[Migration]:
+    migrations = []
+    for file_name in os.listdir(path):
+        match = MIGRATION_FILE_PATTERN.match(file_name)
+        if match is None:
+            continue
+        with open(os.path.join(path, file_name), 'r') as file:
+            statements = parse_statements(file.read())
+        migrations.append(Migration(int(match.group(1)), file_name, statements))
+    migrations.sort(key=lambda migration: migration.version)
+    return migrations
+
+
+def migrations() -> list[Migration]:
+    global _migrations
+    if _migrations is None:
+        _migrations = load_migrations()
+    return _migrations
+
+
+# Переименовывает дубликаты column в table: первая запись с каждым именем остается как есть,
+# к остальным добавляется суффикс _<номер>, которого еще нет в таблице (начиная с id записи).
+# Имя обрезается так, чтобы с суффиксом уложиться в max_length. Переименования записываются
+# в renamed_names: файлы профилей (repos/, PROPERTIES/) и папки пользователей лежат под старыми именами
+async def rename_duplicates(db: aiosqlite.Connection, table: str, column: str, max_length: Optional[int] = None):
+    cursor = await db.execute(
+        f'SELECT id, {column} FROM {table} '
+        f'WHERE id NOT IN (SELECT MIN(id) FROM {table} GROUP BY {column}) ORDER BY id'
+    )
+    duplicates = await cursor.fetchall()
+    await cursor.close()
+    if not duplicates:
+        return
+    cursor = await db.execute(f'SELECT {column} FROM {table}')
+    taken = {row[0] for row in await cursor.fetchall()}
+    await cursor.close()
+    for record_id, name in duplicates:
+        number = record_id
+        while True:
+            suffix = f'_{number}'
+            new_name = (name if max_length is None else name[:max_length - len(suffix)]) + suffix
+            if new_name not in taken:
+                break
+            number += 1
+        taken.add(new_name)
+        await db.execute(f'UPDATE {table} SET {column} = ? WHERE id = ?', (new_name, record_id))
+        await db.execute(
+            'INSERT INTO renamed_names (table_name, record_id, old_name, new_name) VALUES (?, ?, ?, ?)',
+            (table, record_id, name, new_name)
+        )
+        # TODO: do logging
+        print(f"duplicate {table}.{column} '{name}' (id {record_id}) renamed to '{new_name}'; "
+              f"its files stay under the old name")
+
+
+# перед 002-unique-names.sql: уникальные индексы не создадутся, пока есть дубликаты
+async def rename_duplicate_names(db: aiosqlite.Connection):
+    await db.execute(
+        'CREATE TABLE IF NOT EXISTS renamed_names ('
+        'table_name TEXT NOT NULL, '
+        'record_id INTEGER NOT NULL, '
+        'old_name TEXT NOT NULL, '
+        'new_name TEXT NOT NULL, '
+        'renamed_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP)'
+    )
+    await rename_duplicates(db, 'profiles', 'name', MAX_PROFILE_NAME_LENGTH)
+    await rename_duplicates(db, 'users', 'login')
+
+
+# шаги на Python, которые выполняются в транзакции миграции перед ее SQL: версия -> шаг
+BEFORE_MIGRATION: dict[int, Callable[[aiosqlite.Connection], Awaitable[None]]] = {
+    2: rename_duplicate_names,
+}
+
+
+async def schema_version(db: aiosqlite.Connection) -> int:
+    cursor = await db.execute('SELECT MAX(version) FROM schema_version')
+    row = await cursor.fetchone()
+    await cursor.close()
+    return row[0] or 0
+
+
+# Доводит схему БД до последней версии; каждая миграция применяется в своей транзакции.
+# Возвращает версию схемы после применения
+async def migrate(db: aiosqlite.Connection) -> int:
+    await db.execute(
+        'CREATE TABLE IF NOT EXISTS schema_version ('
+        'version INTEGER PRIMARY KEY, '
+        'name TEXT NOT NULL, '
+        'applied_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP)'
+    )
+    current = await schema_version(db)
+    for migration in migrations():
+        if migration.version <= current:
+            continue
+        await db.execute('BEGIN')
+        try:
+            before = BEFORE_MIGRATION.get(migration.version)
+            if before is not None:
+                await before(db)
+            for statement in migration.statements:
+                await db.execute(statement.sql)
+            await db.execute(
+                'INSERT INTO schema_version (version, name) VALUES (?, ?)',
+                (migration.version, migration.name)
+            )
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        current = migration.version
+    return current
@@ -0,0 +1,380 @@
+import asyncio
+import codecs
+import json
+import os
+import time
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, NamedTuple, Optional, Sequence
+
+from fastapi import WebSocket
+
+import cd2b_metrics
+
+STDOUT = 'stdout'
+STDERR = 'stderr'
+
+# размер куска, читаемого из пайпа процесса за раз
+READ_CHUNK_SIZE = 64 * 1024
+# как часто отправлять накопленный вывод одним фреймом, в секундах
+FRAME_INTERVAL = 0.05
+# максимальный размер текста в одном фрейме
+MAX_FRAME_SIZE = 16 * 1024
+# строка длиннее этого отдается как законченная, даже если в ней нет перевода строки
+MAX_LINE_LENGTH = 64 * 1024
+# сколько вывода можно накопить, пока клиент не успевает его забирать;
+# дальше чтение вывода процесса приостанавливается
+MAX_BUFFERED_OUTPUT = 256 * 1024
+# дублировать вывод сборок в консоль сервера; полный лог сборки и так пишется в файл
+PRINT_BUILD_OUTPUT = os.environ.get('CD2B_PRINT_BUILD_OUTPUT', '').lower() in ('1', 'true', 'yes')
+
+
+class LineSplitter:
+    """Инкрементально режет поток байт на строки.
+
+    feed возвращает список (text, is_new_line): законченные строки идут с
+    is_new_line=True, незаконченный хвост (например, прогресс-бар) - с False.
+    Для хвоста с \\r отдается только текст после последнего \\r, как его
+    увидел бы терминал.
+    """
+
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._tail = ''
+        self._sent_partial = ''
+
+    def _partial(self) -> list[tuple[str, bool]]:
+        partial = self._tail.rsplit('\r', 1)[-1].strip()
+        if not partial or partial == self._sent_partial:
+            return []
+        self._sent_partial = partial
+        return [(partial, False)]
+
+    def feed(self, data: bytes) -> list[tuple[str, bool]]:
+        lines = (self._tail + self._decoder.decode(data)).split('\n')
+        self._tail = lines.pop()
+        result = []
+        for line in lines:
+            # \r\n - обычный конец строки, остальные \r перезаписывают строку
+            line = line.rstrip('\r').rsplit('\r', 1)[-1].strip()
+            if line:
+                result.append((line, True))
+        if len(self._tail) > MAX_LINE_LENGTH:
+            lines.append(self._tail)
+            result.append((self._tail, True))
+            self._tail = ''
+        if lines:
+            self._sent_partial = ''
+        return result + self._partial()
+
+    # дочитывает остаток после конца потока
+    def close(self) -> list[tuple[str, bool]]:
+        tail = (self._tail + self._decoder.decode(b'', final=True)).rstrip('\r').rsplit('\r', 1)[-1].strip()
+        self._tail = ''
+        return [(tail, True)] if tail else []
+
+
+class FrameCoalescer:
+    """Копит строки вывода и отправляет их фреймами раз в interval секунд
+    или как только набралось max_frame_size текста.
+
+    Из прогресса (is_new_line=False) отправляется только последнее состояние.
+    Если отправка не успевает и накоплено больше max_buffered, add ждет,
+    пока накопленное не заберут, - так медленный клиент тормозит чтение
+    вывода, а не раздувает память сервера.
+    """
+
+    def __init__(self,
+                 send: Callable[[dict], Awaitable],
+                 interval: float = FRAME_INTERVAL,
+                 max_frame_size: int = MAX_FRAME_SIZE,
+                 max_buffered: int = MAX_BUFFERED_OUTPUT):
+        self._send = send
+        self.interval = interval
+        self.max_frame_size = max_frame_size
+        self.max_buffered = max_buffered
+        self._lines: list[str] = []
+        self._partial: Optional[str] = None
+        self._size = 0
+        self._has_data = asyncio.Event()
+        self._frame_full = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._closed = False
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    # отправляет все накопленное и останавливает отправку
+    async def close(self):
+        self._closed = True
+        self._has_data.set()
+        self._frame_full.set()
+        await self._task
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    async def add(self, text: str, is_new_line: bool = True):
+        if is_new_line:
+            self._lines.append(text)
+            self._partial = None
+            self._size += len(text) + 1
+        else:
+            self._partial = text
+        self._has_data.set()
+        if self._size >= self.max_frame_size:
+            self._frame_full.set()
+        if self._size >= self.max_buffered:
+            self._drained.clear()
+            await self._drained.wait()
+
+    # строки длиннее max_frame_size режутся на куски, чтобы ни один фрейм не превышал max_frame_size
+    def _pieces(self, lines: list[str]):
+        for line in lines:
+            if len(line) <= self.max_frame_size:
+                yield line
+                continue
+            for start in range(0, len(line), self.max_frame_size):
+                yield line[start:start + self.max_frame_size]
+
+    def _frames(self, lines: list[str], partial: Optional[str]) -> list[dict]:
+        frames = []
+        chunk, chunk_size = [], 0
+        for line in self._pieces(lines):
+            if chunk and chunk_size + len(line) > self.max_frame_size:
+                frames.append({"message": '\n'.join(chunk), "is_new_line": True})
+                chunk, chunk_size = [], 0
+            chunk.append(line)
+            chunk_size += len(line) + 1
+        if chunk:
+            frames.append({"message": '\n'.join(chunk), "is_new_line": True})
+        if partial is not None:
+            # от слишком длинного прогресса показываем конец, как терминал
+            frames.append({"message": partial[-self.max_frame_size:], "is_new_line": False})
+        return frames
+
+    async def _run(self):
+        while True:
+            await self._has_data.wait()
+            if not self._closed:
+                try:
+                    await asyncio.wait_for(self._frame_full.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._has_data.clear()
+            self._frame_full.clear()
+            lines, partial = self._lines, self._partial
+            self._lines, self._partial, self._size = [], None, 0
+            self._drained.set()
+
+            for frame in self._frames(lines, partial):
+                await self._send(frame)
+
+            if self._closed and not self._lines and self._partial is None:
+                return
+
+
+class LogLine(NamedTuple):
+    stream: str  # stdout или stderr
+    text: str
+    is_new_line: bool  # False - незаконченная строка (прогресс), следующая ее перезапишет
+    time: float
+
+
+class LogConsumer:
+    """Получатель строк вывода процесса. write вызывается по порядку для
+    каждой строки, close - один раз после завершения процесса."""
+
+    async def write(self, line: LogLine):
+        pass
+
+    async def close(self):
+        pass
+
+
+class PrintLogConsumer(LogConsumer):
+    """Печатает законченные строки в консоль сервера. Печать по строке дорогая,
+    поэтому в сборках используется только при CD2B_PRINT_BUILD_OUTPUT."""
+
+    # TODO: do logging
+    async def write(self, line: LogLine):
+        if line.is_new_line:
+            print(line.text)
+
+
+class WebSocketLogConsumer(LogConsumer):
+    """Отправляет вывод по вебсокету склеенными фреймами (см. FrameCoalescer).
+    Если клиент отключился, вывод ему больше не отправляется, а процесс продолжает работу."""
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.alive = True
+        self._frames: Optional[FrameCoalescer] = None
+
+    async def _send(self, frame: dict):
+        if not self.alive:
+            return
+        # сериализуем сами, как send_json, чтобы знать размер фрейма
+        text = json.dumps(frame, separators=(',', ':'), ensure_ascii=False)
+        try:
+            await self.websocket.send_text(text)
+        except Exception:
+            self.alive = False
+            return
+        cd2b_metrics.websocket_frames.inc()
+        cd2b_metrics.websocket_bytes.inc(amount=len(text.encode('utf-8')))
+
+    async def write(self, line: LogLine):
+        if self._frames is None:
+            self._frames = FrameCoalescer(self._send)
+            self._frames.start()
+        await self._frames.add(line.text, line.is_new_line)
+
+    async def close(self):
+        if self._frames is not None:
+            await self._frames.close()
+
+
+class TailLogConsumer(LogConsumer):
+    """Помнит последние size законченных строк, например для сообщения об ошибке."""
+
+    def __init__(self, size: int = 20):
+        self.lines: deque[str] = deque(maxlen=size)
+
+    async def write(self, line: LogLine):
+        if line.is_new_line:
+            self.lines.append(line.text)
+
+    def text(self) -> str:
+        return '\n'.join(self.lines)
+
+
+class ProcessFailedError(Exception):
+    """Исключение для случаев, когда процесс завершился с ненулевым кодом."""
+
+    def __init__(self, command: str, returncode: int, output_tail: str = ''):
+        self.command = command
+        self.returncode = returncode
+        self.output_tail = output_tail
+        self.msg = f"'{command}' failed with exit code {returncode}."
+        if output_tail:
+            self.msg += f" Last output:\n{output_tail}"
+        super().__init__(self.msg)
+
+
+# сколько строк вывода может ждать получателей; дальше чтение пайпов приостанавливается
+MAX_QUEUED_LINES = 1024
+
+
+# Убивает процесс, если он еще жив, и дожидается его завершения, чтобы не оставить зомби
+async def kill(process: asyncio.subprocess.Process):
+    if process.returncode is None:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+    await process.wait()
+
+
+# Читает stdout и stderr процесса одновременно и кладет строки обоих потоков в queue
+# в порядке поступления. Ошибка чтения любого из пайпов пробрасывается
+async def read_output(process: asyncio.subprocess.Process, queue: asyncio.Queue):
+    async def read(stream: asyncio.StreamReader, name: str):
+        splitter = LineSplitter()
+        while chunk := await stream.read(READ_CHUNK_SIZE):
+            for text, is_new_line in splitter.feed(chunk):
+                await queue.put(LogLine(name, text, is_new_line, time.time()))
+        for text, is_new_line in splitter.close():
+            await queue.put(LogLine(name, text, is_new_line, time.time()))
+
+    readers = [
+        asyncio.create_task(read(stream, name))
+        for stream, name in ((process.stdout, STDOUT), (process.stderr, STDERR))
+        if stream is not None
+    ]
+    try:
+        await asyncio.gather(*readers)
+    finally:
+        for task in readers:
+            task.cancel()
+
+
+# Отдает строки вывода процесса (см. read_output) каждому из consumers. Дожидается завершения процесса
+# и возвращает его код возврата. Если pump отменили (например, клиент отключился
+# от запроса, который ждет сборку), процесс убивается
+async def pump(process: asyncio.subprocess.Process, consumers: Sequence[LogConsumer]) -> int:
+    queue: asyncio.Queue = asyncio.Queue(maxsize=MAX_QUEUED_LINES)
+    consumers = list(consumers)
+
+    async def dispatch():
+        while (line := await queue.get()) is not None:
+            for consumer in list(consumers):
+                try:
+                    await consumer.write(line)
+                except Exception as e:
+                    # сломанный получатель не должен останавливать процесс и остальных получателей
+                    print(f'log consumer {consumer} failed: {e}')
+                    consumers.remove(consumer)
+
+    reader = asyncio.create_task(read_output(process, queue))
+    dispatcher = asyncio.create_task(dispatch())
+    try:
+        await reader
+        await queue.put(None)
+        await dispatcher
+        return await process.wait()
+    except BaseException:
+        for task in (reader, dispatcher):
+            task.cancel()
+        await kill(process)
+        raise
+    finally:
+        for consumer in consumers:
+            try:
+                await consumer.close()
+            except Exception as e:
+                print(f'log consumer {consumer} failed to close: {e}')
+
+
+# Отдает вывод процесса (stdout и stderr в порядке поступления) пачками строк:
+# каждая пачка - все, что успело накопиться, но не больше max_batch строк.
+# Пока получатель не забрал строки, пайпы не читаются и процесс упирается в них.
+# Процесс не завершается - это дело вызывающего. Ошибка чтения пайпов пробрасывается
+# после того, как отданы все прочитанные до нее строки
+async def iter_line_batches(process: asyncio.subprocess.Process,
+                            max_batch: int = MAX_QUEUED_LINES) -> AsyncIterator[list[LogLine]]:
+    queue: asyncio.Queue = asyncio.Queue(maxsize=MAX_QUEUED_LINES)
+
+    async def read_all():
+        try:
+            await read_output(process, queue)
+        except asyncio.CancelledError:
+            raise
+        except BaseException:
+            # конец вывода; саму ошибку получатель увидит из await reader
+            await queue.put(None)
+            raise
+        await queue.put(None)
+
+    reader = asyncio.create_task(read_all())
+    try:
+        while True:
+            line = await queue.get()
+            batch = []
+            while line is not None:
+                batch.append(line)
+                if len(batch) >= max_batch or queue.empty():
+                    break
+                line = queue.get_nowait()
+            if batch:
+                yield batch
+            if line is None:
+                break
+        await reader
+    finally:
+        reader.cancel()
@@ -0,0 +1,182 @@
+import asyncio
+import os
+import re
+import secrets
+import threading
+from typing import Mapping, NamedTuple, Optional
+
+KEY_PATTERN = re.compile(r'^[a-zA-Z0-9._-]+$')
+
+
+# проверяет формат ключа пропертей, возвращает ключ без пробелов по краям
+def validate_key(key: str) -> str:
+    key = key.strip()
+    if not KEY_PATTERN.match(key):
+        raise ValueError('Incorrect key format.')
+    return key
+
+
+# проверяет значение пропертей: перевод строки дописал бы в файл лишние строки
+# (например, второй server.port), возвращает значение строкой без пробелов по краям
+def validate_value(value) -> str:
+    value = str(value).strip()
+    if '\n' in value or '\r' in value:
+        raise ValueError('Property values must not contain line breaks.')
+    return value
+
+
+class Properties:
+    """Разобранный application.properties.
+
+    Хранит строки файла как есть (комментарии, пустые строки и порядок сохраняются)
+    и индекс ключ -> номер строки, поэтому чтение и замена значения не сканируют файл.
+    """
+
+    def __init__(self, lines: list[str]):
+        self.lines = lines
+        self._index: dict[str, int] = {}
+        for i, line in enumerate(lines):
+            stripped = line.strip()
+            if stripped == '' or stripped.startswith('#') or '=' not in stripped:
+                continue
+            # как и раньше, меняется первое вхождение ключа
+            self._index.setdefault(stripped.split('=', 1)[0].strip(), i)
+
+    @staticmethod
+    def parse(text: str) -> 'Properties':
+        return Properties(text.splitlines(keepends=True))
+
+    def get(self, key: str) -> Optional[str]:
+        i = self._index.get(key)
+        if i is None:
+            return None
+        return self.lines[i].split('=', 1)[1].strip()
+
+    # устанавливает значение, возвращает True если файл изменился
+    def set(self, key: str, value) -> bool:
+        value = validate_value(value)
+        line = f'{key}={value}\n'
+        i = self._index.get(key)
+        if i is not None:
+            if self.lines[i] == line:
+                return False
+            self.lines[i] = line
+            return True
+        if self.lines and not self.lines[-1].endswith('\n'):
+            self.lines[-1] += '\n'
+        self._index[key] = len(self.lines)
+        self.lines.append(line)
+        return True
+
+    def update(self, values: Mapping[str, object]) -> bool:
+        changed = False
+        for key, value in values.items():
+            changed = self.set(key, value) or changed
+        return changed
+
+    def copy(self) -> 'Properties':
+        return Properties(list(self.lines))
+
+    def render(self) -> str:
+        return ''.join(self.lines)
+
+
+class _Entry(NamedTuple):
+    mtime_ns: int
+    size: int
+    properties: Properties
+
+
+# создает временный файл рядом с файлом пропертей. Права 0666 урезает umask процесса,
+# как у open() (mkstemp создал бы 0600, а файл монтируется в контейнер)
+def _create_temp_file(directory: str) -> tuple[int, str]:
+    while True:
+        tmp_path = os.path.join(directory, f'.tmp-{secrets.token_hex(8)}.properties')
+        try:
+            return os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666), tmp_path
+        except FileExistsError:
+            continue
+
+
+# атомарно записывает файл: пишем во временный файл рядом и переименовываем поверх.
+# Права существующего файла сохраняются
+def atomic_write(path: str, data: bytes):
+    directory = os.path.dirname(path) or '.'
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = None
+    fd, tmp_path = _create_temp_file(directory)
+    try:
+        if mode is not None:
+            os.fchmod(fd, mode)
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class PropertiesCache:
+    """Кэш разобранных файлов пропертей с проверкой mtime и размера файла.
+
+    Изменения применяются пачкой к копии модели и записываются одной атомарной
+    записью; чтение-изменение-запись одного файла сериализуется блокировкой,
+    поэтому параллельные пачки не теряют изменения друг друга.
+    """
+
+    def __init__(self):
+        self._entries: dict[str, _Entry] = {}
+        self._locks: dict[str, threading.Lock] = {}
+        self._guard = threading.Lock()
+
+    def _lock(self, path: str) -> threading.Lock:
+        with self._guard:
+            return self._locks.setdefault(path, threading.Lock())
+
+    def _load(self, path: str) -> Properties:
+        stat = os.stat(path)
+        entry = self._entries.get(path)
+        if entry is not None and entry.mtime_ns == stat.st_mtime_ns and entry.size == stat.st_size:
+            return entry.properties
+        with open(path, 'r', encoding='utf-8') as file:
+            properties = Properties.parse(file.read())
+        self._entries[path] = _Entry(stat.st_mtime_ns, stat.st_size, properties)
+        return properties
+
+    def _save(self, path: str, properties: Properties):
+        atomic_write(path, properties.render().encode('utf-8'))
+        stat = os.stat(path)
+        self._entries[path] = _Entry(stat.st_mtime_ns, stat.st_size, properties)
+
+    def _update(self, path: str, values: Mapping[str, object]) -> Properties:
+        with self._lock(path):
+            properties = self._load(path).copy()
+            if properties.update(values):
+                self._save(path, properties)
+            return properties
+
+    def _write(self, path: str, data: bytes):
+        with self._lock(path):
+            atomic_write(path, data)
+            self._entries.pop(path, None)
+
+    # модель файла; возвращаемый объект менять нельзя - он общий для всех читателей
+    async def load(self, path: str) -> Properties:
+        return await asyncio.to_thread(self._load, path)
+
+    # применяет values к файлу, пишет его только если что-то поменялось
+    async def update(self, path: str, values: Mapping[str, object]) -> Properties:
+        return await asyncio.to_thread(self._update, path, values)
+
+    # заменяет файл целиком
+    async def write(self, path: str, data: bytes):
+        await asyncio.to_thread(self._write, path, data)
+
+    def invalidate(self, path: str):
+        self._entries.pop(path, None)
+
+
+cache = PropertiesCache()
@@ -0,0 +1,75 @@
+import os
+from typing import NamedTuple, Optional
+
+# запросы, которые возвращают строки; остальные считаются изменяющими и коммитятся
+READ_KEYWORDS = ('select', 'with', 'pragma', 'explain')
+
+
+class Statement(NamedTuple):
+    sql: str
+    is_read: bool
+
+
+class Query(NamedTuple):
+    name: str
+    statements: tuple[Statement, ...]
+    mtime: float
+
+
+# Убирает строки-комментарии, оставляя только текст запроса
+def strip_comments(sql: str) -> str:
+    lines = [line for line in sql.splitlines() if not line.strip().startswith('--')]
+    return '\n'.join(lines).strip()
+
+
+# Разбивает содержимое .sql файла на отдельные запросы и классифицирует их
+def parse_statements(content: str) -> tuple[Statement, ...]:
+    statements = []
+    for chunk in content.split(';'):
+        sql = chunk.strip()
+        body = strip_comments(sql)
+        if not body:
+            continue
+        keyword = body.split(None, 1)[0].lower()
+        statements.append(Statement(sql=sql, is_read=keyword in READ_KEYWORDS))
+    return tuple(statements)
+
+
+class QueryRegistry:
+    """Реестр .sql запросов из папки path.
+
+    Файлы читаются и разбираются один раз. В режиме hot_reload при каждом
+    обращении проверяется mtime файла, и изменившийся файл перечитывается.
+    """
+
+    def __init__(self, path: str, hot_reload: bool = False):
+        self.path = path
+        self.hot_reload = hot_reload
+        self._queries: dict[str, Query] = {}
+
+    # загружает все .sql файлы из папки
+    def load(self):
+        queries = {}
+        for entry in os.scandir(self.path):
+            if entry.is_file() and entry.name.endswith('.sql'):
+                queries[entry.name] = self._read(entry.name)
+        self._queries = queries
+
+    def _read(self, name: str) -> Query:
+        file_path = os.path.join(self.path, name)
+        mtime = os.stat(file_path).st_mtime
+        with open(file_path, 'r') as file:
+            content = file.read()
+        return Query(name=name, statements=parse_statements(content), mtime=mtime)
+
+    # возвращает разобранный запрос по имени файла (без пути)
+    def get(self, name: str) -> Query:
+        query: Optional[Query] = self._queries.get(name)
+        if query is None:
+            query = self._queries[name] = self._read(name)
+        elif self.hot_reload and os.stat(os.path.join(self.path, name)).st_mtime != query.mtime:
+            query = self._queries[name] = self._read(name)
+        return query
+
+    def names(self) -> list[str]:
+        return sorted(self._queries)
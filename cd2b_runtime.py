@@ -0,0 +1,789 @@
+import abc
+import asyncio
+import contextlib
+import json
+import os
+import posixpath
+import re
+import tarfile
+import tempfile
+import time
+from datetime import datetime
+from typing import AsyncContextManager, AsyncIterator, NamedTuple, Optional, Sequence
+from urllib.parse import quote
+
+import httpx
+
+import cd2b_containers
+import cd2b_metrics
+import cd2b_process
+from cd2b_containers import ContainerInfo
+
+# cli - docker CLI; api - Docker Engine API через сокет; auto - API, если сокет доступен, иначе CLI; fake.
+# По умолчанию CLI: сборку через API (классический builder, без BuildKit) включают явно
+CONTAINER_RUNTIME = os.environ.get('CD2B_CONTAINER_RUNTIME', 'cli')
+DOCKER_SOCKET = os.environ.get('CD2B_DOCKER_SOCKET', '/var/run/docker.sock')
+DOCKER_API_VERSION = os.environ.get('CD2B_DOCKER_API_VERSION', 'v1.41')
+# таймаут запросов к Docker Engine API, кроме сборки (она ограничена только временем сборки)
+DOCKER_API_TIMEOUT = float(os.environ.get('CD2B_DOCKER_API_TIMEOUT', 60))
+# размер куска контекста сборки, отправляемого в /build
+BUILD_CONTEXT_CHUNK_SIZE = 256 * 1024
+# до этого размера tar контекста сборки держится в памяти, дальше - во временном файле
+BUILD_CONTEXT_MAX_MEMORY = 16 * 1024 * 1024
+# эти файлы docker CLI отправляет в контекст сборки, даже если они есть в .dockerignore
+ALWAYS_SENT_FILES = frozenset({'Dockerfile', '.dockerignore'})
+# длительность в формате docker (10m, 1h30m) для since/until логов
+DURATION_PATTERN = re.compile(r'^(?:\d+(?:\.\d+)?(?:ns|us|µs|ms|s|m|h))+$')
+DURATION_UNITS = {'ns': 1e-9, 'us': 1e-6, 'µs': 1e-6, 'ms': 1e-3, 's': 1, 'm': 60, 'h': 60 * 60}
+
+
+class DockerApiError(Exception):
+    """Исключение для ошибочных ответов Docker Engine API.
+
+    status_code равен None, если ответа нет: сокет недоступен, соединение оборвалось или истек таймаут.
+    """
+
+    def __init__(self, operation: str, status_code: Optional[int], message: str = ''):
+        self.operation = operation
+        self.status_code = status_code
+        if status_code is None:
+            self.msg = f"Docker API '{operation}' failed"
+        else:
+            self.msg = f"Docker API '{operation}' failed with status {status_code}"
+        if message:
+            self.msg += f": {message}"
+        super().__init__(self.msg)
+
+
+class ContainerRuntime(abc.ABC):
+    """Операции с образами и контейнерами профилей.
+
+    Реализации: EngineApiRuntime (Docker Engine API через unix-сокет),
+    CliRuntime (docker CLI) и FakeRuntime (в памяти, для тестов).
+    Образы задаются как в docker CLI: repository или repository:tag.
+    """
+
+    @abc.abstractmethod
+    async def image_exists(self, image: str) -> bool:
+        pass
+
+    # теги образа repository, например ['latest', '0123abcd4567-89abcdef0123']
+    @abc.abstractmethod
+    async def image_tags(self, repository: str) -> list[str]:
+        pass
+
+    @abc.abstractmethod
+    async def tag(self, source: str, target: str) -> bool:
+        pass
+
+    # собирает образ из папки context с тегами tags; вывод сборки уходит в consumers, которые в конце закрываются.
+    # Если сборка упала - выбрасывает cd2b_process.ProcessFailedError, если Docker недоступен - DockerApiError
+    @abc.abstractmethod
+    async def build(self,
+                    context: str,
+                    tags: Sequence[str],
+                    build_args: Optional[dict[str, str]] = None,
+                    consumers: Sequence[cd2b_process.LogConsumer] = ()):
+        pass
+
+    # запускает контейнер name из образа image в фоне.
+    # ports - порт контейнера -> порт хоста, volumes - папка хоста -> папка в контейнере
+    @abc.abstractmethod
+    async def run(self,
+                  image: str,
+                  name: str,
+                  ports: Optional[dict[int, int]] = None,
+                  volumes: Optional[dict[str, str]] = None,
+                  auto_remove: bool = True) -> bool:
+        pass
+
+    @abc.abstractmethod
+    async def stop(self, name: str) -> bool:
+        pass
+
+    @abc.abstractmethod
+    async def remove_images(self, images: Sequence[str]) -> bool:
+        pass
+
+    # запущенные контейнеры: имя -> информация. Если список получить не удалось - выбрасывает исключение
+    # (CliRuntime - cd2b_process.ProcessFailedError, EngineApiRuntime - DockerApiError), а не отдает пустой список
+    @abc.abstractmethod
+    async def list_running(self) -> dict[str, ContainerInfo]:
+        pass
+
+    # подписка на события контейнеров: на входе в контекст подписка уже действует,
+    # внутри - поток событий в формате docker events ({"Type", "Action", "Actor": {"Attributes": {"name"}}})
+    @abc.abstractmethod
+    def events(self) -> AsyncContextManager[AsyncIterator[dict]]:
+        pass
+
+    # вывод контейнера пачками законченных строк. follow - ждать новых строк, пока контейнер работает;
+    # since и until - время или длительность в формате docker (2024-01-01T10:00:00, 10m);
+    # tail - сколько последних строк отдать
+    @abc.abstractmethod
+    def container_logs(self,
+                       container_name: str,
+                       follow: bool = False,
+                       since: Optional[str] = None,
+                       until: Optional[str] = None,
+                       tail: Optional[int] = None,
+                       timestamps: bool = False) -> AsyncIterator[list[cd2b_process.LogLine]]:
+        pass
+
+    async def close(self):
+        pass
+
+
+# Отдает строки вывода сборки получателям; сломанный получатель отключается, в конце все закрываются
+async def _broadcast(lines: AsyncIterator[cd2b_process.LogLine], consumers: Sequence[cd2b_process.LogConsumer]):
+    consumers = list(consumers)
+    try:
+        async for line in lines:
+            for consumer in list(consumers):
+                try:
+                    await consumer.write(line)
+                except Exception as e:
+                    print(f'log consumer {consumer} failed: {e}')
+                    consumers.remove(consumer)
+    finally:
+        for consumer in consumers:
+            try:
+                await consumer.close()
+            except Exception as e:
+                print(f'log consumer {consumer} failed to close: {e}')
+
+
+class CliRuntime(ContainerRuntime):
+    """Docker через CLI: по процессу docker на каждую операцию."""
+
+    async def image_exists(self, image: str) -> bool:
+        return await cd2b_containers.image_exists(image)
+
+    async def image_tags(self, repository: str) -> list[str]:
+        return await cd2b_containers.image_tags(repository)
+
+    async def tag(self, source: str, target: str) -> bool:
+        returncode, _ = await cd2b_containers.run_docker('tag', source, target)
+        return returncode == 0
+
+    async def build(self,
+                    context: str,
+                    tags: Sequence[str],
+                    build_args: Optional[dict[str, str]] = None,
+                    consumers: Sequence[cd2b_process.LogConsumer] = ()):
+        args = ['build']
+        for key, value in (build_args or {}).items():
+            args += ['--build-arg', f'{key}={value}']
+        for tag in tags:
+            args += ['-t', tag]
+        args.append('.')
+        command = ' '.join([cd2b_containers.DOCKER_BIN, *args])
+        print(command)
+
+        tail = cd2b_process.TailLogConsumer()
+        with cd2b_metrics.track_subprocess(command):
+            process = await asyncio.create_subprocess_exec(
+                cd2b_containers.DOCKER_BIN, *args,
+                cwd=context,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            returncode = await cd2b_process.pump(process, [*consumers, tail])
+        if returncode != 0:
+            raise cd2b_process.ProcessFailedError(command, returncode, tail.text())
+
+    async def run(self,
+                  image: str,
+                  name: str,
+                  ports: Optional[dict[int, int]] = None,
+                  volumes: Optional[dict[str, str]] = None,
+                  auto_remove: bool = True) -> bool:
+        args = ['run', '-d', '--name', name]
+        if auto_remove:
+            args.append('--rm')
+        for container_port, host_port in (ports or {}).items():
+            args += ['-p', f'{host_port}:{container_port}']
+        for host_path, container_path in (volumes or {}).items():
+            args += ['-v', f'{host_path}:{container_path}']
+        args.append(image)
+
+        # TODO: do logging
+        print('run command:')
+        print(' '.join(['docker', *args]))
+        returncode, _ = await cd2b_containers.run_docker(*args)
+        return returncode == 0
+
+    async def stop(self, name: str) -> bool:
+        returncode, _ = await cd2b_containers.run_docker('stop', name)
+        return returncode == 0
+
+    async def remove_images(self, images: Sequence[str]) -> bool:
+        returncode, _ = await cd2b_containers.run_docker('rmi', *images)
+        return returncode == 0
+
+    async def list_running(self) -> dict[str, ContainerInfo]:
+        return await cd2b_containers.list_running_containers()
+
+    def events(self) -> AsyncContextManager[AsyncIterator[dict]]:
+        return cd2b_containers.docker_events()
+
+    def container_logs(self,
+                       container_name: str,
+                       follow: bool = False,
+                       since: Optional[str] = None,
+                       until: Optional[str] = None,
+                       tail: Optional[int] = None,
+                       timestamps: bool = False) -> AsyncIterator[list[cd2b_process.LogLine]]:
+        return cd2b_containers.container_logs(
+            container_name, follow=follow, since=since, until=until, tail=tail, timestamps=timestamps
+        )
+
+
+class IgnorePattern(NamedTuple):
+    regex: re.Pattern
+    # шаблон с ! - исключение из исключений
+    exclusion: bool
+
+
+# Переводит шаблон .dockerignore в регулярное выражение по правилам docker:
+# * и ? не переходят через /, ** - любое число папок, [...] - класс символов, \ экранирует символ
+def _ignore_regex(pattern: str) -> re.Pattern:
+    result = ''
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith('**/', i):
+            result += '(?:.*/)?'
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            result += '.*'
+            i += 2
+            continue
+        if char == '*':
+            result += '[^/]*'
+        elif char == '?':
+            result += '[^/]'
+        elif char == '\\' and i + 1 < len(pattern):
+            i += 1
+            result += re.escape(pattern[i])
+        elif char == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            chars = pattern[i + 1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            result += f'[{chars}]'
+            i = end
+        else:
+            result += re.escape(char)
+        i += 1
+    return re.compile(f'^{result}$')
+
+
+# Шаблоны .dockerignore в порядке файла; пустые строки и комментарии пропускаются,
+# пути нормализуются как в docker (без ведущего /, без ./ и ..)
+def parse_dockerignore(text: str) -> list[IgnorePattern]:
+    patterns = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        exclusion = line.startswith('!')
+        if exclusion:
+            line = line[1:].strip()
+        line = posixpath.normpath(line)
+        if len(line) > 1 and line.startswith('/'):
+            line = line.lstrip('/')
+        if line == '.':
+            continue
+        patterns.append(IgnorePattern(_ignore_regex(line), exclusion))
+    return patterns
+
+
+def _read_dockerignore(context: str) -> list[IgnorePattern]:
+    path = os.path.join(context, '.dockerignore')
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as file:
+        return parse_dockerignore(file.read())
+
+
+# Исключен ли путь (относительно контекста, через /): побеждает последний подошедший шаблон.
+# Шаблон подходит и к самому пути, и к любой его родительской папке
+def is_ignored(path: str, patterns: Sequence[IgnorePattern]) -> bool:
+    parts = path.split('/')
+    parents = ['/'.join(parts[:i]) for i in range(1, len(parts))]
+    ignored = False
+    for pattern in patterns:
+        # включающий шаблон не меняет уже исключенный путь, исключение - не исключенный
+        if pattern.exclusion != ignored:
+            continue
+        if pattern.regex.match(path) or any(pattern.regex.match(parent) for parent in parents):
+            ignored = not pattern.exclusion
+    return ignored
+
+
+# Упаковывает папку context в tar для /build так же, как docker CLI: без путей из .dockerignore,
+# но Dockerfile и .dockerignore отправляются всегда. В исключенную папку заходим,
+# только если есть шаблоны с ! - они могут вернуть что-то из нее
+def make_build_context(context: str):
+    patterns = _read_dockerignore(context)
+    has_exclusions = any(pattern.exclusion for pattern in patterns)
+
+    archive = tempfile.SpooledTemporaryFile(max_size=BUILD_CONTEXT_MAX_MEMORY)
+    with tarfile.open(fileobj=archive, mode='w') as tar:
+        for directory, dirnames, filenames in os.walk(context):
+            relative = os.path.relpath(directory, context)
+            prefix = '' if relative == '.' else relative.replace(os.sep, '/') + '/'
+            walked = []
+            for name in sorted(dirnames):
+                full_path = os.path.join(directory, name)
+                ignored = is_ignored(prefix + name, patterns)
+                if not ignored:
+                    tar.add(full_path, arcname=prefix + name, recursive=False)
+                # ссылки на папки кладутся как ссылки, внутрь не заходим
+                if not os.path.islink(full_path) and (not ignored or has_exclusions):
+                    walked.append(name)
+            dirnames[:] = walked
+            for name in sorted(filenames):
+                path = prefix + name
+                if path in ALWAYS_SENT_FILES or not is_ignored(path, patterns):
+                    tar.add(os.path.join(directory, name), arcname=path, recursive=False)
+    archive.seek(0)
+    return archive
+
+
+# Время для since/until в Engine API (секунды UNIX) из формата docker CLI: секунды UNIX,
+# длительность назад от текущего момента (10m) или время ISO 8601; время без зоны - местное, как в docker
+def api_timestamp(value: str) -> str:
+    if re.fullmatch(r'\d+(?:\.\d+)?', value):
+        return value
+    if DURATION_PATTERN.match(value):
+        seconds = sum(
+            float(amount) * DURATION_UNITS[unit]
+            for amount, unit in re.findall(r'(\d+(?:\.\d+)?)(ns|us|µs|ms|s|m|h)', value)
+        )
+        return f'{time.time() - seconds:.9f}'
+    return f'{datetime.fromisoformat(value).timestamp():.9f}'
+
+
+# repository:tag -> (repository, tag); без тега - latest, как в docker CLI
+def _split_image(image: str) -> tuple[str, str]:
+    if ':' in image.rsplit('/', 1)[-1]:
+        repository, _, tag = image.rpartition(':')
+        return repository, tag
+    return image, 'latest'
+
+
+class EngineApiRuntime(ContainerRuntime):
+    """Docker Engine HTTP API через unix-сокет.
+
+    Все запросы идут через один httpx-клиент с keep-alive соединениями к сокету,
+    поэтому операция не стоит fork+exec и запуска docker CLI. Вывод сборки
+    приходит потоком JSON-сообщений и сразу уходит получателям.
+    Клиент привязан к event loop, в другом loop создается свой (как в cd2b_http).
+    """
+
+    def __init__(self, socket_path: str = DOCKER_SOCKET, api_version: str = DOCKER_API_VERSION):
+        self.socket_path = socket_path
+        self.api_version = api_version
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client.is_closed or self._client_loop is not loop:
+            self._client = httpx.AsyncClient(
+                transport=httpx.AsyncHTTPTransport(uds=self.socket_path),
+                base_url=f'http://docker/{self.api_version}',
+                timeout=DOCKER_API_TIMEOUT
+            )
+            self._client_loop = loop
+        return self._client
+
+    async def close(self):
+        client, self._client, self._client_loop = self._client, None, None
+        if client is not None and not client.is_closed:
+            await client.aclose()
+
+    # ошибки транспорта (нет сокета, обрыв соединения, таймаут) выбрасываются как DockerApiError
+    async def _request(self, operation: str, method: str, path: str, **kwargs) -> httpx.Response:
+        with cd2b_metrics.docker_api_seconds.time(operation):
+            try:
+                return await self.client().request(method, path, **kwargs)
+            except httpx.TransportError as e:
+                raise DockerApiError(operation, None, str(e) or type(e).__name__) from e
+
+    # как _request, но вместо исключения печатает ошибку и возвращает None;
+    # для операций, которые, как и в CliRuntime, сообщают о неудаче результатом
+    async def _try_request(self, operation: str, method: str, path: str, **kwargs) -> Optional[httpx.Response]:
+        try:
+            return await self._request(operation, method, path, **kwargs)
+        except DockerApiError as e:
+            # TODO: do logging
+            print(e.msg)
+            return None
+
+    @staticmethod
+    def _error(operation: str, response: httpx.Response) -> DockerApiError:
+        try:
+            message = response.json().get('message', '')
+        except ValueError:
+            message = response.text
+        return DockerApiError(operation, response.status_code, message)
+
+    async def image_exists(self, image: str) -> bool:
+        response = await self._try_request('image_inspect', 'GET', f'/images/{quote(image, safe="/:")}/json')
+        return response is not None and response.status_code == 200
+
+    async def image_tags(self, repository: str) -> list[str]:
+        response = await self._try_request(
+            'image_list', 'GET', '/images/json',
+            params={'filters': json.dumps({'reference': [repository]})}
+        )
+        if response is None or response.status_code != 200:
+            return []
+        tags = []
+        for image in response.json():
+            for repo_tag in image.get('RepoTags') or []:
+                repo, _, tag = repo_tag.rpartition(':')
+                if repo == repository and tag and tag != '<none>':
+                    tags.append(tag)
+        return tags
+
+    async def tag(self, source: str, target: str) -> bool:
+        repo, tag = _split_image(target)
+        response = await self._try_request(
+            'image_tag', 'POST', f'/images/{quote(source, safe="/:")}/tag',
+            params={'repo': repo, 'tag': tag}
+        )
+        return response is not None and response.status_code == 201
+
+    async def build(self,
+                    context: str,
+                    tags: Sequence[str],
+                    build_args: Optional[dict[str, str]] = None,
+                    consumers: Sequence[cd2b_process.LogConsumer] = ()):
+        print(f'docker API build {context} -t {" -t ".join(tags)}')
+        archive = await asyncio.to_thread(make_build_context, context)
+        params = [('t', tag) for tag in tags] + [
+            ('buildargs', json.dumps(build_args or {})),
+            ('rm', '1'),
+            ('forcerm', '1'),
+        ]
+        error: Optional[str] = None
+        tail = cd2b_process.TailLogConsumer()
+
+        async def body() -> AsyncIterator[bytes]:
+            while chunk := await asyncio.to_thread(archive.read, BUILD_CONTEXT_CHUNK_SIZE):
+                yield chunk
+
+        async def lines() -> AsyncIterator[cd2b_process.LogLine]:
+            nonlocal error
+            splitter = cd2b_process.LineSplitter()
+            async with self.client().stream(
+                    'POST', '/build',
+                    params=params,
+                    content=body(),
+                    headers={'Content-Type': 'application/x-tar'},
+                    timeout=httpx.Timeout(DOCKER_API_TIMEOUT, read=None)
+            ) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    raise self._error('build', response)
+                async for message_line in response.aiter_lines():
+                    if not message_line.strip():
+                        continue
+                    message = json.loads(message_line)
+                    if 'error' in message:
+                        error = message['error']
+                        text = error + '\n'
+                    else:
+                        text = message.get('stream') or ''
+                    for text, is_new_line in splitter.feed(text.encode()):
+                        yield cd2b_process.LogLine(cd2b_process.STDOUT, text, is_new_line, time.time())
+            for text, is_new_line in splitter.close():
+                yield cd2b_process.LogLine(cd2b_process.STDOUT, text, is_new_line, time.time())
+
+        try:
+            with cd2b_metrics.docker_api_seconds.time('build'):
+                await _broadcast(lines(), [*consumers, tail])
+        except httpx.TransportError as e:
+            raise DockerApiError('build', None, str(e) or type(e).__name__) from e
+        finally:
+            archive.close()
+        if error is not None:
+            raise cd2b_process.ProcessFailedError(f'docker build {context}', 1, tail.text())
+
+    async def run(self,
+                  image: str,
+                  name: str,
+                  ports: Optional[dict[int, int]] = None,
+                  volumes: Optional[dict[str, str]] = None,
+                  auto_remove: bool = True) -> bool:
+        ports = ports or {}
+        config = {
+            'Image': image,
+            'ExposedPorts': {f'{container_port}/tcp': {} for container_port in ports},
+            'HostConfig': {
+                'PortBindings': {
+                    f'{container_port}/tcp': [{'HostPort': str(host_port)}]
+                    for container_port, host_port in ports.items()
+                },
+                'Binds': [f'{host_path}:{container_path}' for host_path, container_path in (volumes or {}).items()],
+                'AutoRemove': auto_remove,
+            },
+        }
+        response = await self._try_request('container_create', 'POST', '/containers/create',
+                                           params={'name': name}, json=config)
+        if response is None:
+            return False
+        if response.status_code != 201:
+            # TODO: do logging
+            print(self._error('container_create', response).msg)
+            return False
+        container_id = response.json()['Id']
+        response = await self._try_request('container_start', 'POST', f'/containers/{container_id}/start')
+        if response is None:
+            return False
+        if response.status_code not in (204, 304):
+            print(self._error('container_start', response).msg)
+            return False
+        return True
+
+    async def stop(self, name: str) -> bool:
+        response = await self._try_request('container_stop', 'POST', f'/containers/{quote(name)}/stop')
+        # 304 - контейнер уже остановлен, как и docker stop, считаем это успехом
+        return response is not None and response.status_code in (204, 304)
+
+    async def remove_images(self, images: Sequence[str]) -> bool:
+        removed = True
+        for image in images:
+            response = await self._try_request('image_remove', 'DELETE', f'/images/{quote(image, safe="/:")}')
+            removed = removed and response is not None and response.status_code == 200
+        return removed
+
+    async def list_running(self) -> dict[str, ContainerInfo]:
+        response = await self._request('container_list', 'GET', '/containers/json')
+        if response.status_code != 200:
+            raise self._error('container_list', response)
+        containers = {}
+        for container in response.json():
+            for name in container.get('Names') or []:
+                name = name.lstrip('/')
+                containers[name] = ContainerInfo(name, container.get('Image', ''), container.get('Status', ''))
+        return containers
+
+    @contextlib.asynccontextmanager
+    async def events(self) -> AsyncIterator[AsyncIterator[dict]]:
+        try:
+            async with self.client().stream(
+                    'GET', '/events',
+                    params={'filters': json.dumps({'type': ['container']})},
+                    timeout=httpx.Timeout(DOCKER_API_TIMEOUT, read=None)
+            ) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    raise self._error('events', response)
+                yield self._read_events(response)
+        except httpx.TransportError as e:
+            raise DockerApiError('events', None, str(e) or type(e).__name__) from e
+
+    @staticmethod
+    async def _read_events(response: httpx.Response) -> AsyncIterator[dict]:
+        async for line in response.aiter_lines():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+    # контейнеры профилей запускаются без TTY, поэтому вывод приходит мультиплексированным потоком:
+    # у каждого куска заголовок из 8 байт - номер потока (1 - stdout, 2 - stderr) и размер
+    async def container_logs(self,
+                             container_name: str,
+                             follow: bool = False,
+                             since: Optional[str] = None,
+                             until: Optional[str] = None,
+                             tail: Optional[int] = None,
+                             timestamps: bool = False) -> AsyncIterator[list[cd2b_process.LogLine]]:
+        params = {
+            'stdout': '1',
+            'stderr': '1',
+            'follow': '1' if follow else '0',
+            'timestamps': '1' if timestamps else '0',
+        }
+        if since:
+            params['since'] = api_timestamp(since)
+        if until:
+            params['until'] = api_timestamp(until)
+        if tail is not None:
+            params['tail'] = str(tail)
+        streams = {1: cd2b_process.STDOUT, 2: cd2b_process.STDERR}
+        splitters = {stream_type: cd2b_process.LineSplitter() for stream_type in streams}
+        try:
+            async with self.client().stream(
+                    'GET', f'/containers/{quote(container_name)}/logs',
+                    params=params,
+                    timeout=httpx.Timeout(DOCKER_API_TIMEOUT, read=None)
+            ) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    raise self._error('container_logs', response)
+                buffer = bytearray()
+                async for chunk in response.aiter_bytes():
+                    buffer += chunk
+                    batch = []
+                    while len(buffer) >= 8:
+                        size = int.from_bytes(buffer[4:8], 'big')
+                        if len(buffer) < 8 + size:
+                            break
+                        stream_type, payload = buffer[0], bytes(buffer[8:8 + size])
+                        del buffer[:8 + size]
+                        if stream_type not in splitters:
+                            continue
+                        # как и у docker logs, строки всегда законченные, незаконченный хвост придет позже
+                        for text, is_new_line in splitters[stream_type].feed(payload):
+                            if is_new_line:
+                                batch.append(cd2b_process.LogLine(streams[stream_type], text, True, time.time()))
+                    if batch:
+                        yield batch
+        except httpx.TransportError as e:
+            raise DockerApiError('container_logs', None, str(e) or type(e).__name__) from e
+
+
+class FakeRuntime(ContainerRuntime):
+    """Контейнеры и образы в памяти, для тестов. Все вызовы записываются в calls."""
+
+    def __init__(self, build_output: Sequence[str] = ('BUILD SUCCESSFUL',), fail_build: bool = False):
+        self.build_output = list(build_output)
+        self.fail_build = fail_build
+        self.images: set[tuple[str, str]] = set()
+        self.running: dict[str, ContainerInfo] = {}
+        # вывод контейнеров: имя -> строки
+        self.logs: dict[str, list[str]] = {}
+        self.calls: list[tuple] = []
+        self._subscribers: list[asyncio.Queue] = []
+
+    def _emit(self, action: str, name: str):
+        for queue in self._subscribers:
+            queue.put_nowait({'Type': 'container', 'Action': action, 'Actor': {'Attributes': {'name': name}}})
+
+    async def image_exists(self, image: str) -> bool:
+        self.calls.append(('image_exists', image))
+        return _split_image(image) in self.images
+
+    async def image_tags(self, repository: str) -> list[str]:
+        self.calls.append(('image_tags', repository))
+        return sorted(tag for repo, tag in self.images if repo == repository)
+
+    async def tag(self, source: str, target: str) -> bool:
+        self.calls.append(('tag', source, target))
+        if _split_image(source) not in self.images:
+            return False
+        self.images.add(_split_image(target))
+        return True
+
+    async def build(self,
+                    context: str,
+                    tags: Sequence[str],
+                    build_args: Optional[dict[str, str]] = None,
+                    consumers: Sequence[cd2b_process.LogConsumer] = ()):
+        self.calls.append(('build', context, tuple(tags)))
+
+        async def lines() -> AsyncIterator[cd2b_process.LogLine]:
+            for text in self.build_output:
+                yield cd2b_process.LogLine(cd2b_process.STDOUT, text, True, 0.0)
+
+        await _broadcast(lines(), consumers)
+        if self.fail_build:
+            raise cd2b_process.ProcessFailedError('fake build', 1, '\n'.join(self.build_output))
+        self.images.update(_split_image(tag) for tag in tags)
+
+    async def run(self,
+                  image: str,
+                  name: str,
+                  ports: Optional[dict[int, int]] = None,
+                  volumes: Optional[dict[str, str]] = None,
+                  auto_remove: bool = True) -> bool:
+        self.calls.append(('run', image, name, dict(ports or {}), dict(volumes or {})))
+        if _split_image(image) not in self.images or name in self.running:
+            return False
+        self.running[name] = ContainerInfo(name, image, 'Up 1 second')
+        self._emit('start', name)
+        return True
+
+    async def stop(self, name: str) -> bool:
+        self.calls.append(('stop', name))
+        if self.running.pop(name, None) is not None:
+            self._emit('die', name)
+        return True
+
+    async def remove_images(self, images: Sequence[str]) -> bool:
+        self.calls.append(('remove_images', tuple(images)))
+        removed = True
+        for image in images:
+            if _split_image(image) in self.images:
+                self.images.discard(_split_image(image))
+            else:
+                removed = False
+        return removed
+
+    async def list_running(self) -> dict[str, ContainerInfo]:
+        return dict(self.running)
+
+    @contextlib.asynccontextmanager
+    async def events(self) -> AsyncIterator[AsyncIterator[dict]]:
+        queue = asyncio.Queue()
+        self._subscribers.append(queue)
+
+        async def read() -> AsyncIterator[dict]:
+            while True:
+                yield await queue.get()
+
+        try:
+            yield read()
+        finally:
+            self._subscribers.remove(queue)
+
+    # follow, since и until не поддерживаются: отдаются все записанные строки (или последние tail)
+    async def container_logs(self,
+                             container_name: str,
+                             follow: bool = False,
+                             since: Optional[str] = None,
+                             until: Optional[str] = None,
+                             tail: Optional[int] = None,
+                             timestamps: bool = False) -> AsyncIterator[list[cd2b_process.LogLine]]:
+        self.calls.append(('container_logs', container_name))
+        lines = self.logs.get(container_name, [])
+        if tail is not None:
+            lines = lines[-tail:] if tail else []
+        if lines:
+            yield [cd2b_process.LogLine(cd2b_process.STDOUT, text, True, 0.0) for text in lines]
+
+
+def create_runtime(kind: str = CONTAINER_RUNTIME) -> ContainerRuntime:
+    if kind == 'fake':
+        return FakeRuntime()
+    if kind == 'api':
+        return EngineApiRuntime()
+    if kind == 'auto' and os.access(DOCKER_SOCKET, os.R_OK | os.W_OK):
+        return EngineApiRuntime()
+    return CliRuntime()
+
+
+runtime: ContainerRuntime = CliRuntime()
+
+
+# Устанавливает runtime для профилей; снимок запущенных контейнеров и поток событий тоже берутся через него
+def set_runtime(new_runtime: ContainerRuntime) -> ContainerRuntime:
+    global runtime
+    previous, runtime = runtime, new_runtime
+    cd2b_containers.status.list_containers = new_runtime.list_running
+    cd2b_containers.status.invalidate()
+    cd2b_containers.tracker.events = new_runtime.events
+    cd2b_containers.tracker.list_containers = new_runtime.list_running
+    cd2b_containers.tracker.restart()
+    return previous
+
+
+set_runtime(create_runtime())
@@ -1,20 +1,50 @@
 import asyncio
+import inspect
+import json
 import os
+from contextlib import asynccontextmanager
 from typing import Optional
 
 from fastapi import FastAPI, WebSocket, HTTPException, Request, Depends
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 import uvicorn
 from pydantic import BaseModel
 from starlette import status
-from starlette.responses import FileResponse, HTMLResponse
+from starlette.responses import HTMLResponse, Response, StreamingResponse
 from starlette.templating import Jinja2Templates
 
 import cd2b_api
 import cd2b_auth_core
+import cd2b_build_logs
+import cd2b_containers
+import cd2b_db_core
+import cd2b_http
+import cd2b_jobs
+import cd2b_log_files
+import cd2b_metrics
+import cd2b_process
+import cd2b_runtime
+import utils
 from cd2b_auth_core import User
 from cd2b_db_core import InvalidPortError, InvalidPropertiesFormat
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    cd2b_db_core.queries.load()
+    # открываем общую БД заранее, чтобы миграции прошли при старте, а не на первом запросе
+    async with cd2b_db_core.connection('.'):
+        pass
+    cd2b_containers.tracker.start()
+    yield
+    await cd2b_containers.tracker.stop()
+    await cd2b_http.close_client()
+    await cd2b_runtime.runtime.close()
+    await cd2b_db_core.close_connections()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(cd2b_metrics.RequestMetricsMiddleware)
 templates = Jinja2Templates(directory="templates")
 
 
@@ -30,18 +60,37 @@ class UserRequest(BaseModel):
     password: str
 
 
-async def auth_validation(user_request: UserRequest) -> User:
+bearer = HTTPBearer(auto_error=False)
+
+
+# Авторизация: по токену из /login в заголовке Authorization: Bearer <token>,
+# либо, как раньше, логином и паролем в теле запроса
+async def auth_validation(
+        user_request: Optional[UserRequest] = None,
+        credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer)
+) -> User:
+    if credentials is not None:
+        return cd2b_auth_core.token_validation(credentials.credentials)
+    if user_request is None:
+        raise cd2b_auth_core.unauthorized_exception("Not authenticated")
     user = User(user_request.login, user_request.password)
-    await cd2b_auth_core.auth_validation(user)
-    return User(user_request.login, user_request.password)
+    return await cd2b_auth_core.auth_validation(user)
 
 
-async def ws_auth_validation(login: str, password: str) -> User:
-    return await auth_validation(UserRequest(login=login, password=password))
+# В вебсокетах токен или логин с паролем передаются query-параметрами
+async def ws_auth_validation(
+        login: Optional[str] = None,
+        password: Optional[str] = None,
+        token: Optional[str] = None
+) -> User:
+    if token is not None:
+        return cd2b_auth_core.token_validation(token)
+    if login is None or password is None:
+        raise cd2b_auth_core.unauthorized_exception("Not authenticated")
+    return await cd2b_auth_core.auth_validation(User(login, password))
 
 
-async def get_profile_with_auth(profile_name: str, user_request: UserRequest) -> cd2b_api.Profile:
-    user = await auth_validation(user_request)
+async def get_profile_with_auth(profile_name: str, user: User = Depends(auth_validation)) -> cd2b_api.Profile:
     profile = await cd2b_api.get_by_name(workdir=user.workdir, name=profile_name)
     if profile is None:
         raise HTTPException(
@@ -51,25 +100,169 @@ async def get_profile_with_auth(profile_name: str, user_request: UserRequest) ->
     return profile
 
 
+# Ставит в очередь сборку и запуск профиля. kind - bandr (запуск) или rerun (перезапуск);
+# приоритет задачи определяется по kind на сервере (cd2b_jobs.PRIORITIES), клиент его не задает.
+# Вывод сборки идет только в лог сборки (cd2b_build_logs); вебсокеты читают его как подписчики,
+# поэтому сборка не ждет медленных клиентов и одинаковые задачи можно дедуплицировать
+async def submit_run_job(
+        profile: cd2b_api.Profile,
+        kind: str,
+        external_port: int = -1,
+        rebuild: bool = True
+) -> cd2b_jobs.Job:
+    profile_name = await profile.name
+
+    async def action(job: cd2b_jobs.Job):
+        # лог заводится до первого await: run_job_ws подписывается на него сразу после начала задачи
+        build_log = job.build_log = cd2b_build_logs.hub.start(
+            (profile.workdir, profile_name), profile.build_log_path()
+        )
+        try:
+            await run_profile(job, build_log)
+        finally:
+            await build_log.close()
+
+    async def run_profile(job: cd2b_jobs.Job, build_log: cd2b_build_logs.BuildLog):
+        if kind == 'rerun':
+            await profile.rerun(
+                external_port=external_port,
+                rebuild=rebuild,
+                on_stage=job.set_status,
+                consumers=[build_log]
+            )
+        else:
+            if await profile.is_running():
+                raise RuntimeError(f"The profile '{profile_name}' is already running.")
+            await profile.run(
+                external_port=external_port,
+                rebuild=rebuild,
+                on_stage=job.set_status,
+                consumers=[build_log]
+            )
+        if not await profile.is_running():
+            raise RuntimeError(f"The container of profile '{profile_name}' is not running.")
+
+    key = (profile.workdir, profile_name, kind, external_port, rebuild)
+    return cd2b_jobs.scheduler.submit(
+        owner=profile.workdir,
+        profile_name=profile_name,
+        kind=kind,
+        action=action,
+        key=key,
+        priority=cd2b_jobs.PRIORITIES.get(kind, 0)
+    )
+
+
+# Ответ POST-ручек запуска: сразу id задачи, либо (wait=true) профиль после завершения задачи
+async def run_job_response(
+        job: cd2b_jobs.Job,
+        profile: cd2b_api.Profile,
+        wait: bool,
+        fields: Optional[list[str]] = None
+):
+    if not wait:
+        return job.to_dict()
+    await job.wait()
+    if job.status == cd2b_jobs.FAILED:
+        raise HTTPException(status_code=500, detail=job.to_dict())
+    response = await profile_response(profile, fields)
+    response['job'] = job.to_dict()
+    return response
+
+
+# Ведет вебсокет-сессию задачи: сообщает id задачи, ждет ее завершения и закрывает сокет
+async def run_job_ws(job: cd2b_jobs.Job, websocket: WebSocket):
+    await websocket.send_json(
+        {
+            "message": f"Job {job.id} is {job.status}.",
+            "is_new_line": True,
+            "job_id": job.id
+        }
+    )
+    await job.wait_started()
+    if job.build_log is not None and not await stream_build_log(job.build_log, websocket):
+        # клиент отключился; сборка продолжается без него
+        return
+    await job.wait()
+    if job.status == cd2b_jobs.FAILED:
+        # reason в close-фрейме ограничен 123 байтами
+        await websocket.close(1011, (job.error or 'failed')[:120])
+        return
+    await websocket.close(1000, 'ok')
+
+
+# Выдает токен сессии; дальше его можно передавать в заголовке Authorization: Bearer <token>
+@app.post("/login")
+async def login(
+        user: User = Depends(auth_validation)
+):
+    return {
+        "access_token": cd2b_auth_core.sessions.create(user),
+        "token_type": "bearer",
+        "expires_in": cd2b_auth_core.sessions.ttl
+    }
+
+
+@app.post("/logout")
+async def logout(
+        credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer)
+):
+    if credentials is not None:
+        cd2b_auth_core.sessions.invalidate(credentials.credentials)
+
+
+# сколько ответов по профилям строить одновременно в списках профилей
+PROFILE_RESPONSE_CONCURRENCY = 16
+# размер страницы /all_profiles
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+
 # Контракт на профиль
-async def profile_response(profile: cd2b_api.Profile):
+# Поля считаются только запрошенные (fields), независимые поля - одновременно
+PROFILE_FIELDS = {
+    "name": lambda profile: profile.name,
+    "repo_name": lambda profile: profile.repo_name,
+    "repo_uri": lambda profile: profile.github,
+    "port": lambda profile: profile.port,
+    "image_name": lambda profile: profile.docker_image_name,
+    "has_properties": lambda profile: profile.has_properties(),
+    "properties_content": lambda profile: profile.properties_content(),
+    "is_running": lambda profile: profile.is_running(),
+    "last_commit": lambda profile: profile.last_commit(),
+}
+
+
+async def profile_response(profile: cd2b_api.Profile, fields: Optional[list[str]] = None):
+    names = fields or list(PROFILE_FIELDS)
+    values = [PROFILE_FIELDS[name](profile) for name in names]
+    pending = [value for value in values if inspect.isawaitable(value)]
+    results = iter(await asyncio.gather(*pending))
     return {
-        "name": await profile.name,
-        "repo_name": profile.repo_name,
-        "repo_uri": profile.github,
-        "port": profile.port,
-        "image_name": profile.docker_image_name,
-        "has_properties": await profile.has_properties(),
-        "properties_content": await profile.properties_content(),
-        "is_running": await profile.is_running(),
-        "last_commit": await profile.last_commit()
+        name: next(results) if inspect.isawaitable(value) else value
+        for name, value in zip(names, values)
     }
 
 
+# Разбирает query-параметр fields (например fields=name,is_running) в список полей профиля
+async def response_fields(fields: Optional[str] = None) -> Optional[list[str]]:
+    if fields is None:
+        return None
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    unknown = [name for name in names if name not in PROFILE_FIELDS]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown profile fields: {', '.join(unknown)}. Available: {', '.join(PROFILE_FIELDS)}"
+        )
+    return names
+
+
 @app.post("/create_profile")
 async def create_profile(
         profile_request: ProfileRequest,
-        user: User = Depends(auth_validation)
+        user: User = Depends(auth_validation),
+        fields: Optional[list[str]] = Depends(response_fields)
 ):
     response = {'message': "Profile created successfully."}
     if await cd2b_api.get_by_name(workdir=user.workdir, name=profile_request.name) is not None:
@@ -82,38 +275,42 @@ async def create_profile(
         workdir=user.workdir,
         post_proc=profile_request.post_proc
     )
-    response['profile'] = await profile_response(profile)
+    response['profile'] = await profile_response(profile, fields)
     return response
 
 
 # Возвращает инфу по профилю с именем profile_name
 @app.post("/check_profile")
 async def check_profile(
-        profile: cd2b_api.Profile = Depends(get_profile_with_auth)
+        profile: cd2b_api.Profile = Depends(get_profile_with_auth),
+        fields: Optional[list[str]] = Depends(response_fields)
 ):
-    return await profile_response(profile)
+    return await profile_response(profile, fields)
 
 
+# удаляет все профили пользователя, возвращает сводку по каждому профилю
 @app.post("/clear_profiles")
 async def clear_profiles(
         user: User = Depends(auth_validation)
 ):
     profiles = await cd2b_api.get_all_profiles(workdir=user.workdir)
-    for profile in profiles:
-        await profile.remove()
-    pass
+    removed = await cd2b_api.remove_profiles(user.workdir, profiles)
+    # в кэше могут остаться объекты профилей, которых уже нет в БД
+    cd2b_api.profiles.remove_workdir(user.workdir)
+    return {"profiles": removed}
 
 
 @app.post("/upload_prop")
 async def щщщщщd_prop(
         file_url: str,
-        profile: cd2b_api.Profile = Depends(get_profile_with_auth)
+        profile: cd2b_api.Profile = Depends(get_profile_with_auth),
+        fields: Optional[list[str]] = Depends(response_fields)
 ):
     try:
         await profile.load_properties(file_url)
     except InvalidPropertiesFormat as e:
         raise HTTPException(status_code=400, detail=e.msg)
-    return await profile_response(profile)
+    return await profile_response(profile, fields)
 
 
 # TODO: дибильный способ аутентификации, переделать под JWT
@@ -140,52 +337,59 @@ async def bandr_ws(
         await websocket.close(1001, error_msg)
         return
 
-    await profile.run(
-        websocket=websocket,
+    job = await submit_run_job(
+        profile,
+        'bandr',
         external_port=external_port,
         rebuild=rebuild
     )
-    await websocket.close(1000, 'ok')
+    await run_job_ws(job, websocket)
 
 
-# Аналог вебсокета bandr, без вывода инфы о билде. Ответ возвращается после запуска образа
+# Аналог вебсокета bandr, без вывода инфы о билде.
+# Сразу возвращает задачу (ее статус - в /job_status); с wait=true ответ возвращается после запуска образа
 @app.post("/bandr")
 async def bandr_post(
         external_port: int = -1,
         rebuild: bool = True,
-        profile: cd2b_api.Profile = Depends(get_profile_with_auth)
+        wait: bool = False,
+        profile: cd2b_api.Profile = Depends(get_profile_with_auth),
+        fields: Optional[list[str]] = Depends(response_fields)
 ):
     if await profile.is_running():
         error_msg = f"The profile '{await profile.name}' is already running."
         raise HTTPException(status_code=400, detail=error_msg)
 
-    await profile.run(
+    job = await submit_run_job(
+        profile,
+        'bandr',
         external_port=external_port,
         rebuild=rebuild
     )
-
-    return await profile_response(profile)
+    return await run_job_response(job, profile, wait, fields)
 
 
 # Устанавливает профилю с именем profile_name порт port
 @app.post("/set_port")
 async def set_port(
         port: int | str,
-        profile: cd2b_api.Profile = Depends(get_profile_with_auth)
+        profile: cd2b_api.Profile = Depends(get_profile_with_auth),
+        fields: Optional[list[str]] = Depends(response_fields)
 ):
     try:
         await profile.set_port(port)
     except InvalidPortError as e:
         raise HTTPException(status_code=400, detail=e.msg)
-    return await profile_response(profile)
+    return await profile_response(profile, fields)
 
 
 @app.post("/stop")
 async def stop_profile(
-        profile: cd2b_api.Profile = Depends(get_profile_with_auth)
+        profile: cd2b_api.Profile = Depends(get_profile_with_auth),
+        fields: Optional[list[str]] = Depends(response_fields)
 ):
     await profile.stop_container()
-    return await profile_response(profile)
+    return await profile_response(profile, fields)
 
 
 @app.post("/remove")
@@ -195,15 +399,57 @@ async def remove_profile(
     await profile.remove()
 
 
+# Без параметров возвращает массив всех профилей.
+# С cursor/limit - страницу {"items": [...], "next_cursor": ...}; next_cursor передается в следующий запрос.
+# С stream=true - NDJSON: по профилю на строку, каждый отправляется, как только готов
 @app.post("/all_profiles")
 async def all_profiles(
-        user: User = Depends(auth_validation)
+        user: User = Depends(auth_validation),
+        fields: Optional[list[str]] = Depends(response_fields),
+        cursor: Optional[int] = None,
+        limit: Optional[int] = None,
+        stream: bool = False
 ):
-    profiles = await cd2b_api.get_all_profiles(user.workdir)
-    response = []
-    for profile in profiles:
-        response.append(await profile_response(profile))
-    return response
+    if limit is not None and not 1 <= limit <= MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be in [1; {MAX_PAGE_SIZE}]")
+
+    if stream:
+        # поток начинается с профиля после cursor, limit - размер страницы, которыми читается БД
+        return StreamingResponse(
+            stream_profiles(user.workdir, fields, limit or DEFAULT_PAGE_SIZE, cursor or 0),
+            media_type="application/x-ndjson"
+        )
+
+    if cursor is None and limit is None:
+        profiles = await cd2b_api.get_all_profiles(user.workdir)
+        return await utils.gather_bounded(
+            (profile_response(profile, fields) for profile in profiles),
+            PROFILE_RESPONSE_CONCURRENCY
+        )
+
+    profiles, next_cursor = await cd2b_api.get_profiles_page(
+        user.workdir,
+        after_id=cursor or 0,
+        limit=limit or DEFAULT_PAGE_SIZE
+    )
+    return {
+        "items": await utils.gather_bounded(
+            (profile_response(profile, fields) for profile in profiles),
+            PROFILE_RESPONSE_CONCURRENCY
+        ),
+        "next_cursor": next_cursor
+    }
+
+
+async def stream_profiles(workdir: str, fields: Optional[list[str]], page_size: int, cursor: int = 0):
+    while cursor is not None:
+        profiles, cursor = await cd2b_api.get_profiles_page(workdir, cursor, page_size)
+        # ответы страницы считаются параллельно, а отдаются страницей по порядку
+        responses = await utils.gather_bounded(
+            (profile_response(profile, fields) for profile in profiles),
+            PROFILE_RESPONSE_CONCURRENCY
+        )
+        yield ''.join(json.dumps(response) + '\n' for response in responses)
 
 
 # Build and Run profile. If profile is running - stop one and run again
@@ -225,26 +471,198 @@ async def rerun_ws(
         await websocket.close(1001, error_msg)
         return
 
-    await profile.rerun(
-        websocket=websocket,
+    job = await submit_run_job(
+        profile,
+        'rerun',
         external_port=external_port,
         rebuild=rebuild
     )
-    await websocket.close(1000, 'ok')
+    await run_job_ws(job, websocket)
 
 
-# Аналог вебсокета rerun, без вывода инфы о билде. Ответ возвращается после запуска образа
+# Аналог вебсокета rerun, без вывода инфы о билде.
+# Сразу возвращает задачу (ее статус - в /job_status); с wait=true ответ возвращается после запуска образа
 @app.post("/rerun")
 async def rerun_post(
         external_port: int = -1,
         rebuild: bool = True,
-        profile: cd2b_api.Profile = Depends(get_profile_with_auth)
+        wait: bool = False,
+        profile: cd2b_api.Profile = Depends(get_profile_with_auth),
+        fields: Optional[list[str]] = Depends(response_fields)
 ):
-    await profile.rerun(
+    job = await submit_run_job(
+        profile,
+        'rerun',
         external_port=external_port,
         rebuild=rebuild
     )
-    return await profile_response(profile)
+    return await run_job_response(job, profile, wait, fields)
+
+
+# Статус задачи сборки/запуска: queued, cloning, building, starting, running или failed, плюс тайминги
+@app.post("/job_status")
+async def job_status(
+        job_id: str,
+        user: User = Depends(auth_validation)
+):
+    job = cd2b_jobs.scheduler.get(job_id)
+    if job is None or job.owner != user.workdir:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job not found"
+        )
+    return job.to_dict()
+
+
+# Подключается к логу последней сборки профиля: сначала приходят уже накопленные строки,
+# затем новые, пока сборка идет. Формат фреймов тот же, что у /bandr и /rerun
+@app.websocket("/build_logs")
+async def build_logs_ws(
+        profile_name: str,
+        websocket: WebSocket,
+        user: User = Depends(ws_auth_validation)
+):
+    await websocket.accept()
+    build_log = cd2b_build_logs.hub.get((user.workdir, profile_name))
+    if build_log is None:
+        await websocket.close(1001, f'There are no builds of the profile {profile_name}.')
+        return
+
+    if await stream_build_log(build_log, websocket):
+        await websocket.close(1000, 'ok')
+
+
+# Отправляет лог сборки по вебсокету как подписчик: накопленные строки, затем новые до конца сборки.
+# Очередь подписчика ограничена, медленный клиент перескакивает вперед, а сборка его не ждет.
+# Возвращает False, если клиент отключился
+async def stream_build_log(build_log: cd2b_build_logs.BuildLog, websocket: WebSocket) -> bool:
+    subscriber = build_log.subscribe()
+    consumer = cd2b_process.WebSocketLogConsumer(websocket)
+    try:
+        async for line in subscriber:
+            await consumer.write(line)
+            if not consumer.alive:
+                break
+    finally:
+        build_log.unsubscribe(subscriber)
+        await consumer.close()
+    return consumer.alive
+
+
+# сколько последних строк вывода контейнера отдавать в режиме follow, если не задано tail или since
+DEFAULT_CONTAINER_LOGS_TAIL = 100
+
+
+# вывод запущенного контейнера профиля (docker logs) по вебсокету: последние tail строк
+# или строки начиная с since, затем, если follow, новые строки. Строки уходят склеенными фреймами,
+# медленный клиент притормаживает чтение docker logs, а не копится в памяти
+@app.websocket("/container_logs")
+async def container_logs_ws(
+        profile_name: str,
+        websocket: WebSocket,
+        follow: bool = True,
+        since: Optional[str] = None,
+        tail: Optional[int] = None,
+        user: User = Depends(ws_auth_validation)
+):
+    await websocket.accept()
+    profile = await cd2b_api.get_by_name(workdir=user.workdir, name=profile_name)
+    if profile is None:
+        await websocket.close(1001, f"The profile '{profile_name}' does not exist.")
+        return
+    if not await profile.is_running():
+        await websocket.close(1001, f"The profile '{profile_name}' is not running.")
+        return
+
+    consumer = cd2b_process.WebSocketLogConsumer(websocket)
+
+    async def stream():
+        lines = profile.container_logs(follow=follow, since=since, tail=container_logs_tail(tail, since, follow))
+        try:
+            async for batch in lines:
+                for line in batch:
+                    await consumer.write(line)
+                if not consumer.alive:
+                    break
+        finally:
+            await lines.aclose()
+            await consumer.close()
+
+    # в режиме follow новых строк может не быть долго, поэтому отключение клиента ждем отдельно
+    async def wait_disconnect():
+        while (await websocket.receive())['type'] != 'websocket.disconnect':
+            pass
+
+    streaming = asyncio.create_task(stream())
+    disconnect = asyncio.create_task(wait_disconnect())
+    await asyncio.wait((streaming, disconnect), return_when=asyncio.FIRST_COMPLETED)
+    if not streaming.done():
+        consumer.alive = False
+        streaming.cancel()
+    disconnect.cancel()
+    await asyncio.gather(streaming, disconnect, return_exceptions=True)
+    if consumer.alive:
+        await websocket.close(1000, 'ok')
+
+
+# вывод запущенного контейнера профиля. С follow=true - Server-Sent Events с новыми строками,
+# иначе NDJSON-файл {"time", "stream", "text"} за промежуток since..until (или последние tail строк)
+@app.get("/container_logs")
+async def container_logs(
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+        tail: Optional[int] = None,
+        follow: bool = False,
+        profile: cd2b_api.Profile = Depends(get_profile_with_auth)
+):
+    if tail is not None and tail < 0:
+        raise HTTPException(status_code=400, detail="tail must be non-negative")
+    if not await profile.is_running():
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"The profile '{await profile.name}' is not running."
+        )
+
+    # генераторы закрываем явно: при отключении клиента иначе останется живой docker logs -f
+    if follow:
+        async def events():
+            lines = profile.container_logs(follow=True, since=since, tail=container_logs_tail(tail, since, follow))
+            try:
+                async for batch in lines:
+                    yield ''.join(f'data: {line.text}\n\n' for line in batch)
+            finally:
+                await lines.aclose()
+
+        return StreamingResponse(events(), media_type='text/event-stream', headers={'cache-control': 'no-cache'})
+
+    async def ndjson():
+        lines = profile.container_logs(since=since, until=until, tail=tail, timestamps=True)
+        try:
+            async for batch in lines:
+                yield ''.join(
+                    json.dumps(cd2b_containers.parse_log_line(line)._asdict(), ensure_ascii=False) + '\n'
+                    for line in batch
+                )
+        finally:
+            await lines.aclose()
+
+    return StreamingResponse(
+        ndjson(),
+        media_type='application/x-ndjson',
+        headers={'content-disposition': f'attachment; filename="{profile.docker_image_name}.ndjson"'}
+    )
+
+
+def container_logs_tail(tail: Optional[int], since: Optional[str], follow: bool) -> Optional[int]:
+    if tail is None and since is None and follow:
+        return DEFAULT_CONTAINER_LOGS_TAIL
+    return tail
+
+
+# метрики в текстовом формате Prometheus; собираются только в момент запроса
+@app.get("/metrics")
+async def metrics():
+    return Response(cd2b_metrics.registry.render(), headers={'content-type': cd2b_metrics.CONTENT_TYPE})
 
 
 async def is_inside_logs(path):
@@ -258,8 +676,19 @@ async def is_inside_logs(path):
 @app.get("/logs/{files_path:path}")
 async def list_files(
         request: Request,
-        files_path: str
+        files_path: str,
+        tail: Optional[int] = None,
+        follow: bool = False,
+        offset: int = 0,
+        limit: int = cd2b_log_files.DEFAULT_LISTING_LIMIT
 ):
+    if tail is not None and tail < 0:
+        raise HTTPException(status_code=400, detail="tail must be non-negative")
+    if offset < 0 or not 1 <= limit <= cd2b_log_files.MAX_LISTING_LIMIT:
+        raise HTTPException(
+            status_code=400,
+            detail=f"offset must be non-negative and limit in [1; {cd2b_log_files.MAX_LISTING_LIMIT}]"
+        )
     full_path = os.path.join(f"./USERS/", files_path)
     if not await is_inside_logs(full_path):
         return HTMLResponse(
@@ -268,13 +697,25 @@ async def list_files(
         )
 
     if os.path.isdir(full_path):
-        files = os.listdir(full_path)
-        files_paths = sorted([os.path.join(f"{request.url._url}", f) for f in files])
+        entries, total = await asyncio.to_thread(cd2b_log_files.list_directory, full_path, offset, limit)
+        base_path = request.url.path.rstrip('/')
+        files_paths = [
+            f"{base_path}/{entry.name}{'/' if entry.is_dir else ''}"
+            for entry in entries
+        ]
+        next_page = None
+        if offset + limit < total:
+            next_page = str(request.url.include_query_params(offset=offset + limit, limit=limit))
         return templates.TemplateResponse(
-            "index.html", {"request": request, "files": files_paths}
+            "index.html", {"request": request, "files": files_paths, "next_page": next_page}
         )
     elif os.path.isfile(full_path):
-        return FileResponse(full_path)
+        # follow - SSE с дописываемыми строками, tail=N - последние N строк, иначе файл целиком или Range
+        if follow:
+            return await cd2b_log_files.follow_response(full_path, tail or 0)
+        if tail is not None:
+            return await cd2b_log_files.tail_response(request, full_path, tail)
+        return await cd2b_log_files.file_response(request, full_path)
     else:
         return HTMLResponse(
             content=f'404, not found: {request.url._url}',
@@ -288,10 +729,31 @@ async def list_files(
 async def change_properties_field(
         key: str,
         value: str,
-        profile: cd2b_api.Profile = Depends(get_profile_with_auth)
+        profile: cd2b_api.Profile = Depends(get_profile_with_auth),
+        fields: Optional[list[str]] = Depends(response_fields)
 ):
-    await profile.update_property(key, value)
-    return await profile_response(profile)
+    return await update_properties(profile, {key: value}, fields)
+
+
+# ручка меняющая сразу несколько полей пропертей: {"properties": {"key": "value", ...}}
+# файл переписывается один раз, в репо он попадет при следующей сборке
+@app.post("/change_properties_fields")
+async def change_properties_fields(
+        properties: dict[str, str],
+        profile: cd2b_api.Profile = Depends(get_profile_with_auth),
+        fields: Optional[list[str]] = Depends(response_fields)
+):
+    return await update_properties(profile, properties, fields)
+
+
+async def update_properties(profile: cd2b_api.Profile, properties: dict[str, str], fields: Optional[list[str]]):
+    try:
+        await profile.update_properties(properties)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return await profile_response(profile, fields)
 
 
 # TODO: do logs
@@ -0,0 +1,5 @@
+-- дубликаты имен профилей и логинов до этого переименовывает cd2b_migrations.rename_duplicate_names
+-- имена профилей уникальны
+CREATE UNIQUE INDEX IF NOT EXISTS profiles_name_idx ON profiles (name);
+-- логины пользователей уникальны
+CREATE UNIQUE INDEX IF NOT EXISTS users_login_idx ON users (login);
@@ -0,0 +1,4 @@
+-- все профили по возрастанию id
+SELECT id, name, github_repo_url, port FROM profiles
+ORDER BY id
+;
@@ -0,0 +1,6 @@
+-- страница профилей по возрастанию id: профили с id больше заданного, не больше limit штук
+SELECT id, name, github_repo_url, port FROM profiles
+WHERE id > ?
+ORDER BY id
+LIMIT ?
+;
@@ -0,0 +1,293 @@
+import asyncio
+import json
+import os
+import time
+
+from fastapi.testclient import TestClient
+
+import cd2b_api
+import cd2b_build_logs
+import cd2b_db_core
+import cd2b_git
+import cd2b_jobs
+import cd2b_process
+import cd2b_runtime
+import main
+from cd2b_auth_core import User
+
+
+def test_profiles_identity_map(tmp_path, monkeypatch):
+    async def reachable(url):
+        return True
+
+    monkeypatch.setattr(cd2b_db_core, 'check_github_repository', reachable)
+    workdir = str(tmp_path)
+
+    async def scenario():
+        profile = cd2b_api.Profile('cached', 'https://github.com/owner/repo.git', 8080, workdir)
+        await profile.save()
+        by_name = await cd2b_api.get_by_name(workdir, 'cached')
+        all_profiles = await cd2b_api.get_all_profiles(workdir)
+
+        # повторное чтение не ходит в БД
+        async def fail(*args, **kwargs):
+            raise AssertionError('database should not be queried')
+
+        monkeypatch.setattr(cd2b_db_core, 'get_profile', fail)
+        cached = await cd2b_api.get_by_name(workdir, 'cached')
+        monkeypatch.undo()
+
+        await cd2b_api.remove_profile_by_name(workdir, 'cached')
+        removed = await cd2b_api.get_by_name(workdir, 'cached')
+        await cd2b_db_core.close_connections()
+        return profile, by_name, all_profiles, cached, removed
+
+    profile, by_name, all_profiles, cached, removed = asyncio.run(scenario())
+    assert by_name is profile
+    assert all_profiles == [profile]
+    assert cached is profile
+    assert removed is None
+
+
+
+def test_drop_profiles_forgets_cached_profiles(tmp_path, monkeypatch):
+    async def reachable(url):
+        return True
+
+    monkeypatch.setattr(cd2b_db_core, 'check_github_repository', reachable)
+    workdir = str(tmp_path)
+
+    async def scenario():
+        old = cd2b_api.Profile('dropped', 'https://github.com/owner/repo.git', 8080, workdir)
+        await old.save()
+        await cd2b_api.drop_profiles(workdir)
+        missing = await cd2b_api.get_by_name(workdir, 'dropped')
+        await cd2b_db_core.create_profile(
+            {'name': 'dropped', 'github': 'https://github.com/owner/other.git', 'port': 9090}, workdir
+        )
+        recreated = await cd2b_api.get_by_name(workdir, 'dropped')
+        await cd2b_db_core.close_connections()
+        return missing, recreated
+
+    missing, recreated = asyncio.run(scenario())
+    assert missing is None
+    assert (recreated.github, recreated.port) == ('https://github.com/owner/other.git', 9090)
+
+
+def test_failed_set_port_keeps_cached_profile_in_sync(tmp_path, monkeypatch):
+    async def reachable(url):
+        return True
+
+    monkeypatch.setattr(cd2b_db_core, 'check_github_repository', reachable)
+    workdir = str(tmp_path)
+
+    async def scenario():
+        profile = cd2b_api.Profile('ported', 'https://github.com/owner/repo.git', 8080, workdir)
+        await profile.save()
+
+        async def failing_save(profile_data, workdir):
+            raise ValueError('database is locked')
+
+        monkeypatch.setattr(cd2b_db_core, 'save_profile', failing_save)
+        try:
+            await profile.set_port(9090)
+        except ValueError:
+            pass
+        monkeypatch.undo()
+
+        cached = await cd2b_api.get_by_name(workdir, 'ported')
+        stored = await cd2b_db_core.get_profile(workdir, 'ported')
+        await cd2b_api.remove_profile_by_name(workdir, 'ported')
+        await cd2b_db_core.close_connections()
+        return cached.port, stored['port']
+
+    assert asyncio.run(scenario()) == (8080, 8080)
+
+def test_profile_response_selects_fields(tmp_path):
+    profile = cd2b_api.Profile('sparse', 'https://github.com/owner/repo.git', 8080, str(tmp_path))
+    full = asyncio.run(main.profile_response(profile))
+    sparse = asyncio.run(main.profile_response(profile, ['port', 'name']))
+
+    assert list(full) == list(main.PROFILE_FIELDS)
+    assert full['has_properties'] is False
+    assert full['last_commit'] == ''
+    assert sparse == {'port': 8080, 'name': 'sparse'}
+
+
+def test_all_profiles_pagination_and_stream(tmp_path):
+    user = User('PAGE_USER', '12345')
+    user.workdir = str(tmp_path)
+    main.app.dependency_overrides[main.auth_validation] = lambda: user
+    client = TestClient(main.app)
+
+    async def seed():
+        for i in range(5):
+            await cd2b_db_core.execute_queries(
+                'create-profile.sql', user.workdir, f'page_{i}', 'https://github.com/owner/repo.git', 8000 + i
+            )
+
+    try:
+        asyncio.run(seed())
+        names, cursor = [], None
+        while True:
+            params = {"limit": 2, "fields": "name"}
+            if cursor is not None:
+                params["cursor"] = cursor
+            page = client.post("/all_profiles", params=params).json()
+            names += [item['name'] for item in page['items']]
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+
+        response = client.post("/all_profiles", params={"stream": True, "fields": "name,port"})
+        streamed = [json.loads(line) for line in response.text.splitlines()]
+        resumed = client.post("/all_profiles", params={"stream": True, "fields": "name", "cursor": 3, "limit": 1})
+    finally:
+        main.app.dependency_overrides.clear()
+        asyncio.run(cd2b_db_core.close_connections())
+
+    assert names == [f'page_{i}' for i in range(5)]
+    assert response.headers['content-type'] == 'application/x-ndjson'
+    assert streamed == [{'name': f'page_{i}', 'port': 8000 + i} for i in range(5)]
+    assert [json.loads(line)['name'] for line in resumed.text.splitlines()] == ['page_3', 'page_4']
+
+
+def test_remove_profiles_in_bulk(tmp_path, monkeypatch):
+    async def reachable(url):
+        return True
+
+    monkeypatch.setattr(cd2b_db_core, 'check_github_repository', reachable)
+    workdir = str(tmp_path)
+
+    async def remove_image(self):
+        if self._name == 'broken':
+            raise RuntimeError('docker is gone')
+        return True
+
+    monkeypatch.setattr(cd2b_api.Profile, 'remove_image', remove_image)
+
+    async def scenario():
+        created = []
+        for name in ('first', 'second', 'broken'):
+            profile = cd2b_api.Profile(name, 'https://github.com/owner/repo.git', 8080, workdir)
+            await profile.save()
+            os.makedirs(os.path.join(workdir, 'repos', profile.docker_image_name, 'repo'))
+            created.append(profile)
+        cd2b_build_logs.hub.start((workdir, 'first'))
+        summary = await cd2b_api.remove_profiles(workdir, created, concurrency=2)
+        left = await cd2b_api.get_all_profiles(workdir)
+        await cd2b_db_core.close_connections()
+        return summary, left
+
+    summary, left = asyncio.run(scenario())
+    assert left == []
+    assert [result['name'] for result in summary] == ['first', 'second', 'broken']
+    assert summary[0] == {'name': 'first', 'removed': True, 'image_removed': True, 'error': None}
+    assert summary[2]['error'] == 'docker is gone'
+    assert os.listdir(os.path.join(workdir, 'repos')) == ['cd2b_repo_broken']
+    assert cd2b_build_logs.hub.get((workdir, 'first')) is None
+
+
+def test_build_skips_existing_image_and_prunes_stale_tags(tmp_path, monkeypatch):
+    commit = {'value': 'a' * 40}
+    runtime = cd2b_runtime.FakeRuntime()
+
+    async def sync_repository(url, path, **kwargs):
+        pass
+
+    async def head_commit(path):
+        return commit['value']
+
+    async def run_and_move_head(image, name, **kwargs):
+        # HEAD сдвинулся между сборкой и запуском - удалять все равно надо по запущенному тегу
+        commit['value'] = 'c' * 40
+        return await cd2b_runtime.FakeRuntime.run(runtime, image, name, **kwargs)
+
+    monkeypatch.setattr(cd2b_git, 'sync_repository', sync_repository)
+    monkeypatch.setattr(cd2b_git, 'head_commit', head_commit)
+    previous = cd2b_runtime.set_runtime(runtime)
+    profile = cd2b_api.Profile('app', 'https://github.com/owner/repo.git', 8080, str(tmp_path))
+    name = profile.docker_image_name
+
+    async def scenario():
+        first_tag = await profile.build()
+        # тот же коммит и проперти - образ уже есть, сборки нет
+        assert await profile.build() == first_tag
+        await profile.run(external_port=39518)
+        await profile.stop_container()
+
+        commit['value'] = 'b' * 40
+        monkeypatch.setattr(runtime, 'run', run_and_move_head)
+        await profile.run(external_port=39518)
+        return first_tag
+
+    try:
+        first_tag = asyncio.run(scenario())
+    finally:
+        cd2b_runtime.set_runtime(previous)
+    second_tag = runtime.running[name].image.split(':')[1]
+
+    assert [call[0] for call in runtime.calls].count('build') == 2
+    assert ('tag', f'{name}:{first_tag}', name) in runtime.calls
+    assert ('remove_images', (f'{name}:{first_tag}',)) in runtime.calls
+    assert second_tag.startswith('b' * 12)
+    assert sorted(tag for _, tag in runtime.images) == sorted(['latest', second_tag])
+
+
+def test_run_job_priority_is_set_by_server(tmp_path, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(cd2b_jobs.scheduler, 'submit', lambda **kwargs: submitted.append(kwargs))
+    profile = cd2b_api.Profile('app', 'https://github.com/owner/repo.git', 8080, str(tmp_path))
+
+    async def scenario():
+        await main.submit_run_job(profile, 'bandr')
+        await main.submit_run_job(profile, 'rerun')
+
+    asyncio.run(scenario())
+
+    assert [job['priority'] for job in submitted] == [0, 1]
+
+
+def test_run_job_ws_reads_build_log_as_subscriber():
+    class SlowWebSocket:
+        def __init__(self):
+            self.frames = []
+            self.sent_at = None
+            self.close_code = None
+
+        async def send_json(self, data):
+            self.frames.append(data)
+
+        async def send_text(self, text):
+            await asyncio.sleep(0.01)
+            self.frames.append(json.loads(text))
+            self.sent_at = time.monotonic()
+
+        async def close(self, code, reason=''):
+            self.close_code = code
+
+    hub = cd2b_build_logs.LogHub()
+
+    async def action(job):
+        build_log = job.build_log = hub.start('app')
+        for i in range(50):
+            await build_log.write(cd2b_process.LogLine('stdout', f'line {i}', True, 0.0))
+            await asyncio.sleep(0)
+        await build_log.close()
+        built.append(time.monotonic())
+
+    built = []
+
+    async def scenario():
+        websocket = SlowWebSocket()
+        job = cd2b_jobs.JobScheduler().submit('owner', 'app', 'bandr', action)
+        await main.run_job_ws(job, websocket)
+        return websocket
+
+    websocket = asyncio.run(scenario())
+
+    # сборка закончилась раньше, чем медленный клиент получил последний фрейм, и клиент получил весь лог
+    assert built[0] < websocket.sent_at
+    lines = '\n'.join(frame['message'] for frame in websocket.frames[1:]).split('\n')
+    assert lines == [f'line {i}' for i in range(50)]
+    assert websocket.close_code == 1000
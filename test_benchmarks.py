@@ -0,0 +1,46 @@
+import json
+
+import cd2b_api
+import cd2b_properties
+from benchmarks import micro
+
+
+def test_micro_benchmarks_smoke_run(tmp_path, capsys):
+    output = tmp_path / 'results.json'
+    sizes = {**micro.QUICK_SIZES, 'profiles': (10,), 'gradle_lines': 200}
+
+    profiles, properties = cd2b_api.profiles, cd2b_properties.cache
+    cached = cd2b_api.Profile('cached', 'https://github.com/owner/repo.git', 8080, str(tmp_path))
+    profiles.put(cached)
+    cached_profiles, cached_properties = list(profiles._profiles), dict(properties._entries)
+
+    report = micro.run(sizes, ('execute_queries', 'get_all_profiles', 'update_property', 'process_writer'))
+    output.write_text(json.dumps(report))
+
+    # кэши процесса не видны бенчмарку и не засоряются им
+    assert cd2b_api.profiles is profiles and cd2b_properties.cache is properties
+    assert list(profiles._profiles) == cached_profiles
+    assert properties._entries == cached_properties
+    profiles.remove(str(tmp_path), 'cached')
+
+    results = report['results']
+    assert results['get_all_profiles.10.cold']['ops'] == sizes['profiles_repeat']
+    assert results['process_writer.gradle_200_lines']['frames_per_run'] >= 1
+    assert all(result['ops_per_s'] > 0 for result in results.values())
+
+    slower = json.loads(output.read_text())
+    for result in slower['results'].values():
+        result['ops_per_s'] /= 2
+    assert micro.compare(report, slower) == len(results)
+    assert 'REGRESSION' in capsys.readouterr().out
+
+
+def test_load_generator_smoke_run():
+    from benchmarks import load
+
+    report = load.run(load.parse_args(['--users', '2', '--duration', '1', '--profiles-per-user', '2']))
+
+    assert report['errors'] == 0
+    assert report['requests'] > 0
+    assert set(report['operations']) <= set(load.DEFAULT_MIX)
+    assert report['server_loop_lag']['samples'] > 0
@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+import cd2b_build_logs
+from cd2b_process import LogLine
+
+
+def line(text):
+    return LogLine('stdout', text, True, time.time())
+
+
+def test_late_subscriber_gets_replay_and_live_lines(tmp_path):
+    log_path = tmp_path / 'logs' / 'build.log'
+
+    async def scenario():
+        build_log = cd2b_build_logs.hub.start(('workdir', 'profile'), str(log_path))
+        await build_log.write(line('first'))
+        subscriber = build_log.subscribe()
+        await build_log.write(line('second'))
+        await build_log.close()
+        return [item.text async for item in subscriber]
+
+    assert asyncio.run(scenario()) == ['first', 'second']
+    assert log_path.read_text() == 'first\nsecond\n'
+
+
+def test_slow_subscriber_skips_ahead():
+    async def scenario():
+        build_log = cd2b_build_logs.BuildLog()
+        subscriber = build_log.subscribe()
+        subscriber.queue_size = 3
+        for i in range(5):
+            await build_log.write(line(f'line {i}'))
+        await build_log.close()
+        return [item.text async for item in subscriber], subscriber.skipped
+
+    lines, skipped = asyncio.run(scenario())
+    assert lines == ['... 3 lines skipped ...', 'line 3', 'line 4']
+    assert skipped == 3
+
+
+def test_log_file_is_written_in_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(cd2b_build_logs, 'FILE_FLUSH_LINES', 3)
+    monkeypatch.setattr(cd2b_build_logs, 'FILE_FLUSH_INTERVAL', 60)
+    log_path = tmp_path / 'build.log'
+    log_path.write_text('previous build\n')
+
+    async def scenario():
+        build_log = cd2b_build_logs.BuildLog(str(log_path))
+        for i in range(4):
+            await build_log.write(line(f'line {i}'))
+        flushed = log_path.read_text()
+        await build_log.close()
+        return flushed
+
+    assert asyncio.run(scenario()) == 'line 0\nline 1\nline 2\n'
+    assert log_path.read_text() == 'line 0\nline 1\nline 2\nline 3\n'
+
+
+def test_hub_rejects_concurrent_build_and_expires_finished_log():
+    hub = cd2b_build_logs.LogHub(ttl=0.01)
+
+    async def scenario():
+        build_log = hub.start('profile')
+        try:
+            hub.start('profile')
+            rejected = False
+        except RuntimeError:
+            rejected = True
+        await build_log.close()
+        kept = hub.get('profile') is build_log
+        await asyncio.sleep(0.05)
+        return rejected, kept, hub.get('profile')
+
+    assert asyncio.run(scenario()) == (True, True, None)
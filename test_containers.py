@@ -0,0 +1,166 @@
+import asyncio
+import contextlib
+import stat
+
+import cd2b_containers
+
+
+def write_fake_docker(tmp_path, script: str) -> str:
+    docker = tmp_path / 'docker'
+    docker.write_text('#!/bin/sh\n' + script)
+    docker.chmod(docker.stat().st_mode | stat.S_IEXEC)
+    return str(docker)
+
+
+def test_status_snapshot_is_shared(tmp_path, monkeypatch):
+    calls = tmp_path / 'calls'
+    monkeypatch.setattr(cd2b_containers, 'DOCKER_BIN', write_fake_docker(
+        tmp_path,
+        f'echo call >> {calls}\n'
+        'printf "cd2b_repo_first\\tcd2b_repo_first\\tUp 2 minutes\\n"\n'
+    ))
+
+    async def scenario():
+        status = cd2b_containers.ContainerStatus(ttl=60)
+        results = await asyncio.gather(
+            *[status.is_running(name) for name in ['cd2b_repo_first', 'cd2b_repo_second'] * 10]
+        )
+        status.invalidate()
+        await status.is_running('cd2b_repo_first')
+        return results
+
+    results = asyncio.run(scenario())
+    assert results == [True, False] * 10
+    assert len(calls.read_text().splitlines()) == 2
+
+
+def test_status_keeps_last_snapshot_when_listing_fails():
+    responses = [{'cd2b_repo_first': cd2b_containers.ContainerInfo('cd2b_repo_first', 'image', 'Up')}]
+
+    async def list_containers():
+        if not responses:
+            raise RuntimeError('docker is unavailable')
+        return responses.pop()
+
+    async def scenario():
+        status = cd2b_containers.ContainerStatus(ttl=60, list_containers=list_containers)
+        before = await status.is_running('cd2b_repo_first')
+        status.invalidate()
+        return before, await asyncio.gather(status.is_running('cd2b_repo_first'), status.is_running('other'))
+
+    assert asyncio.run(scenario()) == (True, [True, False])
+
+
+def test_status_refresh_survives_cancelled_waiter():
+    async def list_containers():
+        await asyncio.sleep(0.05)
+        return {'cd2b_repo_first': cd2b_containers.ContainerInfo('cd2b_repo_first', 'image', 'Up')}
+
+    async def scenario():
+        status = cd2b_containers.ContainerStatus(ttl=60, list_containers=list_containers)
+        first = asyncio.create_task(status.is_running('cd2b_repo_first'))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(status.is_running('cd2b_repo_first'))
+        await asyncio.sleep(0.01)
+        # первый запрос начал обновление и отменился - второй все равно получает снимок
+        first.cancel()
+        return await second
+
+    assert asyncio.run(scenario()) is True
+
+
+def test_tracker_follows_scripted_events(tmp_path, monkeypatch):
+    events = tmp_path / 'events'
+    events.write_text('\n'.join([
+        '{"Type": "container", "Action": "start", "Actor": {"Attributes": {"name": "cd2b_repo_second"}}}',
+        '{"Type": "container", "Action": "die", "Actor": {"Attributes": {"name": "cd2b_repo_first"}}}',
+        '{"Type": "container", "Action": "start", "Actor": {"Attributes": {"name": "postgres"}}}',
+    ]) + '\n')
+    monkeypatch.setattr(cd2b_containers, 'DOCKER_BIN', write_fake_docker(
+        tmp_path,
+        'if [ "$1" = "events" ]; then\n'
+        f'  cat {events}\n'
+        '  exec sleep 5\n'
+        'else\n'
+        '  printf "cd2b_repo_first\\tcd2b_repo_first\\tUp 2 minutes\\n"\n'
+        'fi\n'
+    ))
+
+    async def scenario():
+        tracker = cd2b_containers.ContainerEventTracker()
+        tracker.start()
+        for _ in range(100):
+            if tracker.is_live and tracker.running() == {'cd2b_repo_second'}:
+                break
+            await asyncio.sleep(0.01)
+        running = tracker.running()
+        live = tracker.is_live
+        await tracker.stop()
+        return live, running, tracker.is_live
+
+    live, running, live_after_stop = asyncio.run(scenario())
+    assert live
+    assert running == {'cd2b_repo_second'}
+    assert not live_after_stop
+
+
+def test_container_logs_streams_and_stops_follow(tmp_path, monkeypatch):
+    args = tmp_path / 'args'
+    monkeypatch.setattr(cd2b_containers, 'DOCKER_BIN', write_fake_docker(
+        tmp_path,
+        f'echo "$@" > {args}\n'
+        'echo "2024-01-01T10:00:00.000000001Z started"\n'
+        'echo "2024-01-01T10:00:01.000000001Z oops" >&2\n'
+        'exec sleep 30\n'
+    ))
+
+    async def scenario():
+        lines = []
+        logs = cd2b_containers.container_logs('cd2b_repo_first', follow=True, since='10m', tail=5, timestamps=True)
+        async for batch in logs:
+            lines.extend(batch)
+            if len(lines) == 2:
+                break
+        # выход из цикла должен остановить docker logs --follow
+        await logs.aclose()
+        return lines
+
+    lines = asyncio.run(asyncio.wait_for(scenario(), 5))
+    parsed = sorted(cd2b_containers.parse_log_line(line) for line in lines)
+    assert parsed == [
+        ('2024-01-01T10:00:00.000000001Z', 'stdout', 'started'),
+        ('2024-01-01T10:00:01.000000001Z', 'stderr', 'oops'),
+    ]
+    assert args.read_text().split() == [
+        'logs', '--follow', '--timestamps', '--since=10m', '--tail=5', '--', 'cd2b_repo_first'
+    ]
+
+
+def test_tracker_matches_ps_and_waits_for_snapshot():
+    tracker = cd2b_containers.ContainerEventTracker()
+    tracker.mark('cd2b_repo_first', True)
+    tracker.apply({'Type': 'container', 'Action': 'pause', 'Actor': {'Attributes': {'name': 'cd2b_repo_first'}}})
+    # как и в docker ps, приостановленный контейнер считается запущенным
+    assert tracker.is_running('cd2b_repo_first')
+
+    @contextlib.asynccontextmanager
+    async def events():
+        async def read():
+            await asyncio.sleep(60)
+            yield {}
+
+        yield read()
+
+    async def failing_list():
+        raise RuntimeError('docker ps failed')
+
+    async def scenario():
+        tracker = cd2b_containers.ContainerEventTracker(reconnect_delay=0.01, events=events,
+                                                        list_containers=failing_list)
+        tracker.start()
+        await asyncio.sleep(0.05)
+        live = tracker.is_live
+        await tracker.stop()
+        return live
+
+    assert asyncio.run(scenario()) is False
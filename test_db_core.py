@@ -0,0 +1,111 @@
+import asyncio
+
+import aiosqlite
+
+import cd2b_db_core
+
+
+def test_pool_reuses_connection(tmp_path):
+    async def scenario():
+        pool = cd2b_db_core.ConnectionPool()
+        path = str(tmp_path / 'user' / cd2b_db_core.DATABASE_FILE)
+        async with pool.acquire(path) as first:
+            journal_mode = await (await first.execute('PRAGMA journal_mode')).fetchall()
+        async with pool.acquire(path) as second:
+            pass
+        await pool.close()
+        return first, second, journal_mode, len(pool)
+
+    first, second, journal_mode, size = asyncio.run(scenario())
+    assert first is second
+    assert journal_mode == [('wal',)]
+    assert size == 0
+
+
+def test_pool_evicts_least_recently_used(tmp_path):
+    async def scenario():
+        pool = cd2b_db_core.ConnectionPool(max_connections=2)
+        for i in range(5):
+            async with pool.acquire(str(tmp_path / f'user{i}.db')):
+                pass
+        size = len(pool)
+        await pool.close()
+        return size
+
+    assert asyncio.run(scenario()) == 2
+
+
+def test_migrations_make_profile_names_unique(tmp_path):
+    async def scenario():
+        workdir = str(tmp_path)
+        await cd2b_db_core.create_profile({'name': 'profile', 'port': 8080}, workdir)
+        try:
+            await cd2b_db_core.create_profile({'name': 'profile', 'port': 8081}, workdir)
+        except ValueError as e:
+            error = e
+        else:
+            error = None
+        async with cd2b_db_core.connection(workdir) as db:
+            version = await cd2b_db_core.cd2b_migrations.schema_version(db)
+        profile = await cd2b_db_core.get_profile(workdir, 'profile')
+        await cd2b_db_core.close_connections()
+        return error, version, profile
+
+    error, version, profile = asyncio.run(scenario())
+    assert 'already exists' in str(error)
+    assert version == cd2b_db_core.cd2b_migrations.migrations()[-1].version
+    assert profile['port'] == 8080
+
+
+def test_unique_names_migration_keeps_duplicates(tmp_path):
+    async def scenario():
+        async with aiosqlite.connect(str(tmp_path / 'legacy.db')) as db:
+            await db.execute('CREATE TABLE schema_version (version INTEGER PRIMARY KEY, name TEXT NOT NULL, '
+                             'applied_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP)')
+            await db.execute("INSERT INTO schema_version (version, name) VALUES (1, '001-create-tables.sql')")
+            await db.execute('CREATE TABLE profiles (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, '
+                             'github_repo_url TEXT, port INTEGER)')
+            await db.execute('CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, login TEXT NOT NULL, '
+                             'hash_password TEXT NOT NULL)')
+            # app_2 уже занято, а длинное имя с суффиксом не уложилось бы в 62 символа
+            await db.executemany('INSERT INTO profiles (name, port) VALUES (?, ?)',
+                                 [('app', 8080), ('app', 8081), ('app_2', 8082), ('l' * 62, 1), ('l' * 62, 2)])
+            await db.executemany("INSERT INTO users (login, hash_password) VALUES (?, '')", [('root',), ('root',)])
+            await db.commit()
+            await cd2b_db_core.cd2b_migrations.migrate(db)
+            cursor = await db.execute('SELECT name, port FROM profiles ORDER BY id')
+            profiles = await cursor.fetchall()
+            cursor = await db.execute('SELECT login FROM users ORDER BY id')
+            users = await cursor.fetchall()
+            cursor = await db.execute('SELECT table_name, record_id, old_name, new_name FROM renamed_names')
+            return profiles, users, await cursor.fetchall()
+
+    profiles, users, renamed = asyncio.run(scenario())
+    assert profiles == [('app', 8080), ('app_3', 8081), ('app_2', 8082), ('l' * 62, 1), ('l' * 60 + '_5', 2)]
+    assert users == [('root',), ('root_2',)]
+    assert renamed == [('profiles', 2, 'app', 'app_3'), ('profiles', 5, 'l' * 62, 'l' * 60 + '_5'),
+                       ('users', 2, 'root', 'root_2')]
+
+
+def test_create_profile_checks_name_before_github(tmp_path, monkeypatch):
+    checked = []
+
+    async def reachable(url):
+        checked.append(url)
+        return True
+
+    monkeypatch.setattr(cd2b_db_core, 'check_github_repository', reachable)
+    profile = {'name': 'taken', 'github': 'https://github.com/owner/repo.git', 'port': 8080}
+
+    async def scenario():
+        workdir = str(tmp_path)
+        await cd2b_db_core.create_profile(profile, workdir)
+        try:
+            await cd2b_db_core.create_profile(profile, workdir)
+        except ValueError as e:
+            return str(e)
+        finally:
+            await cd2b_db_core.close_connections()
+
+    assert 'already exists' in asyncio.run(scenario())
+    assert len(checked) == 1
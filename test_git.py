@@ -0,0 +1,116 @@
+import asyncio
+import os
+import shutil
+import subprocess
+
+import cd2b_git
+
+
+def git(*args, cwd):
+    subprocess.run(['git', *args], cwd=cwd, check=True, capture_output=True)
+
+
+def make_origin(tmp_path):
+    origin = tmp_path / 'origin'
+    origin.mkdir()
+    git('init', '--quiet', '-b', 'main', cwd=origin)
+    git('config', 'user.email', 'test@example.com', cwd=origin)
+    git('config', 'user.name', 'test', cwd=origin)
+    (origin / 'file.txt').write_text('first')
+    git('add', '.', cwd=origin)
+    git('commit', '--quiet', '-m', 'first', cwd=origin)
+    return origin
+
+
+def commit(origin, content):
+    (origin / 'file.txt').write_text(content)
+    git('commit', '--quiet', '-am', content, cwd=origin)
+
+
+def test_sync_is_incremental(tmp_path):
+    origin = make_origin(tmp_path)
+    checkout = tmp_path / 'repos' / 'checkout'
+    url = f'file://{origin}'
+
+    asyncio.run(cd2b_git.sync_repository(url, str(checkout)))
+    marker = checkout / '.git' / 'marker'
+    marker.write_text('kept')
+    (checkout / 'untracked.txt').write_text('removed')
+
+    commit(origin, 'second')
+    asyncio.run(cd2b_git.sync_repository(url, str(checkout)))
+
+    assert (checkout / 'file.txt').read_text() == 'second'
+    assert not (checkout / 'untracked.txt').exists()
+    # checkout обновлен на месте, а не склонирован заново
+    assert marker.exists()
+
+
+def test_sync_reclones_corrupt_checkout(tmp_path):
+    origin = make_origin(tmp_path)
+    checkout = tmp_path / 'checkout'
+    url = f'file://{origin}'
+
+    asyncio.run(cd2b_git.sync_repository(url, str(checkout), depth=1))
+    shutil.rmtree(checkout / '.git' / 'objects')
+    commit(origin, 'second')
+    asyncio.run(cd2b_git.sync_repository(url, str(checkout), depth=1))
+
+    assert (checkout / 'file.txt').read_text() == 'second'
+
+
+def test_mirror_cache_shared_between_checkouts(tmp_path):
+    origin = make_origin(tmp_path)
+    url = f'file://{origin}'
+    cache = cd2b_git.MirrorCache(str(tmp_path / 'mirrors'), max_mirrors=1)
+    first = tmp_path / 'first' / 'repo'
+    second = tmp_path / 'second' / 'repo'
+
+    async def scenario():
+        await asyncio.gather(
+            cd2b_git.sync_repository(url, str(first), mirror_cache=cache),
+            cd2b_git.sync_repository(url, str(second), mirror_cache=cache),
+        )
+        commit(origin, 'second')
+        await cd2b_git.sync_repository(url, str(first), mirror_cache=cache)
+
+    asyncio.run(scenario())
+    mirror = cache.mirror_path(url)
+    assert (first / 'file.txt').read_text() == 'second'
+    assert cache._uses_mirror(str(first), mirror)
+    assert cache._uses_mirror(str(second), mirror)
+
+
+def test_mirror_cache_evicts_unused_mirrors(tmp_path):
+    origin = make_origin(tmp_path)
+    cache = cd2b_git.MirrorCache(str(tmp_path / 'mirrors'), max_mirrors=1)
+    first = tmp_path / 'first'
+    second = tmp_path / 'second'
+
+    asyncio.run(cd2b_git.sync_repository(f'file://{origin}', str(first), mirror_cache=cache))
+    shutil.rmtree(first)
+    asyncio.run(cd2b_git.sync_repository(f'file://{origin}/', str(second), mirror_cache=cache))
+
+    assert not os.path.exists(cache.mirror_path(f'file://{origin}'))
+    assert not os.path.exists(cache.mirror_path(f'file://{origin}') + '.lock')
+    assert (second / 'file.txt').read_text() == 'first'
+
+
+def test_sync_keeps_intact_checkout_when_fetch_fails(tmp_path):
+    origin = make_origin(tmp_path)
+    checkout = tmp_path / 'checkout'
+
+    asyncio.run(cd2b_git.sync_repository(f'file://{origin}', str(checkout)))
+    marker = checkout / '.git' / 'marker'
+    marker.write_text('kept')
+
+    try:
+        asyncio.run(cd2b_git.sync_repository(f'file://{tmp_path}/unreachable', str(checkout)))
+    except cd2b_git.GitError:
+        failed = True
+    else:
+        failed = False
+
+    assert failed
+    assert marker.exists()
+    assert (checkout / 'file.txt').read_text() == 'first'
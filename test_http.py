@@ -0,0 +1,40 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cd2b_http
+
+
+class RepositoryHandler(BaseHTTPRequestHandler):
+    hits = []
+
+    def do_GET(self):
+        self.hits.append(self.path)
+        self.send_response(200 if self.path == '/owner/repo.git' else 404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def test_repository_checks_are_cached():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RepositoryHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+
+    async def scenario():
+        cache = cd2b_http.ReachabilityCache()
+        results = await asyncio.gather(*[cache.check(f'{base_url}/owner/repo.git') for _ in range(10)])
+        results.append(await cache.check(f'{base_url}/owner/missing.git'))
+        results.append(await cache.check(f'{base_url}/owner/repo.git'))
+        await cd2b_http.close_client()
+        return results
+
+    try:
+        results = asyncio.run(scenario())
+    finally:
+        server.shutdown()
+
+    assert results == [True] * 10 + [False, True]
+    assert RepositoryHandler.hits == ['/owner/repo.git', '/owner/missing.git']
@@ -0,0 +1,79 @@
+import asyncio
+
+import cd2b_jobs
+
+
+def test_scheduler_limits_and_dedup():
+    async def scenario():
+        scheduler = cd2b_jobs.JobScheduler(max_concurrent=2, max_per_user=1)
+        release = asyncio.Event()
+        started = []
+
+        def make_action(name):
+            async def action(job):
+                started.append(name)
+                job.set_status(cd2b_jobs.BUILDING)
+                await release.wait()
+            return action
+
+        first = scheduler.submit('alice', 'a1', 'bandr', make_action('a1'), key='a1')
+        second = scheduler.submit('alice', 'a2', 'bandr', make_action('a2'), key='a2')
+        duplicate = scheduler.submit('alice', 'a2', 'bandr', make_action('a2 again'), key='a2')
+        third = scheduler.submit('bob', 'b1', 'bandr', make_action('b1'))
+        urgent = scheduler.submit('carol', 'c1', 'bandr', make_action('c1'), priority=10)
+        await asyncio.sleep(0)
+
+        statuses = (first.status, second.status, third.status, urgent.status)
+        release.set()
+        for job in (first, second, third, urgent):
+            await job.wait()
+        return started, duplicate is second, statuses, second.to_dict()
+
+    started, deduplicated, statuses, second = asyncio.run(scenario())
+    assert deduplicated
+    # у alice одна сборка за раз, carol с приоритетом обгоняет вторую сборку alice
+    assert started == ['a1', 'b1', 'c1', 'a2']
+    assert statuses == ('building', 'queued', 'building', 'queued')
+    assert second['status'] == 'running'
+    assert second['started_at'] >= second['created_at']
+
+
+def test_failed_job_reports_error():
+    async def scenario():
+        scheduler = cd2b_jobs.JobScheduler()
+
+        async def action(job):
+            raise RuntimeError('build failed')
+
+        job = scheduler.submit('alice', 'a1', 'bandr', action)
+        await job.wait()
+        return job
+
+    job = asyncio.run(scenario())
+    assert job.status == cd2b_jobs.FAILED
+    assert job.error == 'build failed'
+
+
+def test_history_is_trimmed_past_stuck_job():
+    async def scenario():
+        scheduler = cd2b_jobs.JobScheduler(max_concurrent=2, max_per_user=2, history=3)
+        release = asyncio.Event()
+
+        async def hang(job):
+            await release.wait()
+
+        async def finish(job):
+            pass
+
+        stuck = scheduler.submit('alice', 'stuck', 'bandr', hang)
+        for i in range(20):
+            await scheduler.submit('bob', f'p{i}', 'bandr', finish).wait()
+        size = len(scheduler._jobs)
+        release.set()
+        await stuck.wait()
+        return size, scheduler.get(stuck.id) is stuck
+
+    size, kept_stuck = asyncio.run(scenario())
+    # зависшая задача не мешает забывать завершенные после нее
+    assert size == 3
+    assert kept_stuck
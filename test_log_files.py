@@ -0,0 +1,116 @@
+import asyncio
+import os
+import shutil
+
+import pytest
+from fastapi.testclient import TestClient
+
+import cd2b_log_files
+import main
+
+LOGS_DIR = './USERS/test_log_files'
+
+
+@pytest.fixture
+def logs_dir():
+    os.makedirs(LOGS_DIR, exist_ok=True)
+    yield LOGS_DIR
+    shutil.rmtree(LOGS_DIR)
+
+
+def test_tail_reads_from_end(tmp_path):
+    path = tmp_path / 'app.log'
+    path.write_bytes(b''.join(b'line %d\n' % i for i in range(1000)))
+
+    assert cd2b_log_files.tail(str(path), 3, block_size=7) == b'line 997\nline 998\nline 999\n'
+    assert cd2b_log_files.tail(str(path), 0) == b''
+    path.write_bytes(b'a\nb')
+    assert cd2b_log_files.tail(str(path), 5) == b'a\nb'
+
+
+def test_parse_range():
+    assert cd2b_log_files.parse_range('bytes=0-9', 100) == (0, 9)
+    assert cd2b_log_files.parse_range('bytes=90-', 100) == (90, 99)
+    assert cd2b_log_files.parse_range('bytes=-10', 100) == (90, 99)
+    assert cd2b_log_files.parse_range('bytes=0-1,5-6', 100) is None
+    with pytest.raises(cd2b_log_files.RangeNotSatisfiable):
+        cd2b_log_files.parse_range('bytes=100-', 100)
+
+
+def test_follow_yields_appended_lines(tmp_path):
+    path = tmp_path / 'app.log'
+    path.write_bytes(b'old\n')
+
+    async def scenario():
+        lines = cd2b_log_files.follow(str(path), path.stat().st_size, poll_interval=0.01)
+        with open(path, 'ab') as file:
+            file.write(b'new 1\nnew')
+        first = await asyncio.wait_for(lines.__anext__(), 1)
+        with open(path, 'ab') as file:
+            file.write(b' 2\n')
+        second = await asyncio.wait_for(lines.__anext__(), 1)
+        await lines.aclose()
+        return first, second
+
+    assert asyncio.run(scenario()) == ('new 1', 'new 2')
+
+
+def test_list_directory_reuses_sorted_listing(tmp_path, monkeypatch):
+    for name in ('c', 'a', 'b'):
+        (tmp_path / name).write_text(name)
+    cache = cd2b_log_files.ListingCache()
+    monkeypatch.setattr(cd2b_log_files, 'listings', cache)
+    scans = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda path: scans.append(path) or scandir(path))
+
+    first_page = cd2b_log_files.list_directory(str(tmp_path), 0, 2)
+    second_page = cd2b_log_files.list_directory(str(tmp_path), 2, 2)
+    assert [entry.name for entry in first_page[0]] == ['a', 'b']
+    assert second_page == ([cd2b_log_files.DirectoryEntry('c', False)], 3)
+    assert len(scans) == 1
+    # новая запись меняет mtime директории - листинг перечитывается
+    (tmp_path / 'd').mkdir()
+    os.utime(tmp_path, ns=(0, os.stat(tmp_path).st_mtime_ns + 1))
+    assert cd2b_log_files.list_directory(str(tmp_path), 3, 2) == ([cd2b_log_files.DirectoryEntry('d', True)], 4)
+    assert len(scans) == 2
+
+
+def test_logs_endpoint(logs_dir):
+    content = b''.join(b'log line %d\n' % i for i in range(200))
+    with open(os.path.join(logs_dir, 'app.log'), 'wb') as file:
+        file.write(content)
+    for i in range(3):
+        os.makedirs(os.path.join(logs_dir, f'dir{i}'))
+    client = TestClient(main.app)
+    url = '/logs/test_log_files/app.log'
+
+    ranged = client.get(url, headers={'Range': 'bytes=0-9'})
+    assert ranged.status_code == 206
+    assert ranged.content == content[:10]
+    assert ranged.headers['content-range'] == f'bytes 0-9/{len(content)}'
+
+    full = client.get(url, headers={'Accept-Encoding': 'identity'})
+    assert full.content == content
+    cached = client.get(url, headers={'If-None-Match': full.headers['etag'], 'Accept-Encoding': 'identity'})
+    assert cached.status_code == 304
+
+    compressed = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert compressed.headers['content-encoding'] == 'gzip'
+    assert compressed.headers['vary'] == 'Accept-Encoding'
+    assert compressed.content == content
+    # 304 несет ETag того представления, которое совпало; ETag другого представления не подходит
+    cached = client.get(url, headers={'If-None-Match': compressed.headers['etag'], 'Accept-Encoding': 'gzip'})
+    assert cached.status_code == 304
+    assert cached.headers['etag'] == compressed.headers['etag']
+    stale = client.get(url, headers={'If-None-Match': full.headers['etag'], 'Accept-Encoding': 'gzip'})
+    assert stale.status_code == 200
+
+    tail = client.get(url, params={'tail': 2})
+    assert tail.text == 'log line 198\nlog line 199\n'
+
+    page = client.get('/logs/test_log_files/', params={'limit': 2})
+    assert '/logs/test_log_files/app.log' in page.text
+    assert '/logs/test_log_files/dir0/' in page.text
+    assert 'dir1' not in page.text
+    assert 'offset=2' in page.text
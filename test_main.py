@@ -28,6 +28,37 @@ def test_clear_profiles():
     assert response.status_code == 200
 
 
+def test_login_token():
+    json_data = {
+        "login": "TEST_USER",
+        "password": "12345"
+    }
+    response = client.post(
+        "/login",
+        json=json_data
+    )
+    assert response.status_code == 200
+    token = response.json()['access_token']
+
+    response = client.post(
+        "/all_profiles",
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    assert response.status_code == 200
+
+    response = client.post(
+        "/all_profiles",
+        headers={"Authorization": "Bearer wrong"}
+    )
+    assert response.status_code == 401
+
+    response = client.post(
+        "/all_profiles",
+        json={"login": "TEST_USER", "password": "wrong"}
+    )
+    assert response.status_code == 401
+
+
 def test_create_profile():
     json_data = {
         "user_request": {
@@ -162,12 +193,21 @@ def test_bandr_post():
     }
     response = client.post(
         "/bandr",
-        params={"profile_name": "test_profile"},
+        params={"profile_name": "test_profile", "wait": True},
         json=json_data
     )
 
     assert response.status_code == 200
     assert response.json()['is_running'] == True
+    assert response.json()['job']['status'] == 'running'
+
+    job_response = client.post(
+        "/job_status",
+        params={"job_id": response.json()['job']['job_id']},
+        json=json_data
+    )
+    assert job_response.status_code == 200
+    assert job_response.json()['status'] == 'running'
 
 
 def test_stop_profile():
@@ -0,0 +1,45 @@
+from fastapi.testclient import TestClient
+
+import cd2b_metrics
+import main
+
+
+def test_histogram_and_counter_render():
+    registry = cd2b_metrics.Registry()
+    histogram = registry.histogram('test_seconds', 'Test histogram.', ['file'], buckets=[0.1, 1])
+    counter = registry.counter('test_total', 'Test counter.', ['result'])
+    histogram.observe(0.05, 'a.sql')
+    histogram.observe(0.5, 'a.sql')
+    histogram.observe(5, 'a.sql')
+    counter.inc('say "hi"')
+
+    assert registry.render().splitlines() == [
+        '# HELP test_seconds Test histogram.',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{file="a.sql",le="0.1"} 1',
+        'test_seconds_bucket{file="a.sql",le="1"} 2',
+        'test_seconds_bucket{file="a.sql",le="+Inf"} 3',
+        'test_seconds_sum{file="a.sql"} 5.55',
+        'test_seconds_count{file="a.sql"} 3',
+        '# HELP test_total Test counter.',
+        '# TYPE test_total counter',
+        'test_total{result="say \\"hi\\""} 1',
+    ]
+
+
+def test_subprocess_labels():
+    assert cd2b_metrics.subprocess_labels('/usr/bin/docker build --build-arg A=1 -t x .'.split()) == ('docker', 'build')
+    assert cd2b_metrics.subprocess_labels(['git', 'rev-parse', 'HEAD']) == ('git', 'rev-parse')
+
+
+def test_metrics_endpoint_reports_request_latency():
+    client = TestClient(main.app)
+    client.get('/logs/missing.log')
+    client.get('/no_such_endpoint')
+    response = client.get('/metrics')
+
+    assert response.headers['content-type'] == cd2b_metrics.CONTENT_TYPE
+    assert '# TYPE cd2b_http_request_duration_seconds histogram' in response.text
+    assert 'cd2b_http_request_duration_seconds_count{method="GET",path="/logs/{files_path:path}",status="404"}' \
+           in response.text
+    assert 'path="unmatched",status="404"' in response.text
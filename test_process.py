@@ -0,0 +1,145 @@
+import asyncio
+import json
+import sys
+
+import cd2b_process
+import utils
+
+
+def test_line_splitter_handles_partial_and_progress_lines():
+    splitter = cd2b_process.LineSplitter()
+    assert splitter.feed(b'first line\nsec') == [('first line', True), ('sec', False)]
+    assert splitter.feed(b'ond\r\n10%\r20%') == [('second', True), ('20%', False)]
+    assert splitter.feed(b'\r100%\n') == [('100%', True)]
+    assert splitter.feed('п'.encode()[:1]) == []
+    assert splitter.close() == [('�', True)]
+
+
+class SlowWebSocket:
+    def __init__(self):
+        self.frames = []
+
+    async def send_text(self, text):
+        await asyncio.sleep(0.01)
+        self.frames.append(json.loads(text))
+
+
+def test_process_writer_coalesces_frames():
+    script = 'import sys\nfor i in range(5000): sys.stderr.write(f"line {i}\\n")\n'
+
+    async def scenario():
+        websocket = SlowWebSocket()
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, '-c', script,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        await utils.process_writer(process, websocket)
+        await process.wait()
+        return websocket.frames
+
+    frames = asyncio.run(scenario())
+    lines = '\n'.join(frame['message'] for frame in frames).split('\n')
+    assert lines == [f'line {i}' for i in range(5000)]
+    assert len(frames) < 50
+    assert all(len(frame['message']) <= cd2b_process.MAX_FRAME_SIZE for frame in frames)
+
+
+
+def test_frame_coalescer_splits_oversized_lines():
+    frames = []
+
+    async def send(frame):
+        frames.append(frame)
+
+    async def scenario():
+        coalescer = cd2b_process.FrameCoalescer(send, max_frame_size=100)
+        coalescer.start()
+        await coalescer.add('x' * 250)
+        await coalescer.add('short')
+        await coalescer.add('%' * 150, is_new_line=False)
+        await coalescer.close()
+
+    asyncio.run(scenario())
+    assert all(len(frame['message']) <= 100 for frame in frames)
+    lines = '\n'.join(frame['message'] for frame in frames if frame['is_new_line']).split('\n')
+    assert ''.join(lines[:3]) == 'x' * 250 and lines[3] == 'short'
+    assert frames[-1] == {'message': '%' * 100, 'is_new_line': False}
+
+class CollectingConsumer(cd2b_process.LogConsumer):
+    def __init__(self):
+        self.lines = []
+        self.closed = False
+
+    async def write(self, line):
+        self.lines.append(line)
+
+    async def close(self):
+        self.closed = True
+
+
+def test_pump_drains_both_streams():
+    # 1MB в stdout переполнил бы пайп, если бы читался только stderr
+    script = (
+        'import sys\n'
+        'for _ in range(10000): sys.stdout.write("x" * 100 + "\\n")\n'
+        'sys.stdout.flush()\n'
+        'sys.stderr.write("done\\n")\n'
+        'sys.exit(3)\n'
+    )
+
+    async def scenario():
+        consumer = CollectingConsumer()
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, '-c', script,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        returncode = await asyncio.wait_for(cd2b_process.pump(process, [consumer]), 10)
+        return returncode, consumer
+
+    returncode, consumer = asyncio.run(scenario())
+    assert returncode == 3
+    assert consumer.closed
+    assert sum(line.stream == cd2b_process.STDOUT for line in consumer.lines) == 10000
+    assert consumer.lines[-1].stream == cd2b_process.STDERR
+    assert consumer.lines[-1].text == 'done'
+
+
+def test_cancelled_pump_kills_process():
+    async def scenario():
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, '-c', 'import time\nprint("started", flush=True)\ntime.sleep(60)',
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        task = asyncio.create_task(cd2b_process.pump(process, []))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        return process.returncode
+
+    assert asyncio.run(asyncio.wait_for(scenario(), 10)) is not None
+
+
+class BrokenPipeProcess:
+    def __init__(self):
+        self.stdout = asyncio.StreamReader()
+        self.stdout.set_exception(BrokenPipeError('pipe closed'))
+        self.stderr = None
+
+
+def test_iter_line_batches_propagates_read_errors():
+    async def scenario():
+        try:
+            async for _ in cd2b_process.iter_line_batches(BrokenPipeProcess()):
+                pass
+        except BrokenPipeError:
+            return True
+        return False
+
+    # ошибка чтения пайпа не выглядит как обычный конец вывода
+    assert asyncio.run(scenario())
@@ -0,0 +1,76 @@
+import asyncio
+import os
+
+import pytest
+
+import cd2b_api
+import cd2b_properties
+
+
+def test_properties_set_keeps_layout():
+    properties = cd2b_properties.Properties.parse('# comment\na.b=1\n\nc=2')
+
+    assert properties.get('a.b') == '1'
+    assert properties.set('a.b', '1') is False
+    assert properties.update({'a.b': 3, 'd': 'x'}) is True
+    assert properties.render() == '# comment\na.b=3\n\nc=2\nd=x\n'
+
+
+def test_properties_cache_batches_and_reloads(tmp_path):
+    path = str(tmp_path / 'application.properties')
+    with open(path, 'w') as file:
+        file.write('a=1\n')
+    cache = cd2b_properties.PropertiesCache()
+
+    async def scenario():
+        first = await cache.load(path)
+        again = await cache.load(path)
+        await cache.update(path, {'a': 2, 'b': 3})
+        updated = await cache.load(path)
+        # файл поменяли снаружи - модель перечитывается
+        with open(path, 'w') as file:
+            file.write('a=10\nb=3\nc=4\n')
+        reloaded = await cache.load(path)
+        return first, again, updated, reloaded
+
+    first, again, updated, reloaded = asyncio.run(scenario())
+    assert first is again
+    assert first.get('a') == '1'
+    assert updated.render() == 'a=2\nb=3\n'
+    assert reloaded.get('c') == '4'
+    assert os.listdir(tmp_path) == ['application.properties']
+
+
+def test_profile_update_properties_pins_port(tmp_path):
+    profile = cd2b_api.Profile('props', 'https://github.com/owner/repo.git', 8080, str(tmp_path))
+    properties_path = tmp_path / 'PROPERTIES' / profile.docker_image_name / 'application.properties'
+    properties_path.parent.mkdir(parents=True)
+    properties_path.write_text('server.port=1\nspring.name=old\n')
+
+    asyncio.run(profile.update_properties({'spring.name': 'new', 'server.port': 9999, 'extra': 'x'}))
+
+    assert properties_path.read_text() == 'server.port=8080\nspring.name=new\nextra=x\n'
+    # в репо проперти копируются только при сборке
+    assert not (tmp_path / 'repos').exists()
+    with pytest.raises(ValueError):
+        asyncio.run(profile.update_properties({'bad key': '1'}))
+    # перевод строки в значении дописал бы в файл второй server.port
+    with pytest.raises(ValueError):
+        asyncio.run(profile.update_properties({'spring.name': 'x\nserver.port=1'}))
+    assert properties_path.read_text() == 'server.port=8080\nspring.name=new\nextra=x\n'
+
+
+def test_atomic_write_keeps_file_mode(tmp_path):
+    path = str(tmp_path / 'application.properties')
+    with open(path, 'w') as file:
+        file.write('a=1\n')
+    os.chmod(path, 0o644)
+
+    asyncio.run(cd2b_properties.PropertiesCache().update(path, {'a': 2}))
+
+    assert os.stat(path).st_mode & 0o777 == 0o644
+    # новый файл получает те же права, что и созданный через open()
+    new_path = str(tmp_path / 'new.properties')
+    cd2b_properties.atomic_write(new_path, b'a=1\n')
+    (tmp_path / 'plain').write_text('')
+    assert os.stat(new_path).st_mode & 0o777 == os.stat(tmp_path / 'plain').st_mode & 0o777
@@ -0,0 +1,23 @@
+import os
+
+from cd2b_queries import QueryRegistry, parse_statements
+
+
+def test_parse_statements():
+    statements = parse_statements(
+        '-- comment with select\nINSERT INTO t VALUES (?);\nSELECT * FROM t;\n-- trailing comment'
+    )
+    assert [statement.is_read for statement in statements] == [False, True]
+    assert statements[1].sql == 'SELECT * FROM t'
+
+
+def test_hot_reload(tmp_path):
+    query_file = tmp_path / 'q.sql'
+    query_file.write_text('SELECT 1;')
+    registry = QueryRegistry(str(tmp_path), hot_reload=True)
+    registry.load()
+    assert registry.get('q.sql').statements[0].sql == 'SELECT 1'
+
+    query_file.write_text('SELECT 2;')
+    os.utime(query_file, (0, 12345))
+    assert registry.get('q.sql').statements[0].sql == 'SELECT 2'
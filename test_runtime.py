@@ -0,0 +1,333 @@
+import asyncio
+import io
+import json
+import tarfile
+import time
+
+import pytest
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+import cd2b_api
+import cd2b_containers
+import cd2b_git
+import cd2b_process
+import cd2b_runtime
+
+
+class ListLogConsumer(cd2b_process.LogConsumer):
+    def __init__(self):
+        self.lines = []
+        self.closed = False
+
+    async def write(self, line: cd2b_process.LogLine):
+        self.lines.append((line.text, line.is_new_line))
+
+    async def close(self):
+        self.closed = True
+
+
+# Небольшая замена Docker Engine: отвечает на те запросы, которые делает EngineApiRuntime
+def fake_engine(requests: list) -> Starlette:
+    images = {'cd2b_repo_app:latest'}
+    running = {}
+
+    async def build(request: Request):
+        archive = tarfile.open(fileobj=io.BytesIO(await request.body()))
+        requests.append(('build', request.query_params.getlist('t'), sorted(archive.getnames()),
+                         json.loads(request.query_params['buildargs'])))
+        images.update(request.query_params.getlist('t'))
+
+        async def messages():
+            yield b'{"stream":"Step 1/2 : FROM scratch\\n"}\r\n'
+            yield b'{"stream":"Step 2/2 : COPY . ."}\r\n{"stream":"\\n"}\r\n'
+            if 'fail' in request.query_params.getlist('t'):
+                yield b'{"errorDetail":{"message":"boom"},"error":"boom"}\r\n'
+
+        return StreamingResponse(messages(), media_type='application/json')
+
+    async def inspect_image(request: Request):
+        image = request.path_params['image']
+        if image in images or f'{image}:latest' in images:
+            return JSONResponse({'Id': 'sha256:fake'})
+        return JSONResponse({'message': 'No such image'}, status_code=404)
+
+    async def list_images(request: Request):
+        reference = json.loads(request.query_params['filters'])['reference'][0]
+        tags = [image for image in images if image.startswith(reference + ':')]
+        return JSONResponse([{'RepoTags': tags}] if tags else [])
+
+    async def tag_image(request: Request):
+        images.add(f"{request.query_params['repo']}:{request.query_params['tag']}")
+        return Response(status_code=201)
+
+    async def remove_image(request: Request):
+        images.discard(request.path_params['image'])
+        return JSONResponse([{'Untagged': request.path_params['image']}])
+
+    async def create_container(request: Request):
+        name = request.query_params['name']
+        requests.append(('create', name, await request.json()))
+        running[name] = 'id_' + name
+        return JSONResponse({'Id': running[name]}, status_code=201)
+
+    async def start_container(request: Request):
+        requests.append(('start', request.path_params['id']))
+        return Response(status_code=204)
+
+    async def stop_container(request: Request):
+        if running.pop(request.path_params['name'], None) is None:
+            return Response(status_code=304)
+        return Response(status_code=204)
+
+    async def events(request: Request):
+        async def stream():
+            yield b'{"Type":"container","Action":"start","Actor":{"Attributes":{"name":"cd2b_repo_app"}}}\n'
+
+        return StreamingResponse(stream(), media_type='application/json')
+
+    async def container_logs(request: Request):
+        requests.append(('logs', request.path_params['name'], dict(request.query_params)))
+
+        def frame(stream_type: int, data: bytes) -> bytes:
+            return bytes([stream_type, 0, 0, 0]) + len(data).to_bytes(4, 'big') + data
+
+        # строка stdout разрезана между кадрами, между ними - кадр stderr
+        body = frame(1, b'10:00:00Z started\n10:00:') + frame(2, b'10:00:01Z oops\n') + frame(1, b'02Z done\n')
+        return Response(body, media_type='application/vnd.docker.raw-stream')
+
+    async def list_containers(request: Request):
+        return JSONResponse([
+            {'Names': ['/' + name], 'Image': name, 'Status': 'Up 1 second'} for name in running
+        ])
+
+    return Starlette(routes=[
+        Route('/v1.41/build', build, methods=['POST']),
+        Route('/v1.41/images/json', list_images),
+        Route('/v1.41/images/{image:path}/json', inspect_image),
+        Route('/v1.41/images/{image:path}/tag', tag_image, methods=['POST']),
+        Route('/v1.41/images/{image:path}', remove_image, methods=['DELETE']),
+        Route('/v1.41/containers/create', create_container, methods=['POST']),
+        Route('/v1.41/containers/{id}/start', start_container, methods=['POST']),
+        Route('/v1.41/containers/{name}/stop', stop_container, methods=['POST']),
+        Route('/v1.41/containers/json', list_containers),
+        Route('/v1.41/containers/{name}/logs', container_logs),
+        Route('/v1.41/events', events),
+    ])
+
+
+def test_engine_api_runtime(tmp_path):
+    socket_path = str(tmp_path / 'docker.sock')
+    context = tmp_path / 'context'
+    (context / '.git').mkdir(parents=True)
+    (context / 'build').mkdir()
+    (context / 'Dockerfile').write_text('FROM scratch\n')
+    (context / 'build' / 'app.jar').write_text('jar')
+    (context / '.dockerignore').write_text('# comment\nbuild\n')
+    requests = []
+
+    async def scenario():
+        server = uvicorn.Server(uvicorn.Config(fake_engine(requests), uds=socket_path, log_level='warning'))
+        serving = asyncio.create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.01)
+        runtime = cd2b_runtime.EngineApiRuntime(socket_path)
+        consumer = ListLogConsumer()
+        try:
+            await runtime.build(str(context), ['cd2b_repo_app:abc', 'cd2b_repo_app'], {'HOST_USER_UID': '1000'},
+                                [consumer])
+            try:
+                await runtime.build(str(context), ['fail'])
+                failed = None
+            except cd2b_process.ProcessFailedError as e:
+                failed = e
+            results = {
+                'exists': await runtime.image_exists('cd2b_repo_app:abc'),
+                'missing': await runtime.image_exists('cd2b_repo_other'),
+                'tag': await runtime.tag('cd2b_repo_app:abc', 'cd2b_repo_app:old'),
+                'tags': sorted(await runtime.image_tags('cd2b_repo_app')),
+                'removed': await runtime.remove_images(['cd2b_repo_app:old']),
+                'run': await runtime.run('cd2b_repo_app', 'cd2b_repo_app', ports={8080: 9000},
+                                         volumes={'/srv/logs': '/usr/src/app/logs'}),
+                'running': await runtime.list_running(),
+                'stop': await runtime.stop('cd2b_repo_app'),
+                'stop_again': await runtime.stop('cd2b_repo_app'),
+                'logs': [
+                    (line.stream, line.text)
+                    async for batch in runtime.container_logs('cd2b_repo_app', since='1700000000', tail=5,
+                                                              timestamps=True)
+                    for line in batch
+                ],
+            }
+            async with runtime.events() as events:
+                results['event'] = await events.__anext__()
+        finally:
+            await runtime.close()
+            server.should_exit = True
+            await serving
+        return consumer, failed, results
+
+    consumer, failed, results = asyncio.run(scenario())
+
+    assert consumer.closed
+    assert [text for text, is_new_line in consumer.lines if is_new_line] == [
+        'Step 1/2 : FROM scratch', 'Step 2/2 : COPY . .'
+    ]
+    assert 'boom' in failed.output_tail
+    assert requests[0] == ('build', ['cd2b_repo_app:abc', 'cd2b_repo_app'], ['.dockerignore', '.git', 'Dockerfile'],
+                           {'HOST_USER_UID': '1000'})
+    assert results['exists'] and not results['missing']
+    assert results['tag'] and results['removed']
+    assert results['tags'] == ['abc', 'latest', 'old']
+    assert results['run']
+    create = next(request for request in requests if request[0] == 'create')
+    assert create[2]['HostConfig']['PortBindings'] == {'8080/tcp': [{'HostPort': '9000'}]}
+    assert create[2]['HostConfig']['Binds'] == ['/srv/logs:/usr/src/app/logs']
+    assert list(results['running']) == ['cd2b_repo_app']
+    assert results['stop'] and results['stop_again']
+    assert results['logs'] == [
+        ('stdout', '10:00:00Z started'), ('stderr', '10:00:01Z oops'), ('stdout', '10:00:02Z done')
+    ]
+    logs_request = next(request for request in requests if request[0] == 'logs')
+    assert logs_request[2] == {'stdout': '1', 'stderr': '1', 'follow': '0', 'timestamps': '1', 'since': '1700000000',
+                               'tail': '5'}
+    assert results['event']['Actor']['Attributes']['name'] == 'cd2b_repo_app'
+
+
+def test_api_timestamp():
+    assert cd2b_runtime.api_timestamp('1700000000.5') == '1700000000.5'
+    assert cd2b_runtime.api_timestamp('2024-01-01T00:00:00Z') == '1704067200.000000000'
+    assert abs(float(cd2b_runtime.api_timestamp('1h30m')) - (time.time() - 5400)) < 5
+
+
+def test_build_context_follows_dockerignore_rules(tmp_path):
+    for path in ('src/main/App.java', 'src/test/AppTest.java', 'docs/a/b/notes.md', 'build/app.jar', 'README.md'):
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text(path)
+    (tmp_path / 'Dockerfile').write_text('FROM scratch\n')
+    (tmp_path / '.dockerignore').write_text('*\n!src\nsrc/test\n!**/*.md\ndocs/*.md\n')
+
+    with tarfile.open(fileobj=cd2b_runtime.make_build_context(str(tmp_path))) as archive:
+        names = sorted(archive.getnames())
+
+    # * не переходит через /, поэтому docs/*.md не задевает docs/a/b/notes.md; Dockerfile отправляется всегда
+    assert names == ['.dockerignore', 'Dockerfile', 'README.md', 'docs/a/b/notes.md', 'src', 'src/main',
+                     'src/main/App.java']
+
+
+def test_profile_uses_runtime(tmp_path, monkeypatch):
+    runtime = cd2b_runtime.FakeRuntime()
+
+    async def sync_repository(url, path, **kwargs):
+        (tmp_path / 'synced').write_text(path)
+
+    async def head_commit(path):
+        return '0123456789abcdef0123456789abcdef01234567'
+
+    monkeypatch.setattr(cd2b_git, 'sync_repository', sync_repository)
+    monkeypatch.setattr(cd2b_git, 'head_commit', head_commit)
+    previous = cd2b_runtime.set_runtime(runtime)
+    profile = cd2b_api.Profile('app', 'https://github.com/owner/repo.git', 8080, str(tmp_path))
+
+    async def scenario():
+        consumer = ListLogConsumer()
+        await profile.run(external_port=39517, consumers=[consumer])
+        running = await profile.is_running()
+        # образ с тем же тегом уже есть - второй сборки нет
+        await profile.build()
+        await profile.stop_container()
+        return consumer, running, await profile.is_running()
+
+    try:
+        consumer, running, stopped_running = asyncio.run(scenario())
+    finally:
+        cd2b_runtime.set_runtime(previous)
+
+    assert consumer.lines == [('BUILD SUCCESSFUL', True)]
+    assert running and not stopped_running
+    assert [call[0] for call in runtime.calls].count('build') == 1
+    run_call = next(call for call in runtime.calls if call[0] == 'run')
+    assert run_call[2] == profile.docker_image_name
+    assert run_call[3] == {8080: 39517}
+    assert ('stop', profile.docker_image_name) in runtime.calls
+    assert cd2b_containers.status.list_containers == previous.list_running
+
+
+def test_engine_api_runtime_without_docker(tmp_path):
+    runtime = cd2b_runtime.EngineApiRuntime(str(tmp_path / 'missing.sock'))
+    (tmp_path / 'Dockerfile').write_text('FROM scratch\n')
+
+    async def scenario():
+        try:
+            results = {
+                'exists': await runtime.image_exists('cd2b_repo_app'),
+                'tags': await runtime.image_tags('cd2b_repo_app'),
+                'tag': await runtime.tag('cd2b_repo_app', 'cd2b_repo_app:old'),
+                'run': await runtime.run('cd2b_repo_app', 'cd2b_repo_app'),
+                'stop': await runtime.stop('cd2b_repo_app'),
+                'removed': await runtime.remove_images(['cd2b_repo_app:old']),
+            }
+            errors = []
+            for call in (runtime.list_running(), runtime.build(str(tmp_path), ['cd2b_repo_app'])):
+                try:
+                    await call
+                except cd2b_runtime.DockerApiError as e:
+                    errors.append(e)
+        finally:
+            await runtime.close()
+        return results, errors
+
+    results, errors = asyncio.run(scenario())
+
+    assert results == {'exists': False, 'tags': [], 'tag': False, 'run': False, 'stop': False, 'removed': False}
+    assert [(e.operation, e.status_code) for e in errors] == [('container_list', None), ('build', None)]
+
+
+def test_container_runtime_requires_all_operations():
+    class PartialRuntime(cd2b_runtime.ContainerRuntime):
+        async def list_running(self):
+            return {}
+
+    with pytest.raises(TypeError):
+        PartialRuntime()
+
+
+def test_tracker_and_logs_use_runtime(tmp_path):
+    runtime = cd2b_runtime.FakeRuntime()
+    runtime.images.add(('cd2b_repo_app', 'latest'))
+    runtime.logs['cd2b_repo_app'] = ['one', 'two']
+    profile = cd2b_api.Profile('app', 'https://github.com/owner/repo.git', 8080, str(tmp_path))
+
+    async def wait_for(condition):
+        for _ in range(100):
+            if condition():
+                return True
+            await asyncio.sleep(0.01)
+        return False
+
+    async def scenario():
+        tracker = cd2b_containers.tracker
+        tracker.start()
+        try:
+            live = await wait_for(lambda: tracker.is_live)
+            await runtime.run('cd2b_repo_app', 'cd2b_repo_app')
+            started = await wait_for(lambda: tracker.is_running('cd2b_repo_app'))
+            await runtime.stop('cd2b_repo_app')
+            stopped = await wait_for(lambda: not tracker.is_running('cd2b_repo_app'))
+        finally:
+            await tracker.stop()
+        logs = [line.text async for batch in profile.container_logs(tail=1) for line in batch]
+        return live, started, stopped, logs
+
+    previous = cd2b_runtime.set_runtime(runtime)
+    try:
+        live, started, stopped, logs = asyncio.run(scenario())
+    finally:
+        cd2b_runtime.set_runtime(previous)
+
+    assert live and started and stopped
+    assert logs == ['two']
+    assert ('container_logs', 'cd2b_repo_app') in runtime.calls
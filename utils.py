@@ -1,10 +1,12 @@
+import asyncio
 import os
 import re
-import subprocess
-from typing import Optional
+from typing import Awaitable, Iterable, Optional
 
 from fastapi import WebSocket
 
+import cd2b_process
+
 
 def create_dirs(path: str):
     directory_path = os.path.dirname(path)
@@ -21,35 +23,27 @@ def build_path(path1: str, path2: str) -> str:
     ).rstrip('/')
 
 
-# Вспомогательный метод, отправляющий по вебсокету результат билда контейнера
-# TODO: обработка ошибок
-# TODO: возможно стоит читать посимвольно и проверять на новую строку? Тогда эта штука будет работать не только в случае с gradle
-async def process_writer(process, websocket: Optional['WebSocket'] = None):
-    output = ''
-    is_gradle_downloading = False
-    while process.returncode is None:
-        if "Downloading https://services.gradle.org/" in output:
-            is_gradle_downloading = True
-            output = ""
+# Вспомогательный метод, отправляющий по вебсокету результат билда контейнера.
+# Читает stdout и stderr процесса одновременно, по вебсокету уходят склеенные
+# фреймы {"message": ..., "is_new_line": ...}. Возвращает код возврата процесса
+async def process_writer(process, websocket: Optional['WebSocket'] = None) -> int:
+    consumers: list[cd2b_process.LogConsumer] = []
+    if cd2b_process.PRINT_BUILD_OUTPUT:
+        consumers.append(cd2b_process.PrintLogConsumer())
+    if websocket is not None:
+        consumers.append(cd2b_process.WebSocketLogConsumer(websocket))
+    return await cd2b_process.pump(process, consumers)
 
-        output = output + (await process.stderr.read(1)).decode() if is_gradle_downloading \
-            else (await process.stderr.readline()).decode().strip().rstrip('\n')
 
-        if output:
-            if websocket is not None:
-                await websocket.send_json(
-                    {
-                        "message": output,
-                        "is_new_line": not is_gradle_downloading
-                    }
-                )
-            print(output)
+# Аналог asyncio.gather, но одновременно выполняется не больше limit awaitable
+async def gather_bounded(aws: Iterable[Awaitable], limit: int) -> list:
+    semaphore = asyncio.Semaphore(limit)
 
-        if is_gradle_downloading and "100%" in output:
-            is_gradle_downloading = False
+    async def run(aw: Awaitable):
+        async with semaphore:
+            return await aw
 
-        if process.stdout.at_eof() and process.stderr.at_eof():
-            break
+    return await asyncio.gather(*[run(aw) for aw in aws])
 
 
 async def is_valid_properties_file(properties_content: str) -> bool: